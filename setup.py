@@ -12,6 +12,7 @@ os.environ["CXX"] = "g++"
 language = "c++"
 extra_compile_args=["-std=c++11", "-O3"]
 extra_link_args=["-std=c++11", "-O3"]
+openmp_args = ["-fopenmp"]
 include_dirs = [np.get_include()]
 
 modules = [Extension("simplot.rootplot.cmerge",
@@ -36,14 +37,14 @@ modules = [Extension("simplot.rootplot.cmerge",
                      ["simplot/sparsehist/unordered_map.pxd", "simplot/sparsehist/sparsehist.pxd", "simplot/sparsehist/sparsehist.pyx"],
                      include_dirs=include_dirs,
                      language = language,
-                     extra_compile_args=extra_compile_args,
-                     extra_link_args=extra_link_args),
+                     extra_compile_args=extra_compile_args + openmp_args,
+                     extra_link_args=extra_link_args + openmp_args),
            Extension("simplot.binnedmodel.model",
                      ["simplot/binnedmodel/model.pyx"],
                      include_dirs=include_dirs,
                      language = language,
-                     extra_compile_args=extra_compile_args,
-                     extra_link_args=extra_link_args),
+                     extra_compile_args=extra_compile_args + openmp_args,
+                     extra_link_args=extra_link_args + openmp_args),
            Extension("simplot.binnedmodel.fluxweights",
                  ["simplot/binnedmodel/fluxweights.pyx"],
                      include_dirs=include_dirs,
@@ -54,8 +55,14 @@ modules = [Extension("simplot.rootplot.cmerge",
                  ["simplot/binnedmodel/xsecweights.pyx"],
                      include_dirs=include_dirs,
                  language = "c++",
-                     extra_compile_args=["-std=c++11", "-O3"],
-                     extra_link_args=["-std=c++11", "-O3"]),
+                     extra_compile_args=["-std=c++11", "-O3"] + openmp_args,
+                     extra_link_args=["-std=c++11", "-O3"] + openmp_args),
+           Extension("simplot.binnedmodel.vacuumprob",
+                     ["simplot/binnedmodel/vacuumprob.pyx"],
+                     include_dirs=include_dirs,
+                     language = language,
+                     extra_compile_args=extra_compile_args + openmp_args,
+                     extra_link_args=extra_link_args + openmp_args),
            Extension("simplot.binnedmodel.simplemodelwithosc",
                      ["simplot/binnedmodel/simplemodelwithosc.pyx"],
                      include_dirs=include_dirs,
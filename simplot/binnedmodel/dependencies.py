@@ -0,0 +1,69 @@
+import numpy as np
+
+################################################################################
+
+def parameter_indices(component):
+    """Positions in the parameter vector that component depends on.
+    Components declare these with a parameter_indices() method. None is
+    returned if the dependencies are unknown, the component is then treated as
+    depending on every parameter.
+    """
+    if component is None:
+        return []
+    try:
+        method = component.parameter_indices
+    except AttributeError:
+        return None
+    return list(method())
+
+################################################################################
+
+class ParameterDependencies(object):
+    """Tracks which of a sequence of components have inputs that changed
+    since the previous parameter vector.
+    """
+    def __init__(self, dependencies):
+        #dependencies is a list of index lists (None for unknown dependencies)
+        self._dependencies = list(dependencies)
+        self._unknown = np.array([d is None for d in self._dependencies], dtype=bool)
+        self._mask = None
+        self._previous = None
+
+    def __len__(self):
+        return len(self._dependencies)
+
+    def parameter_indices(self):
+        """The union of the dependencies, None if any of them are unknown."""
+        if np.any(self._unknown):
+            return None
+        return sorted(set(i for d in self._dependencies for i in d))
+
+    def changed(self, pars):
+        """Boolean array, True for each component whose parameters changed
+        since the last call. Everything has changed on the first call.
+        """
+        pars = np.asarray(pars, dtype=float)
+        if self._previous is None or self._previous.shape != pars.shape:
+            self._build_mask(len(pars))
+            self._previous = np.array(pars, copy=True)
+            return np.ones(len(self._dependencies), dtype=bool)
+        #NaN never compares equal so it is always treated as a change
+        diff = pars != self._previous
+        result = self._mask.dot(diff) | self._unknown
+        self._previous[:] = pars
+        return result
+
+    def reset(self):
+        """Forget the previous parameters so that everything is recalculated."""
+        self._previous = None
+        return
+
+    def _build_mask(self, npars):
+        mask = np.zeros((len(self._dependencies), npars), dtype=bool)
+        for ii, indices in enumerate(self._dependencies):
+            if indices is not None:
+                mask[ii, indices] = True
+        self._mask = mask
+        return
+
+################################################################################
@@ -6,6 +6,9 @@ from libc.stdint cimport uint64_t
 
 import re
 
+import numpy as np
+import scipy.sparse
+
 #_DEFAULT_FLAV_BINMAP = {"numu" : 0, "nue" : 1, "antinumu" : 2, "antinue" : 3}
 _DEFAULT_FLAV_BINMAP = {0 : 0, 1 : 1, 2 : 2, 3 : 3}
 
@@ -96,6 +99,24 @@ cdef class FluxWeights:
         _update(self, pars)
         return self._arr
 
+    def parameter_indices(self):
+        return sorted(set(self._parindex))
+
+    def jacobian(self, pars):
+        """Derivatives of the stored weights with respect to pars as a sparse
+        matrix, each weight is equal to one of the parameters.
+        """
+        #the stored weights (and their positions) exist once pars are set
+        _update(self, pars)
+        self._arr.freeze()
+        keys = np.array(self._keys, dtype=np.uint64)
+        parindex = np.array(self._parindex, dtype=np.intp)
+        #as in _update, the last parameter set for a bin is used
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        position = np.searchsorted(self._arr._keys, keys[last])
+        return scipy.sparse.csr_matrix((np.ones(len(last)), (position, parindex[last])), shape=(self._arr._nfrozen, len(pars)))
+
 cdef void _update(FluxWeights self, vector[double]& pars):
         cdef int ii
         cdef uint64_t key
@@ -104,5 +125,5 @@ cdef void _update(FluxWeights self, vector[double]& pars):
             key = self._keys[ii]
             parindex = self._parindex[ii]
             value = pars[parindex]
-            self._arr._data[key] = value
+            self._arr.setkey(key, value)
         return
@@ -1,21 +1,28 @@
 # cython: profile=False
 
 #from sparsehist import SparseArray
-from simplot.sparsehist.sparsehist cimport SparseArray
+from simplot.sparsehist.sparsehist cimport SparseArray, ProjectionPlan, frozen_value, parallel_threads, same_pattern
 from simplot.sparsehist.sparsehist cimport std_map
 import numpy as np
 cimport numpy as np
 
 import cython
 from cython.operator cimport dereference, preincrement
+from cython.parallel cimport prange
 
+import collections
 import itertools
 import StringIO
 
+import scipy.sparse
+
+from simplot.binnedmodel.dependencies import ParameterDependencies, parameter_indices
+
 #from rootglobes import crootglobes
 
 from libcpp.vector cimport vector
 from libc.stdint cimport uint64_t
+from libc.string cimport memcpy
 from libc.math cimport asin, sqrt
 
 ctypedef std_map[uint64_t, double].iterator SparseArrayIterator
@@ -26,6 +33,13 @@ DEF _CODE_THETA = 0
 DEF _CODE_SINSQ2THETA = 1
 DEF _CODE_SINSQTHETA = 2
 
+DEF _STAGE_OSCILLATION = 1
+
+_ENGINES = ("dense", "sparse", "compare")
+
+#relative step of numerical derivatives
+_JACOBIAN_STEP = 1.0e-6
+
 ################################################################################
 
 class OscParMode:
@@ -46,6 +60,245 @@ class OscParMode:
 
 ################################################################################
 
+cdef class ModelWorkspace:
+    """Buffers for the intermediate products of a model evaluation.
+
+    The buffers are kept alive between evaluations. Once they have the
+    sparsity pattern of the model they are overwritten in place and no
+    memory is allocated.
+    """
+    cdef list _buffers
+    cdef SparseArray result
+
+    def __init__(self, shape):
+        self._buffers = [SparseArray(shape) for _ in xrange(2)]
+        self.result = SparseArray(shape)
+
+    cdef SparseArray buffer(self, int i):
+        return self._buffers[i]
+
+    cdef SparseArray product(self, list factors, SparseArray arr, SparseArray out):
+        # factors[n-1] * (... * (factors[0] * arr)) evaluated in a single
+        # pass and written into out (a new array if out is None).
+        if not factors:
+            if out is None:
+                return arr.clone()
+            out._assign(arr)
+            return out
+        expression = arr.lazy()
+        for factor in factors:
+            expression = factor * expression
+        return expression.evaluate(out=out)
+
+cdef list _evaluate_weights(pars, list calcs):
+    return [calc(pars) for calc in calcs if calc is not None]
+
+cdef class DenseModelEngine:
+    """Flattened form of a model used to evaluate it with dense loops.
+
+    Every stored bin of the model (the rows, a frozen SparseArray) is one
+    entry of a value vector. For each weight array the row of the weight
+    that applies to each model row is found once and cached for its
+    sparsity pattern, so applying a weight is a gather and a multiply.
+    Weights that share the pattern of the rows need no gather at all.
+
+    One gather is kept per slot (the stage of the model that the weight is
+    applied at). It is replaced when the weight in that slot has a
+    different sparsity pattern.
+    """
+    cdef SparseArray _rows
+    cdef dict _gathers
+
+    def __init__(self, SparseArray rows):
+        self._rows = rows.freeze()
+        self._gathers = {}
+
+    cdef np.ndarray _gather(self, SparseArray weight, int slot):
+        # position of each row in the weight storage (-1 if the weight has
+        # no entry for it), None if the weight has the pattern of the rows
+        weight.freeze()
+        if weight._shape == self._rows._shape and same_pattern(self._rows, weight):
+            return None
+        cached = self._gathers.get(slot)
+        if cached is not None:
+            keys, dimscale, gather = cached
+            if keys is weight._keys or (dimscale == weight._dimscale and np.array_equal(keys, weight._keys)):
+                self._gathers[slot] = (weight._keys, weight._dimscale, gather)
+                return gather
+        indices, _ = self._rows.to_indices()
+        keys = indices.dot(np.array(weight._dimscale, dtype=np.uint64))
+        position = np.searchsorted(weight._keys, keys)
+        found = position < weight._nfrozen
+        found[found] = weight._keys[position[found]] == keys[found]
+        gather = np.where(found, position, -1).astype(np.intp)
+        self._gathers[slot] = (weight._keys, weight._dimscale, gather)
+        return gather
+
+    @cython.boundscheck(False)
+    cdef SparseArray multiply(self, SparseArray arr, SparseArray weight, int slot, SparseArray out):
+        # out[i] = weight[row i] * arr[i], arr has the pattern of the rows
+        # and out may be arr
+        cdef np.ndarray gather = self._gather(weight, slot)
+        self._rows._pattern_into(out)
+        cdef double* values = arr._vptr
+        cdef double* result = out._vptr
+        cdef double* wptr = weight._vptr
+        cdef Py_ssize_t n = self._rows._nfrozen
+        cdef Py_ssize_t ii
+        cdef np.intp_t* gptr
+        if gather is None:
+            with nogil:
+                for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                    result[ii] = wptr[ii] * values[ii]
+            return out
+        gptr = <np.intp_t*> gather.data
+        with nogil:
+            for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                if gptr[ii] >= 0:
+                    result[ii] = wptr[gptr[ii]] * values[ii]
+                else:
+                    result[ii] = 0.0 * values[ii]
+        return out
+
+    cdef np.ndarray values(self, SparseArray weight, int slot):
+        # the weight at each row (0 where it has no entry)
+        cdef np.ndarray gather = self._gather(weight, slot)
+        if gather is None:
+            return np.array(weight._values, copy=True)
+        if weight._nfrozen == 0:
+            return np.zeros(self._rows._nfrozen, dtype=float)
+        return np.where(gather >= 0, weight._values[gather], 0.0)
+
+    cdef object selection(self, SparseArray weight, int slot):
+        # sparse (rows, stored entries of weight) matrix that picks the entry
+        # of the weight for each row
+        cdef np.ndarray gather = self._gather(weight, slot)
+        cdef Py_ssize_t n = self._rows._nfrozen
+        if gather is None:
+            return scipy.sparse.identity(n, format="csr")
+        rows = np.flatnonzero(gather >= 0)
+        return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, gather[rows])), shape=(n, weight._nfrozen))
+
+    cdef SparseArray start(self, SparseArray arr, SparseArray out):
+        # out (a new array if None) with the pattern of the rows and the
+        # values of arr, which must have the same pattern
+        if out is None:
+            out = SparseArray(self._rows.shape())
+        self._rows._pattern_into(out)
+        if out is not arr and self._rows._nfrozen > 0:
+            memcpy(out._vptr, arr._vptr, self._rows._nfrozen * sizeof(double))
+        return out
+
+def _batch_rows(pars_matrix):
+    pars_matrix = np.array(pars_matrix, dtype=float, ndmin=2, copy=False)
+    if pars_matrix.ndim != 2:
+        raise ValueError("expected a 2D matrix of parameter vectors", pars_matrix.shape)
+    return pars_matrix
+
+cdef np.ndarray _observable_batch(model, np.ndarray pars_matrix, np.ndarray order, Py_ssize_t size, out):
+    # evaluate the rows of pars_matrix (in the given order) into the rows of
+    # out. Each row is a full observable_array call, only the output buffer
+    # is shared between the rows.
+    cdef Py_ssize_t n = pars_matrix.shape[0]
+    cdef Py_ssize_t ii, row
+    if out is None:
+        out = np.zeros((n, size), dtype=float)
+    elif not (out.dtype == np.float64 and out.shape == (n, size) and out.flags.c_contiguous):
+        raise ValueError("batch output buffer has the wrong shape or type", np.shape(out), (n, size))
+    for ii in xrange(n):
+        row = ii if order is None else order[ii]
+        model.observable_array(pars_matrix[row], out=out[row])
+    return out
+
+cdef SparseArray _copy_factor(SparseArray arr, SparseArray out):
+    # copy of a weight array into out (a new array if None or of another
+    # shape). Weights may return an array that they keep and change later,
+    # so the cached factors of a model must not refer to it.
+    arr.freeze()
+    if out is None or out.shape() != arr.shape():
+        out = SparseArray(arr.shape())
+    out._assign(arr)
+    return out
+
+cdef SparseArray _evaluate_factor(weight, pars, SparseArray out):
+    # weight(pars) as a factor owned by the model, written into out (see
+    # _copy_factor). Weights with an _eval_into method (XsecWeights and
+    # StackedXsecWeights) write into out directly, their calls return a new
+    # copy each time.
+    try:
+        method = weight._eval_into
+    except AttributeError:
+        return _copy_factor(weight(pars), out)
+    return method(pars, out)
+
+cdef object _row_jacobian(DenseModelEngine engine, weight, SparseArray arr, int slot, np.ndarray pars):
+    # derivatives of the weight at each row of the engine with respect to
+    # pars, a sparse (rows, npars) matrix. arr is weight(pars) applied at
+    # slot of the engine. Weights
+    # without a jacobian method are differentiated numerically.
+    cdef Py_ssize_t n = engine._rows._nfrozen
+    indices = parameter_indices(weight)
+    if indices == []:
+        return scipy.sparse.csr_matrix((n, len(pars)))
+    try:
+        method = weight.jacobian
+    except AttributeError:
+        method = None
+    if method is not None:
+        return engine.selection(arr, slot).dot(scipy.sparse.csr_matrix(method(pars)))
+    if indices is None:
+        indices = range(len(pars))
+    columns = []
+    shifted = np.array(pars, dtype=float)
+    for index in indices:
+        step = _JACOBIAN_STEP * max(abs(pars[index]), 1.0)
+        shifted[index] = pars[index] + step
+        up = engine.values(weight(shifted), slot)
+        shifted[index] = pars[index] - step
+        down = engine.values(weight(shifted), slot)
+        shifted[index] = pars[index]
+        columns.append((up - down) / (2.0 * step))
+    #leave the weight at pars
+    weight(pars)
+    rows = np.tile(np.arange(n), len(indices))
+    return scipy.sparse.csr_matrix((np.ravel(columns), (rows, np.repeat(indices, n))), shape=(n, len(pars)))
+
+cdef object _projection_matrix(ProjectionPlan plan, SparseArray rows):
+    # sparse (observables, rows) matrix of the projection plan
+    plan._check_pattern(rows)
+    dest = plan._dest
+    keep = np.flatnonzero(dest >= 0)
+    return scipy.sparse.csr_matrix((np.ones(len(keep)), (dest[keep], keep)), shape=(plan._size, rows._nfrozen))
+
+cdef object _product_except(list values, Py_ssize_t skip, np.ndarray start):
+    # start times all of values except values[skip]
+    result = np.array(start, copy=True)
+    for ii, v in enumerate(values):
+        if ii != skip and v is not None:
+            result *= v
+    return result
+
+class _ConstantWeight(object):
+    """A weight array that does not depend on any parameter."""
+    def __init__(self, arr):
+        self._arr = arr
+    def __call__(self, pars):
+        return self._arr
+    def parameter_indices(self):
+        return []
+
+cdef _compare_engines(SparseArray dense, SparseArray sparse):
+    if not (same_pattern(dense, sparse) and np.array_equal(dense.to_arrays()[1], sparse.to_arrays()[1])):
+        raise Exception("dense and sparse model evaluation differ", dense.sum(), sparse.sum())
+    return
+
+cdef _check_engine(engine):
+    if engine not in _ENGINES:
+        raise ValueError("unknown model evaluation engine", engine, _ENGINES)
+    return
+
+################################################################################
+
 cdef class BinnedModel:
     cdef SparseArray _N_sel;
     cdef _flux_weights;
@@ -53,31 +306,103 @@ cdef class BinnedModel:
     cdef _det_weights;
     cdef list _parnames;
     cdef vector[uint64_t] _obs;
-    def __init__(self, parnames, N_sel, obs, flux_weights=None, xsec_weights=None, det_weights=None):
+    cdef ProjectionPlan _obsplan;
+    cdef ModelWorkspace _workspace;
+    cdef DenseModelEngine _dense;
+    cdef str _engine;
+    cdef list _weights;
+    cdef list _factors;
+    cdef list _partials;
+    cdef object _dependencies;
+    def __init__(self, parnames, N_sel, obs, flux_weights=None, xsec_weights=None, det_weights=None, engine="dense"):
+        """engine selects the evaluation: "dense" (DenseModelEngine),
+        "sparse" (SparseArray expressions) or "compare" (both, raising an
+        exception unless the results are identical).
+        """
+        _check_engine(engine)
+        self._engine = engine
         self._parnames = parnames
         self._obs = obs
         #self._shape = N_sel.array().shape()
-        self._N_sel = N_sel.array()
-        if flux_weights is None:
-            flux_weights = lambda x: _identity(self._N_sel.shape())
+        self._N_sel = N_sel.array().freeze()
+        self._obsplan = ProjectionPlan(self._N_sel.shape(), obs)
+        self._workspace = ModelWorkspace(self._N_sel.shape())
+        self._dense = DenseModelEngine(self._N_sel)
+        #weights that are None are skipped
         self._flux_weights = flux_weights
-        if xsec_weights is None:
-            xsec_weights = lambda x: _identity(self._N_sel.shape())
         self._xsec_weights = xsec_weights
-        if det_weights is None:
-            det_weights = lambda x: _identity(self._N_sel.shape())
         self._det_weights = det_weights
+        #the dense engine keeps the partial products N_sel*w0, N_sel*w0*w1, ...
+        #and only recalculates them from the first weight whose parameters changed
+        self._weights = [w for w in [flux_weights, xsec_weights, det_weights] if w is not None]
+        self._factors = [None] * len(self._weights)
+        self._partials = [SparseArray(self._N_sel.shape()) for _ in self._weights]
+        self._dependencies = ParameterDependencies([parameter_indices(w) for w in self._weights])
         return
 
     def __call__(self, pars):
         return self.eval(pars)
 
-    cdef eval(self, pars):
-        return self._det_weights(pars) * (self._xsec_weights(pars) * (self._flux_weights(pars) * self._N_sel))
+    cdef SparseArray eval(self, pars, SparseArray out=None):
+        if self._engine == "sparse":
+            return self._eval_sparse(pars, out)
+        cdef SparseArray result = self._dense.start(self._eval_dense(pars), out)
+        if self._engine == "compare":
+            _compare_engines(result, self._eval_sparse(pars, None))
+        return result
+
+    cdef SparseArray _eval_sparse(self, pars, SparseArray out):
+        factors = _evaluate_weights(pars, [self._flux_weights, self._xsec_weights, self._det_weights])
+        return self._workspace.product(factors, self._N_sel, out)
+
+    cdef SparseArray _eval_dense(self, pars):
+        # the model array, this is one of the cached partial products
+        cdef DenseModelEngine engine = self._dense
+        cdef SparseArray partial = self._N_sel
+        changed = self._dependencies.changed(pars)
+        recalculate = False
+        for ii, weight in enumerate(self._weights):
+            if changed[ii]:
+                self._factors[ii] = _evaluate_factor(weight, pars, self._factors[ii])
+                recalculate = True
+            if recalculate:
+                engine.multiply(partial, self._factors[ii], ii, self._partials[ii])
+            partial = self._partials[ii]
+        return partial
 
     def observable(self, pars):
         return self.eval(pars).project(self._obs)
 
+    def observable_array(self, pars, out=None):
+        """As observable but returns the flattened rate vector as a numpy array."""
+        if self._engine == "dense":
+            return self._obsplan(self._eval_dense(pars), out=out)
+        return self._obsplan(self.eval(pars, self._workspace.result), out=out)
+
+    def observable_batch(self, pars_matrix, out=None):
+        """observable_array for each row of pars_matrix, returned as an (n, nobs) array.
+        This is a per row convenience: the weights, the product and the
+        projection are evaluated for each row in turn and nothing is
+        amortized over the batch.
+        """
+        return _observable_batch(self, _batch_rows(pars_matrix), None, self._obsplan.size(), out)
+
+    def jacobian(self, pars):
+        """Derivatives of observable_array with respect to each parameter,
+        an (nobs, npars) array. Weights with a jacobian method (the
+        derivatives of their stored values as a sparse matrix) are
+        differentiated analytically, other weights numerically.
+        """
+        pars = np.array(pars, dtype=float)
+        cdef DenseModelEngine engine = self._dense
+        self._eval_dense(pars)
+        values = [engine.values(f, ii) for ii, f in enumerate(self._factors)]
+        result = scipy.sparse.csr_matrix((self._N_sel._nfrozen, len(pars)))
+        for ii, weight in enumerate(self._weights):
+            others = _product_except(values, ii, self._N_sel._values)
+            result = result + scipy.sparse.diags(others).dot(_row_jacobian(engine, weight, self._factors[ii], ii, pars))
+        return _projection_matrix(self._obsplan, self._N_sel).dot(result).toarray()
+
     def parameter_names(self):
         return self._parnames
 
@@ -99,14 +424,31 @@ cdef class BinnedModelWithOscillation:
     cdef _det_weights;
     cdef _osc_flux_weights;
     cdef list _parnames;
+    cdef ProjectionPlan _obsplan;
+    cdef ModelWorkspace _workspace;
+    cdef DenseModelEngine _dense;
+    cdef str _engine;
+    cdef np.ndarray _partner;
+    cdef np.ndarray _pdis;
+    cdef np.ndarray _papp;
+    cdef list _weights;
+    cdef list _factors;
+    cdef list _partials;
+    cdef object _dependencies;
 
-    def __init__(self, parnames, N_sel, N_nosel, obs, enudim, flavdim, detdim, detdist, flux_weights=None, xsec_weights=None, det_weights=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA):
+    def __init__(self, parnames, N_sel, N_nosel, obs, enudim, flavdim, detdim, detdist, flux_weights=None, xsec_weights=None, det_weights=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, engine="dense", probabilitygrid=None):
+        """engine selects the evaluation, see BinnedModel."""
+        _check_engine(engine)
+        self._engine = engine
         self._parnames = parnames
         self._shape = N_sel.array().shape()
-        self._eff = N_sel.array() / N_nosel.array()
-        self._N_sel = N_sel.array()
-        self.N_nosel = N_nosel.array()
+        #freeze the inputs so that all derived arrays share their sparsity pattern
+        self._N_sel = N_sel.array().freeze()
+        self.N_nosel = N_nosel.array().freeze()
+        self._eff = self._N_sel / self.N_nosel
         self._obs = obs
+        self._obsplan = ProjectionPlan(self._shape, obs)
+        self._workspace = ModelWorkspace(self._shape)
         self._flav_dimension = flavdim
         self._enu_dimension = enudim
         if detdim is None:
@@ -114,24 +456,112 @@ cdef class BinnedModelWithOscillation:
         self._det_dimension = detdim
         self._otherflav = [1,0,3,2]
         enubinning = N_sel.binning()[enudim]
-        self._prob = ProbabilityCache(parnames, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode)
-        if flux_weights is None:
-            flux_weights = lambda x: _identity(self._shape)
+        self._prob = shared_probability_cache(parnames, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode, grid=probabilitygrid)
+        #weights that are None are skipped
         self._flux_weights = flux_weights
-        if xsec_weights is None:
-            xsec_weights = lambda x: _identity(self._shape)
         self._xsec_weights = xsec_weights
-        if det_weights is None:
-            det_weights = lambda x: _identity(self._shape)
         self._det_weights = det_weights
         self._osc_flux_weights = OscFluxWeights(N_nosel, enudim, flavdim, detdim, self._prob)
+        self._dense = DenseModelEngine(self.N_nosel)
+        self._build_rotation()
+        #as BinnedModel, with the oscillation as the second stage of the product
+        self._weights = [flux_weights, self._prob, _ConstantWeight(self._eff), xsec_weights, det_weights]
+        self._factors = [None] * len(self._weights)
+        self._partials = [SparseArray(self._shape) for _ in self._weights]
+        self._dependencies = ParameterDependencies([parameter_indices(w) for w in self._weights])
+        return
+
+    def _build_rotation(self):
+        # for each row of N_nosel: the row of the partner flavour (-1 if it
+        # is empty) and the positions of the disappearance and appearance
+        # probabilities in the (contiguous) ProbabilityCache array
+        cdef SparseArray arr = self.N_nosel
+        indices, _ = arr.to_indices()
+        shape = self._prob.array.shape
+        enu = indices[:, self._enu_dimension].astype(np.intp)
+        flav_j = indices[:, self._flav_dimension].astype(np.intp)
+        flav_i = np.array(self._otherflav, dtype=np.intp)[flav_j]
+        det = np.zeros_like(enu)
+        if self._det_dimension != NO_DET_DIM:
+            det = indices[:, self._det_dimension].astype(np.intp)
+        offset = (enu * shape[1] + det) * shape[2] * shape[3]
+        self._pdis = offset + flav_j * shape[3] + flav_j
+        self._papp = offset + flav_i * shape[3] + flav_j
+        cdef uint64_t flavscale = arr._dimscale[self._flav_dimension]
+        otherkeys = arr._keys - flav_j.astype(np.uint64) * flavscale + flav_i.astype(np.uint64) * flavscale
+        position = np.searchsorted(arr._keys, otherkeys)
+        found = position < arr._nfrozen
+        found[found] = arr._keys[position[found]] == otherkeys[found]
+        self._partner = np.where(found, position, -1).astype(np.intp)
         return
 
     def __call__(self, pars):
         return self.eval(pars)
 
-    cdef eval(self, pars):
-        return self._det_weights(pars) * (self._xsec_weights(pars) * (self._eff * self._osc_flav_rotation(pars, self._flux_weights(pars) * self.N_nosel)))
+    cdef SparseArray eval(self, pars, SparseArray out=None):
+        if self._engine == "sparse":
+            return self._eval_sparse(pars, out)
+        cdef SparseArray result = self._dense.start(self._eval_dense(pars), out)
+        if self._engine == "compare":
+            _compare_engines(result, self._eval_sparse(pars, None))
+        return result
+
+    cdef SparseArray _eval_dense(self, pars):
+        # the model array, this is one of the cached partial products
+        cdef DenseModelEngine engine = self._dense
+        cdef SparseArray partial = self.N_nosel
+        changed = self._dependencies.changed(pars)
+        recalculate = False
+        for ii, weight in enumerate(self._weights):
+            if weight is None:
+                continue
+            if changed[ii]:
+                if ii != _STAGE_OSCILLATION:
+                    self._factors[ii] = _evaluate_factor(weight, pars, self._factors[ii])
+                recalculate = True
+            if recalculate:
+                if ii == _STAGE_OSCILLATION:
+                    #the cache may be shared with other samples and left at
+                    #their parameters, bring it back to pars (cheap if unchanged)
+                    self._prob.update(pars)
+                    self._rotate(partial, self._partials[ii])
+                else:
+                    engine.multiply(partial, self._factors[ii], ii, self._partials[ii])
+            partial = self._partials[ii]
+        return partial
+
+    @cython.boundscheck(False)
+    cdef SparseArray _rotate(self, SparseArray flux, SparseArray out):
+        # out = pdis*flux + papp*(flux of the partner flavour)
+        cdef np.ndarray posc = np.ascontiguousarray(self._prob.array)
+        self.N_nosel._pattern_into(out)
+        cdef double* pptr = <double*> posc.data
+        cdef double* fptr = flux._vptr
+        cdef double* rptr = out._vptr
+        cdef np.intp_t* partner = <np.intp_t*> self._partner.data
+        cdef np.intp_t* pdis = <np.intp_t*> self._pdis.data
+        cdef np.intp_t* papp = <np.intp_t*> self._papp.data
+        cdef Py_ssize_t n = self.N_nosel._nfrozen
+        cdef Py_ssize_t ii
+        cdef double other
+        with nogil:
+            for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                other = 0.0
+                if partner[ii] >= 0:
+                    other = fptr[partner[ii]]
+                rptr[ii] = (pptr[pdis[ii]] * fptr[ii]) + (pptr[papp[ii]] * other)
+        return out
+
+    cdef SparseArray _eval_sparse(self, pars, SparseArray out):
+        cdef ModelWorkspace ws = self._workspace
+        cdef SparseArray flux = self.N_nosel
+        cdef SparseArray weights
+        if self._flux_weights is not None:
+            weights = self._flux_weights(pars)
+            flux = weights.multiply(flux, out=ws.buffer(0))
+        cdef SparseArray rotated = self._osc_flav_rotation(pars, flux, ws.buffer(1))
+        factors = [self._eff] + _evaluate_weights(pars, [self._xsec_weights, self._det_weights])
+        return ws.product(factors, rotated, out)
         #return self._xsec_weights(pars) * (self._eff * (self._osc_flux_weights(pars) * (self._flux_weights(pars) * self.N_nosel)))
         # avoid unneccessary new copies
         #cdef SparseArray r = self._flux_weights(pars) * self.N_nosel
@@ -141,53 +571,133 @@ cdef class BinnedModelWithOscillation:
         #return r
 
     @cython.boundscheck(False)
-    cdef SparseArray _osc_flav_rotation(self, pars, SparseArray arr):
+    @cython.cdivision(True)
+    cdef SparseArray _osc_flav_rotation(self, pars, SparseArray arr, SparseArray out):
         self._prob.update(pars)
-        cdef np.ndarray[double, ndim=4] posc = self._prob.array
+        cdef np.ndarray[double, ndim=4] posc = np.ascontiguousarray(self._prob.array)
+        cdef double* pptr = <double*> posc.data
+        cdef Py_ssize_t enustride = posc.shape[1] * posc.shape[2] * posc.shape[3]
+        cdef Py_ssize_t detstride = posc.shape[2] * posc.shape[3]
+        cdef Py_ssize_t flavstride = posc.shape[3]
         cdef uint64_t ienu = self._enu_dimension
         cdef uint64_t idet = self._det_dimension
         cdef uint64_t iflav = self._flav_dimension
-        cdef vector[uint64_t] otherflav = self._otherflav
-        cdef SparseArray result = SparseArray(self._shape)
+        cdef uint64_t otherflav[4]
+        cdef Py_ssize_t ii
+        for ii in xrange(4):
+            otherflav[ii] = self._otherflav[ii]
+        #bin numbers are decoded from the keys with integer arithmetic
+        cdef uint64_t enuscale = arr._dimscale[ienu]
+        cdef uint64_t enusize = arr._shape[ienu]
+        cdef uint64_t flavscale = arr._dimscale[iflav]
+        cdef uint64_t flavsize = arr._shape[iflav]
+        cdef uint64_t detscale = 0
+        cdef uint64_t detsize = 1
+        if idet != NO_DET_DIM:
+            detscale = arr._dimscale[idet]
+            detsize = arr._shape[idet]
         cdef Py_ssize_t enu, det, flav_i, flav_j;
         cdef double pdis, papp;
-        cdef SparseArrayIterator it = arr._data.begin()
-        cdef SparseArrayIterator end = arr._data.end()
-        cdef uint64_t key
-        cdef double value, othervalue
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = arr.decodekey(key)
-            value = dereference(it).second
-        #for index, value in arr:
-            #determine oscillation probability
-            enu = index[ienu]
-            if idet == NO_DET_DIM:
-                det = 0
-            else:
-                det = index[idet]
-            flav_j = index[iflav]
-            flav_i = otherflav[flav_j]
-            #pdis = posc[enu][det][flav_j][flav_j]
-            pdis = posc[enu, det, flav_j, flav_j]
-            papp = posc[enu, det, flav_i, flav_j]
-            #get N_otherflav
-            index[iflav] = flav_i 
-            othervalue = arr.get(index)
-            index[iflav] = flav_j # reset index
-            nosc = (pdis * value) + (papp * othervalue)
-            result.set(index, nosc)
-            #increment iterator
-            preincrement(it)
-        return result
+        cdef uint64_t key, otherkey
+        #the result has the same sparsity pattern as the input
+        arr.freeze()
+        arr._pattern_into(out)
+        cdef double* result = out._vptr
+        cdef uint64_t* kptr = arr._kptr
+        cdef double* vptr = arr._vptr
+        cdef Py_ssize_t n = arr._nfrozen
+        with nogil:
+            for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                key = kptr[ii]
+                #determine oscillation probability
+                enu = (key / enuscale) % enusize
+                if detscale == 0:
+                    det = 0
+                else:
+                    det = (key / detscale) % detsize
+                flav_j = (key / flavscale) % flavsize
+                flav_i = otherflav[flav_j]
+                pdis = pptr[enu * enustride + det * detstride + flav_j * flavstride + flav_j]
+                papp = pptr[enu * enustride + det * detstride + flav_i * flavstride + flav_j]
+                #get N_otherflav
+                otherkey = key - flav_j * flavscale + flav_i * flavscale
+                result[ii] = (pdis * vptr[ii]) + (papp * frozen_value(kptr, vptr, n, otherkey))
+        return out
 
     def observable(self, pars):
         return self.eval(pars).project(self._obs)
 
+    def observable_array(self, pars, out=None):
+        """As observable but returns the flattened rate vector as a numpy array."""
+        if self._engine == "dense":
+            return self._obsplan(self._eval_dense(pars), out=out)
+        return self._obsplan(self.eval(pars, self._workspace.result), out=out)
+
+    def observable_batch(self, pars_matrix, out=None):
+        """observable_array for each row of pars_matrix, returned as an (n, nobs) array.
+        Rows are evaluated grouped by their oscillation parameters so that the
+        probabilities are calculated once for each distinct set. Otherwise
+        each row is evaluated in turn as in BinnedModel.observable_batch.
+        """
+        pars_matrix = _batch_rows(pars_matrix)
+        order = np.lexsort(pars_matrix[:, self._prob.parameter_indices()].T[::-1])
+        return _observable_batch(self, pars_matrix, order, self._obsplan.size(), out)
+
+    def jacobian(self, pars):
+        """As BinnedModel.jacobian. The derivatives of the oscillation
+        probabilities (ProbabilityCache.derivatives) and of the flux weights
+        are propagated through the flavour rotation with the chain rule.
+        """
+        pars = np.array(pars, dtype=float)
+        cdef DenseModelEngine engine = self._dense
+        cdef SparseArray rotated
+        self._eval_dense(pars)
+        cdef Py_ssize_t n = self.N_nosel._nfrozen
+        nominal = self.N_nosel._values
+        #flux of each row and of its partner flavour before the rotation
+        flux = nominal
+        if self._flux_weights is not None:
+            flux = nominal * engine.values(self._factors[0], 0)
+        partner = self._partner
+        haspartner = np.flatnonzero(partner >= 0)
+        partnerflux = np.zeros(n, dtype=float)
+        partnerflux[haspartner] = flux[partner[haspartner]]
+        self._prob.update(pars)
+        posc = np.ascontiguousarray(self._prob.array).ravel()
+        pdis = posc[self._pdis]
+        papp = posc[self._papp]
+        rotated = self._partials[_STAGE_OSCILLATION]
+        #weights after the rotation
+        after = [None] * len(self._weights)
+        for ii in xrange(_STAGE_OSCILLATION + 1, len(self._weights)):
+            if self._weights[ii] is not None:
+                after[ii] = engine.values(self._factors[ii], ii)
+        post = _product_except(after, -1, np.ones(n, dtype=float))
+        result = scipy.sparse.csr_matrix((n, len(pars)))
+        for ii in xrange(_STAGE_OSCILLATION + 1, len(self._weights)):
+            if self._weights[ii] is not None:
+                others = _product_except(after, ii, rotated._values)
+                result = result + scipy.sparse.diags(others).dot(_row_jacobian(engine, self._weights[ii], self._factors[ii], ii, pars))
+        #oscillation parameters
+        derivatives = self._prob.derivatives(pars).reshape((len(self._prob.parameter_indices()), -1))
+        columns = post * (derivatives[:, self._pdis] * flux + derivatives[:, self._papp] * partnerflux)
+        rows = np.tile(np.arange(n), len(columns))
+        result = result + scipy.sparse.csr_matrix((columns.ravel(), (rows, np.repeat(self._prob.parameter_indices(), n))), shape=(n, len(pars)))
+        #flux weights
+        if self._flux_weights is not None:
+            dflux = scipy.sparse.diags(nominal).dot(_row_jacobian(engine, self._flux_weights, self._factors[0], 0, pars))
+            swap = scipy.sparse.csr_matrix((np.ones(len(haspartner)), (haspartner, partner[haspartner])), shape=(n, n))
+            drotated = scipy.sparse.diags(pdis).dot(dflux) + scipy.sparse.diags(papp).dot(swap.dot(dflux))
+            result = result + scipy.sparse.diags(post).dot(drotated)
+        return _projection_matrix(self._obsplan, self.N_nosel).dot(result).toarray()
+
     def parameter_names(self):
         return self._parnames
 
+    @property
+    def probability_cache(self):
+        return self._prob
+
     def __str__(self):
         sio = StringIO.StringIO()
         print >>sio, "BinnedModelWithOscillationModel(%s pars, %.2e bins, %.2e max bins)" % (len(self._parnames), len(self.N_nosel), self.N_nosel.max_size())
@@ -201,6 +711,8 @@ cdef class BinnedModelWithOscillation:
 
 ################################################################################
 
+################################################################################
+
 class ObservableRateVector:
     """Wrapper for model that only returns the observable rate vector."""
     def __init__(self, model):
@@ -282,8 +794,30 @@ cdef class ProbabilityCache:
     cdef double _previous_sdm;
     cdef double _previous_ldm;
     cdef np.ndarray _flav_map;
+    cdef object _lru;
+    cdef public int cachesize;
+    cdef readonly long hits;
+    cdef readonly long misses;
+    cdef object _tables;
+    cdef np.ndarray _tablebins;
+    cdef np.ndarray _baselines;
+    cdef object _grid;
 
-    def __init__(self, parnames, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA):
+    def __init__(self, parnames, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, cachesize=8, grid=None):
+        """The probability tables of the last cachesize sets of oscillation
+        parameters are kept. Returning to one of them (e.g. after a rejected
+        MCMC step) does not call the probability calculator. The hits and
+        misses attributes count the lookups.
+
+        If a ProbabilityGrid is given, tables for parameters inside of the
+        grid are interpolated instead of calculated.
+        """
+        if cachesize < 1:
+            raise ValueError("ProbabilityCache size must be at least 1", cachesize)
+        self.cachesize = cachesize
+        self._lru = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
         self._flav_map = np.array([#appearance
                                                               (0, 0, 2, 2, 1),
                                                               (1, 1, 1, 1, 1),
@@ -318,30 +852,86 @@ cdef class ProbabilityCache:
                 self.array[enubin, detbin, flav_i, flav_j] = 1.0
             else:
                 self.array[enubin, detbin, flav_i, flav_j] = 0.0
+        #calculators with fillProbabilityTable fill all energies and baselines
+        #in one call per neutrino/antineutrino
+        self._tables = None
+        self._tablebins = np.flatnonzero(self._detdist != 0)
+        self._baselines = self._detdist[self._tablebins].astype(float)
+        if hasattr(probabilitycalc, "fillProbabilityTable"):
+            self._tables = dict((cp, np.zeros(shape=(enudim, len(self._tablebins), 3, 3), dtype=float)) for cp in (1, -1))
+        self._grid = None
+        if grid is not None:
+            self._check_grid(grid, parnames, oscparmode)
+            self._grid = grid
+
+    def _check_grid(self, grid, parnames, oscparmode):
+        enuarray = (grid.enubinning[1:] + grid.enubinning[:-1])/2.0
+        if list(grid.parnames) != list(parnames) \
+           or grid.oscparmode != oscparmode \
+           or not np.array_equal(enuarray, self._enuarray) \
+           or not np.array_equal(np.array(grid.detdist, dtype=np.intc), self._detdist):
+            raise ValueError("ProbabilityGrid was built for different parameters or binning")
+        return
+
+    def oscillating_entries(self):
+        """Copy of the table entries that are calculated (i.e. for detector
+        bins with non-zero baseline), with shape (enu bins, detector bins, 8).
+        """
+        flavmap = self._flav_map
+        return self.array[:, self._tablebins][:, :, flavmap[:, 0], flavmap[:, 1]]
+
+    def set_oscillating_entries(self, values):
+        """Inverse of oscillating_entries."""
+        flavmap = self._flav_map
+        cdef np.ndarray array = self.array
+        for row in xrange(flavmap.shape[0]):
+            array[:, self._tablebins, flavmap[row, 0], flavmap[row, 1]] = values[:, :, row]
+        return
+
+    def parameter_indices(self):
+        """Positions of the oscillation parameters in the parameter vector."""
+        return [self._theta12, self._theta23, self._theta13, self._deltacp, self._sdm, self._ldm]
+
+    def derivatives(self, pars, step=_JACOBIAN_STEP):
+        """Numerical derivatives of array with respect to the oscillation
+        parameters (in the order of parameter_indices), an array of shape
+        (6,) + array.shape. Central differences with a step relative to each
+        parameter are used, one sided at the limits of the sin^2 parameters.
+        The cache is left at pars and the shifted tables are not cached.
+        """
+        pars = np.array(pars, dtype=float)
+        result = np.zeros((6,) + np.shape(self.array), dtype=float)
+        if not self._prob:
+            return result
+        self._update(pars)
+        angles = []
+        if self._oscparmode != _CODE_THETA:
+            angles = [self._theta12, self._theta23, self._theta13]
+        cdef np.ndarray current = self.array
+        up = np.copy(current)
+        down = np.copy(current)
+        try:
+            for ii, index in enumerate(self.parameter_indices()):
+                x = pars[index]
+                h = step * max(abs(x), 1.0e-3)
+                upper, lower = x + h, x - h
+                if index in angles:
+                    if upper > 1.0:
+                        upper = x
+                    if lower < 0.0:
+                        lower = x
+                for value, table in [(upper, up), (lower, down)]:
+                    pars[index] = value
+                    self.array = table
+                    self._calculate(pars, self._physical_parameters(pars))
+                result[ii] = (up - down) / (upper - lower)
+                pars[index] = x
+        finally:
+            self.array = current
+        return result
 
     def _parse_parameter_names(self, parnames):
-        theta12 = None
-        theta23 = None
-        theta13 = None
-        deltacp = None
-        sdm = None
-        ldm = None
-        for index, p in enumerate(parnames):
-            if p == "theta12" or p == "sinsq2theta12" or p == "sinsqtheta12":
-                theta12 = index
-            elif p == "theta23" or p == "sinsq2theta23" or p == "sinsqtheta23":
-                theta23 = index
-            elif p == "theta13" or p == "sinsq2theta13" or p == "sinsqtheta13":
-                theta13 = index
-            elif p == "deltacp":
-                deltacp = index
-            elif p == "sdm":
-                sdm = index
-            elif p == "ldm":
-                ldm = index
-        if any(p is None for p in [theta12, theta23, theta13, deltacp, sdm, ldm]):
-            raise Exception("ProbabilityCache cannot find all oscillation parameters", parnames)
-        self._theta12, self._theta23, self._theta13, self._deltacp, self._sdm, self._ldm = theta12, theta23, theta13, deltacp, sdm, ldm
+        self._theta12, self._theta23, self._theta13, self._deltacp, self._sdm, self._ldm = _oscillation_parameter_indices(parnames)
         return
 
     cdef _haschanged(self, np.ndarray[double, ndim=1] pars):
@@ -369,30 +959,68 @@ cdef class ProbabilityCache:
         return self._update(pars)
 
     cdef _update(self, np.ndarray[double, ndim=1] pars):
-        cdef double theta12, theta23, theta13, deltacp, sdm, ldm
-        cdef int oscparmode
         if self._prob and self._haschanged(pars):
             #print "DEBUG setting", pars[self._theta12], pars[self._theta23], pars[self._theta13], pars[self._deltacp], pars[self._sdm], pars[self._ldm]
-            theta12 = pars[self._theta12]
-            theta23 = pars[self._theta23]
-            theta13 = pars[self._theta13]
-            deltacp = pars[self._deltacp]
-            sdm = pars[self._sdm]
-            ldm = pars[self._ldm]
-            oscparmode = self._oscparmode
-            if oscparmode == _CODE_SINSQTHETA:
-                theta12 = invsinsqtheta(theta12)
-                theta23 = invsinsqtheta(theta23)
-                theta13 = invsinsqtheta(theta13)
-            elif oscparmode == _CODE_SINSQ2THETA:
-                theta12 = invsinsq2theta(theta12)
-                theta23 = invsinsq2theta(theta23)
-                theta13 = invsinsq2theta(theta13)
-            self._prob.setAll(theta12, theta23, theta13, deltacp, sdm, ldm)
+            key = self._physical_parameters(pars)
+            lru = self._lru
+            cached = lru.pop(key, None)
+            if cached is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                #reuse the least recently used table, the entries that are not
+                #calculated are copied from the current table
+                while lru and len(lru) >= self.cachesize:
+                    cached = lru.popitem(last=False)[1]
+                if cached is None:
+                    cached = np.copy(self.array)
+                else:
+                    np.copyto(cached, self.array)
+                self.array = cached
+                self._calculate(pars, key)
+            lru[key] = cached
+            self.array = cached
+
+    cdef tuple _physical_parameters(self, np.ndarray[double, ndim=1] pars):
+        # the angles in radians, deltacp, sdm and ldm
+        cdef double theta12 = pars[self._theta12]
+        cdef double theta23 = pars[self._theta23]
+        cdef double theta13 = pars[self._theta13]
+        cdef int oscparmode = self._oscparmode
+        if oscparmode == _CODE_SINSQTHETA:
+            theta12 = invsinsqtheta(theta12)
+            theta23 = invsinsqtheta(theta23)
+            theta13 = invsinsqtheta(theta13)
+        elif oscparmode == _CODE_SINSQ2THETA:
+            theta12 = invsinsq2theta(theta12)
+            theta23 = invsinsq2theta(theta23)
+            theta13 = invsinsq2theta(theta13)
+        return (theta12, theta23, theta13, pars[self._deltacp], pars[self._sdm], pars[self._ldm])
+
+    cdef _calculate(self, np.ndarray[double, ndim=1] pars, tuple physical):
+        # fill the calculated entries of array for pars (from the grid if it
+        # covers them), without using or changing the LRU
+        values = None
+        if self._grid is not None:
+            values = self._grid.interpolate(pars)
+        if values is not None:
+            self.set_oscillating_entries(values)
+        else:
+            self._prob.setAll(*physical)
             self._prob.update()
             self._fillcache()
+        return
+
+    def clear(self):
+        """Empty the cache and reset the counters."""
+        self._lru.clear()
+        self.hits = 0
+        self.misses = 0
+        return
 
     cdef _fillcache(self):
+        if self._tables is not None:
+            return self._filltables()
         #get inputs
         prob = self._prob
         cdef np.ndarray[double, ndim=1] enuarray = self._enuarray;
@@ -436,6 +1064,73 @@ cdef class ProbabilityCache:
                     array[enubin,detbin,flav_i,flav_j] = p
         return
 
+    cdef _filltables(self):
+        cdef np.ndarray enuarray = self._enuarray
+        cdef np.ndarray baselines = self._baselines
+        cdef np.ndarray tablebins = self._tablebins
+        cdef np.ndarray array = self.array
+        if len(tablebins) == 0:
+            return
+        for cp, table in self._tables.iteritems():
+            self._prob.fillProbabilityTable(enuarray, len(enuarray), baselines, len(baselines), cp, table)
+        for flav_i, flav_j, flav_init, flav_final, cp in self._flav_map:
+            array[:, tablebins, flav_i, flav_j] = self._tables[cp][:, :, flav_init - 1, flav_final - 1]
+        return
+
+def _oscillation_parameter_indices(parnames):
+    theta12 = None
+    theta23 = None
+    theta13 = None
+    deltacp = None
+    sdm = None
+    ldm = None
+    for index, p in enumerate(parnames):
+        if p == "theta12" or p == "sinsq2theta12" or p == "sinsqtheta12":
+            theta12 = index
+        elif p == "theta23" or p == "sinsq2theta23" or p == "sinsqtheta23":
+            theta23 = index
+        elif p == "theta13" or p == "sinsq2theta13" or p == "sinsqtheta13":
+            theta13 = index
+        elif p == "deltacp":
+            deltacp = index
+        elif p == "sdm":
+            sdm = index
+        elif p == "ldm":
+            ldm = index
+    if any(p is None for p in [theta12, theta23, theta13, deltacp, sdm, ldm]):
+        raise Exception("ProbabilityCache cannot find all oscillation parameters", parnames)
+    return theta12, theta23, theta13, deltacp, sdm, ldm
+
+################################################################################
+
+#process-wide ProbabilityCache instances, see shared_probability_cache
+_shared_caches = {}
+
+def shared_probability_cache(parnames, enubinning, detdist, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, cachesize=8, grid=None):
+    """A ProbabilityCache shared by all callers with the same energy binning,
+    baselines, oscillation parameter positions, oscparmode, probability
+    calculator and grid. Samples at the same baseline then calculate each
+    table once, the first to update the cache fills it and the others reuse
+    it. The cachesize of the first caller is used.
+    """
+    enubinning = np.array(enubinning, dtype=float)
+    key = (tuple(enubinning), tuple(detdist), _oscillation_parameter_indices(parnames), OscParMode.toint(oscparmode), id(probabilitycalc), id(grid))
+    try:
+        return _shared_caches[key][0]
+    except KeyError:
+        pass
+    result = ProbabilityCache(parnames, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode, cachesize=cachesize, grid=grid)
+    #keep the calculator and grid alive so that their ids are not reused
+    _shared_caches[key] = (result, probabilitycalc, grid)
+    return result
+
+def clear_shared_probability_caches():
+    """Forget the shared caches, later models get new ones."""
+    _shared_caches.clear()
+    return
+
+################################################################################
+
 cdef double invsinsqtheta(double x):
     if x < 0.0:
         x = abs(x)
@@ -485,6 +1180,7 @@ cdef class OscFluxWeights:
                 shape[i] = 0
         self._sparse_weights = SparseArray(shape)
         self._init_sparse_weights(self._sparse_weights)
+        self._sparse_weights.freeze()
 
     def _init_nominal(self, N_nosel, nominal, enudim, flavdim, detdim):
         if detdim == NO_DET_DIM:
@@ -546,15 +1242,15 @@ cdef class OscFluxWeights:
     cdef _update_sparse_array(self):
         cdef np.ndarray[double, ndim=3] weights = self._weights
         cdef SparseArray arr = self._sparse_weights
-        cdef SparseArrayIterator it = arr._data.begin()
-        cdef SparseArrayIterator end = arr._data.end()
         cdef double value;
         cdef uint64_t enudim = self._enudim
         cdef uint64_t flavdim = self._flavdim
         cdef uint64_t detdim = self._detdim
         cdef uint64_t key, ienu, iflav, idet;
-        while it != end:
-            key = dereference(it).first
+        cdef vector[uint64_t] index
+        cdef Py_ssize_t ii
+        for ii in xrange(arr._nfrozen):
+            key = arr._kptr[ii]
             index = arr.decodekey(key)
             ienu = index[enudim]
             iflav = index[flavdim]
@@ -563,8 +1259,7 @@ cdef class OscFluxWeights:
             else:
                 idet = index[detdim]
             value = weights[ienu, iflav, idet]
-            dereference(it).second = value
-            preincrement(it)
+            arr._vptr[ii] = value
         return
 
 ################################################################################
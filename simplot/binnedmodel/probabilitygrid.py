@@ -0,0 +1,195 @@
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from simplot.cache import cache
+from simplot.binnedmodel.model import OscParMode, ProbabilityCache
+
+################################################################################
+
+_DEFAULT_CACHE_DIR = "/tmp/cache-probability-grid/"
+
+class ProbabilityGrid(object):
+    """Oscillation probability tables precomputed on a grid of oscillation
+    parameters and interpolated between the grid points.
+
+    axes is a list of (parameter name, grid values) for the parameters on the
+    grid (e.g. [("ldm", ...), ("deltacp", ...), ("sinsqtheta23", ...),
+    ("sinsqtheta13", ...)]). The other oscillation parameters are fixed at the
+    values in the dictionary fixed. interpolate returns None for parameters
+    outside of the grid, or where a fixed parameter differs, so that
+    ProbabilityCache falls back to the probability calculator.
+
+    order is 1 for multilinear and 3 for cubic (4 point Lagrange)
+    interpolation. After building, error_bound is the largest absolute
+    difference between the interpolated and calculated probabilities at
+    nvalidation random points inside the grid.
+
+    The grid is built with nprocesses processes (default: 1, None for all
+    cores) and if cache_name is given it is stored in cache_dir and reused
+    by later jobs with the same configuration.
+    """
+    def __init__(self, parnames, enubinning, detdist, axes, fixed, probabilitycalc, oscparmode=OscParMode.SINSQTHETA, order=1, nvalidation=100, seed=None, nprocesses=1, cache_name=None, cache_dir=None):
+        if order not in (1, 3):
+            raise ValueError("ProbabilityGrid interpolation order must be 1 or 3", order)
+        self.parnames = list(parnames)
+        self.enubinning = np.array(enubinning, dtype=float)
+        self.detdist = list(detdist)
+        self.oscparmode = oscparmode
+        self.order = order
+        self.axisnames = [name for name, _ in axes]
+        self.axes = [np.array(values, dtype=float) for _, values in axes]
+        self.fixed = dict(fixed)
+        self._check_axes()
+        oscpars = ProbabilityCache(self.parnames, self.enubinning, self.detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode).parameter_indices()
+        self._axisindices = np.array([self.parnames.index(name) for name in self.axisnames], dtype=int)
+        self._fixedindices = np.array([i for i in oscpars if self.parnames[i] not in self.axisnames], dtype=int)
+        missing = [self.parnames[i] for i in self._fixedindices if self.parnames[i] not in self.fixed]
+        if missing:
+            raise ValueError("ProbabilityGrid needs a value for every oscillation parameter not on the grid", missing)
+        self._fixedvalues = np.array([self.fixed[self.parnames[i]] for i in self._fixedindices], dtype=float)
+        self._lower = np.array([a[0] for a in self.axes])
+        self._upper = np.array([a[-1] for a in self.axes])
+        builder = _GridBuilder(self, probabilitycalc)
+        func = lambda: builder.build(nvalidation, seed, nprocesses)
+        if cache_name is not None:
+            if cache_dir is None:
+                cache_dir = _DEFAULT_CACHE_DIR
+            data = cache(cache_name + "_" + self._configuration(nvalidation, seed), func, tmpdir=cache_dir)
+        else:
+            data = func()
+        self.values, self.error_bound = data
+
+    @property
+    def _strides(self):
+        return [int(np.prod(self.shape[i + 1:])) for i in xrange(len(self.axes))]
+
+    @property
+    def _nentries(self):
+        return int(np.prod(self.values.shape[len(self.axes):]))
+
+    def _check_axes(self):
+        for name, values in itertools.izip(self.axisnames, self.axes):
+            if name not in self.parnames:
+                raise ValueError("ProbabilityGrid axis is not a parameter", name, self.parnames)
+            if values.ndim != 1 or len(values) < self.order + 1 or np.any(np.diff(values) <= 0.0):
+                raise ValueError("ProbabilityGrid axis must be increasing with at least order+1 values", name, values)
+        if len(set(self.axisnames)) != len(self.axisnames):
+            raise ValueError("ProbabilityGrid has duplicate axes", self.axisnames)
+        return
+
+    def _configuration(self, nvalidation, seed):
+        return repr((self.parnames, self.enubinning.tolist(), self.detdist, self.oscparmode, self.order,
+                     self.axisnames, [a.tolist() for a in self.axes], sorted(self.fixed.items()), nvalidation, seed))
+
+    @property
+    def shape(self):
+        return tuple(len(a) for a in self.axes)
+
+    def parameters(self, index):
+        """The full oscillation parameter vector at grid point index."""
+        pars = np.zeros(len(self.parnames))
+        pars[self._fixedindices] = self._fixedvalues
+        pars[self._axisindices] = [a[i] for a, i in itertools.izip(self.axes, index)]
+        return pars
+
+    def covers(self, pars):
+        """True if the parameters are inside of the grid and the other
+        oscillation parameters have their fixed values.
+        """
+        x = pars[self._axisindices]
+        return bool(np.all(x >= self._lower) and np.all(x <= self._upper) and np.array_equal(pars[self._fixedindices], self._fixedvalues))
+
+    def interpolate(self, pars):
+        """Interpolated probabilities in the layout of
+        ProbabilityCache.oscillating_entries, None if not covered.
+        """
+        pars = np.asarray(pars, dtype=float)
+        if not self.covers(pars):
+            return None
+        #the grid points around pars and their weights, combined over the axes
+        index = np.zeros(1, dtype=int)
+        weight = np.ones(1)
+        for a, x, stride in itertools.izip(self.axes, pars[self._axisindices], self._strides):
+            i, w = _axis_weights(a, x, self.order)
+            index = np.add.outer(index, i * stride).ravel()
+            weight = np.multiply.outer(weight, w).ravel()
+        flat = self.values.reshape((-1, self._nentries))
+        return np.dot(weight, flat.take(index, axis=0)).reshape(self.values.shape[len(self.axes):])
+
+################################################################################
+
+def _axis_weights(nodes, x, order):
+    i = int(np.searchsorted(nodes, x, side="right")) - 1
+    i = min(max(i, 0), len(nodes) - 2)
+    if order == 1:
+        t = (x - nodes[i]) / (nodes[i + 1] - nodes[i])
+        return np.array([i, i + 1]), np.array([1.0 - t, t])
+    start = min(max(i - 1, 0), len(nodes) - 4)
+    index = np.arange(start, start + 4)
+    xs = nodes[index]
+    weights = np.ones(4)
+    for k in xrange(4):
+        for m in xrange(4):
+            if m != k:
+                weights[k] *= (x - xs[m]) / (xs[k] - xs[m])
+    return index, weights
+
+################################################################################
+
+#the builder of the grid being filled, inherited by the worker processes
+_builder = None
+
+def _fill_grid_chunk(flatindices):
+    return _builder.fill(flatindices)
+
+class _GridBuilder(object):
+    def __init__(self, grid, probabilitycalc):
+        self._grid = grid
+        self._cache = ProbabilityCache(grid.parnames, grid.enubinning, grid.detdist, probabilitycalc=probabilitycalc, oscparmode=grid.oscparmode, cachesize=1)
+
+    def calculate(self, pars):
+        self._cache.update(pars)
+        return self._cache.oscillating_entries()
+
+    def fill(self, flatindices):
+        shape = self._grid.shape
+        return [self.calculate(self._grid.parameters(np.unravel_index(i, shape))) for i in flatindices]
+
+    def build(self, nvalidation, seed, nprocesses):
+        global _builder
+        grid = self._grid
+        npoints = int(np.prod(grid.shape))
+        if nprocesses is None:
+            nprocesses = multiprocessing.cpu_count()
+        if nprocesses < 1:
+            raise ValueError("number of processes must be greater than 0", nprocesses)
+        chunks = np.array_split(np.arange(npoints), min(npoints, 4 * nprocesses))
+        if nprocesses == 1:
+            results = [self.fill(chunk) for chunk in chunks]
+        else:
+            _builder = self
+            pool = multiprocessing.Pool(nprocesses)
+            try:
+                results = pool.map(_fill_grid_chunk, chunks)
+                pool.close()
+            finally:
+                pool.terminate()
+                _builder = None
+        entries = [e for r in results for e in r]
+        values = np.array(entries).reshape(grid.shape + entries[0].shape)
+        grid.values = values
+        return values, self._error_bound(nvalidation, seed)
+
+    def _error_bound(self, nvalidation, seed):
+        grid = self._grid
+        rng = np.random.RandomState(seed)
+        result = 0.0
+        for _ in xrange(nvalidation):
+            pars = grid.parameters([0] * len(grid.axes))
+            pars[grid._axisindices] = rng.uniform(grid._lower, grid._upper)
+            result = max(result, np.max(np.abs(grid.interpolate(pars) - self.calculate(pars))))
+        return result
+
+################################################################################
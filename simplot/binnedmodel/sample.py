@@ -1,16 +1,217 @@
+import functools
 import itertools
+import multiprocessing
 
 from simplot.pdg import PdgNeutrinoOscillationParameters
-from simplot.cache import cache
+from simplot.cache import cache, cache_key, file_identity
 from simplot.mc.montecarlo import MonteCarloParameterMismatch
 import simplot.sparsehist.sparsehist
-from simplot.sparsehist import SparseHistogram
+from simplot.sparsehist import SparseHistogram, share_patterns
 from simplot.binnedmodel.model import BinnedModel as _BinnedModel
-from simplot.binnedmodel.model import OscParMode
+from simplot.binnedmodel.model import OscParMode, _JACOBIAN_STEP
 from simplot.binnedmodel.model import BinnedModelWithOscillation as _BinnedModelWithOscillation
 
 import numpy as np
 
+_FILL_CHUNK_SIZE = 100000
+
+################################################################################
+
+def _iterchunks(data, chunksize=_FILL_CHUNK_SIZE):
+    """Group an iterable of events into lists of at most chunksize events."""
+    iterable = iter(data)
+    while True:
+        chunk = list(itertools.islice(iterable, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def _systweightarrays(systweight, systhist):
+    """Convert per-event spline weights into one (nevents, nvalues) array per systematic."""
+    return [np.array([w[isyst] for w in systweight], dtype=float).reshape((len(systweight), len(systhist[isyst])))
+            for isyst in xrange(len(systhist))]
+
+def _fill_histograms(create, fill, data, nprocesses=1):
+    """Fill a set of histograms from an iterable of events.
+
+    create() returns a new (possibly nested) tuple/list of empty histograms
+    and fill(hists, chunk) fills them with a list of events. With more than
+    one process the event chunks are shared between a pool of worker
+    processes, each chunk is filled into its own set of histograms and the
+    results are merged as they arrive. nprocesses=None uses all cores. The filled histograms are frozen
+    with their key arrays shared (see share_patterns).
+    """
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+    if nprocesses < 1:
+        raise ValueError("number of processes must be greater than 0", nprocesses)
+    hists = create()
+    if nprocesses == 1:
+        for chunk in _iterchunks(data):
+            fill(hists, chunk)
+    else:
+        pool = multiprocessing.Pool(nprocesses)
+        try:
+            for result in pool.imap_unordered(functools.partial(_fill_new_histograms, create, fill), _iterchunks(data)):
+                _merge_histograms(hists, result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    share_patterns([h.array() for h in _iterhistograms(hists)])
+    return hists
+
+def _fill_new_histograms(create, fill, chunk):
+    hists = create()
+    fill(hists, chunk)
+    return hists
+
+def _iterhistograms(hists):
+    for h in hists:
+        if isinstance(h, SparseHistogram):
+            yield h
+        else:
+            for x in _iterhistograms(h):
+                yield x
+
+def _merge_histograms(total, other):
+    """Add each histogram in other to the matching histogram in total."""
+    for t, o in itertools.izip(total, other):
+        if isinstance(t, SparseHistogram):
+            t += o
+        else:
+            _merge_histograms(t, o)
+    return
+
+def _create_sample_histograms(binedges, nvalues):
+    hist = SparseHistogram(binedges)
+    systhist = [[SparseHistogram(binedges) for _ in xrange(n)] for n in nvalues]
+    return hist, systhist
+
+def _fill_sample_histograms(hists, chunk):
+    hist, systhist = hists
+    coord, selweight, systweight = zip(*chunk)
+    coord = np.array(coord, dtype=float)
+    selweight = np.array(selweight, dtype=float)
+    hist.fill_many(coord, selweight)
+    for isyst, w in enumerate(_systweightarrays(systweight, systhist)):
+        for ival in xrange(len(systhist[isyst])):
+            systhist[isyst][ival].fill_many(coord, selweight * w[:, ival])
+    return
+
+def _create_oscillation_histograms(binedges, nvalues):
+    selhist = SparseHistogram(binedges)
+    noselhist = SparseHistogram(binedges)
+    selsysthist = [[SparseHistogram(binedges) for _ in xrange(n)] for n in nvalues]
+    noselsysthist = [[SparseHistogram(binedges) for _ in xrange(n)] for n in nvalues]
+    return selhist, noselhist, selsysthist, noselsysthist
+
+def _fill_oscillation_histograms(hists, chunk):
+    selhist, noselhist, selsysthist, noselsysthist = hists
+    coord, selweight, noselweight, systweight = zip(*chunk)
+    coord = np.array(coord, dtype=float)
+    selweight = np.array(selweight, dtype=float)
+    noselweight = np.array(noselweight, dtype=float)
+    #only fill selected histograms with selected events
+    issel = selweight != 0
+    selhist.fill_many(coord[issel], selweight[issel])
+    noselhist.fill_many(coord, noselweight)
+    for isyst, w in enumerate(_systweightarrays(systweight, selsysthist)):
+        for ival in xrange(len(selsysthist[isyst])):
+            selsysthist[isyst][ival].fill_many(coord[issel], selweight[issel] * w[issel, ival])
+            noselsysthist[isyst][ival].fill_many(coord, noselweight * w[:, ival])
+    return
+
+def _fill_columns(hists, coords, weights):
+    """Fill each histogram in hists (which share a binning) with the events
+    coords and the matching weight vector. The bins are found once and the
+    weights are summed in each bin before filling.
+    """
+    if len(coords) == 0:
+        return
+    keys, inverse = np.unique(hists[0].bin_keys(coords), return_inverse=True)
+    for h, w in itertools.izip(hists, weights):
+        h.fill_keys(keys, np.bincount(inverse, weights=w, minlength=len(keys)))
+    return
+
+def _fill_sample_columns(hists, columns):
+    hist, systhist = hists
+    #events that are not selected do not contribute
+    issel = columns.selweight != 0
+    selweight = columns.selweight[issel]
+    systweight = columns.systweight[issel]
+    weights = [selweight] + [selweight * systweight[:, isyst, ival] for isyst, h in enumerate(systhist) for ival in xrange(len(h))]
+    _fill_columns([hist] + [h for l in systhist for h in l], columns.coords[issel], weights)
+    return
+
+def _fill_oscillation_columns(hists, columns):
+    selhist, noselhist, selsysthist, noselsysthist = hists
+    issel = columns.selweight != 0
+    selweight = columns.selweight[issel]
+    systweight = columns.systweight[issel]
+    weights = [selweight] + [selweight * systweight[:, isyst, ival] for isyst, h in enumerate(selsysthist) for ival in xrange(len(h))]
+    _fill_columns([selhist] + [h for l in selsysthist for h in l], columns.coords[issel], weights)
+    noselweight = columns.noselweight
+    weights = [noselweight] + [noselweight * columns.systweight[:, isyst, ival] for isyst, h in enumerate(noselsysthist) for ival in xrange(len(h))]
+    _fill_columns([noselhist] + [h for l in noselsysthist for h in l], columns.coords, weights)
+    return
+
+def _fill_histograms_from_columns(create, fill, columns):
+    """As _fill_histograms for EventColumns, filled in a single process."""
+    hists = create()
+    fill(hists, columns)
+    share_patterns([h.array() for h in _iterhistograms(hists)])
+    return hists
+
+def _spline_value_counts(systematics):
+    if not systematics:
+        return []
+    return [len(values) for syst, values in systematics.spline_parameter_values]
+
+################################################################################
+
+class EventColumns(object):
+    """Events stored as numpy arrays, an alternative to the iterable of
+    event tuples used as the data of BinnedSample and
+    BinnedSampleWithOscillation. The histograms are then filled with a few
+    vectorized operations per histogram instead of per chunk of events.
+
+    coords is an (nevents, ndim) array, selweight and noselweight are
+    (nevents,) arrays (noselweight is only needed with oscillation) and
+    systweight is an (nevents, nsyst, nknots) array with the weight of each
+    event at the knots of each spline systematic. nknots is the largest
+    number of knots, systematics with fewer knots ignore the extra values.
+    """
+    def __init__(self, coords, selweight, systweight=None, noselweight=None):
+        self.coords = np.array(coords, dtype=float, copy=False)
+        self.selweight = np.array(selweight, dtype=float, copy=False)
+        nevents = len(self.coords)
+        if systweight is None:
+            systweight = np.zeros((nevents, 0, 0), dtype=float)
+        self.systweight = np.array(systweight, dtype=float, copy=False)
+        self.noselweight = None if noselweight is None else np.array(noselweight, dtype=float, copy=False)
+        if self.coords.ndim != 2:
+            raise ValueError("EventColumns expects an (nevents, ndim) array of coordinates", self.coords.shape)
+        for w in [self.selweight, self.noselweight]:
+            if w is not None and w.shape != (nevents,):
+                raise ValueError("EventColumns expects one weight per event", w.shape, nevents)
+        if self.systweight.ndim != 3 or len(self.systweight) != nevents:
+            raise ValueError("EventColumns expects an (nevents, nsyst, nknots) array of systematic weights", self.systweight.shape, nevents)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def check(self, nvalues, oscillation=False):
+        """Raise ValueError unless there are weights for systematics with
+        nvalues knots (and non-selected weights if oscillation is True).
+        """
+        nsyst, nknots = self.systweight.shape[1:]
+        if nsyst != len(nvalues) or (nvalues and nknots < max(nvalues)):
+            raise ValueError("EventColumns systematic weights do not match the systematics", self.systweight.shape, nvalues)
+        if oscillation and self.noselweight is None:
+            raise ValueError("EventColumns needs noselweight for a sample with oscillation")
+        return
+
 ################################################################################
 
 class Sample(object):
@@ -18,14 +219,51 @@ class Sample(object):
         self.parameter_names = parameter_names
     def __call__(self, x):
         raise NotImplementedError("ERROR: child class should override __call__.")
+    def eval_batch(self, pars_matrix):
+        """Evaluate each row of pars_matrix, returns an (n, nobs) array.
+        Child classes may override this with a faster implementation.
+        """
+        pars_matrix = _check_batch(pars_matrix, self.parameter_names)
+        return np.array([self(x) for x in pars_matrix], dtype=float, ndmin=2).reshape(len(pars_matrix), -1)
+    def jacobian(self, x):
+        """Derivatives of the expected rates with respect to each parameter,
+        an (nobs, npars) array. This uses central differences, child classes
+        may override it with an analytic implementation.
+        """
+        x = np.array(x, dtype=float)
+        columns = []
+        for index in xrange(len(x)):
+            step = _JACOBIAN_STEP * max(abs(x[index]), 1.0)
+            up, down = np.copy(x), np.copy(x)
+            up[index] += step
+            down[index] -= step
+            columns.append((np.asarray(self(up), dtype=float) - np.asarray(self(down), dtype=float)) / (2.0 * step))
+        return np.array(columns, dtype=float).reshape(len(x), -1).T
+
+def _check_batch(pars_matrix, parameter_names):
+    pars_matrix = np.array(pars_matrix, dtype=float, ndmin=2, copy=False)
+    if pars_matrix.ndim != 2 or pars_matrix.shape[1] != len(parameter_names):
+        raise ValueError("Sample called with wrong number of parameters")
+    return pars_matrix
 
 ################################################################################
 
 class BinnedSample(Sample):
-    def __init__(self, name, binning, observables, data, cache_name=None, systematics=None, cache_dir=None):
+    def __init__(self, name, binning, observables, data, cache_name=None, systematics=None, cache_dir=None, nprocesses=1, engine="dense", input_files=None):
+        """The histograms are filled in this process unless nprocesses is greater than 1, in which
+        case a pool of nprocesses worker processes is used (None for all cores on this machine).
+        data may also be an EventColumns, which is filled in this process in a single pass.
+        engine selects how the model is evaluated ("dense", "sparse" or "compare"), see BinnedModel.
+        If cache_name is given the histograms are cached with a key made from cache_name and a hash
+        of the binning, observables, spline knots, the contents of an EventColumns and the path,
+        size and modification time of each of input_files (the files that data is read from), so a
+        change to any of these rebuilds the histograms.
+        """
         parameter_names = self._build_parameter_names(systematics)
         super(BinnedSample, self).__init__(parameter_names)
         self.name = name
+        self._nprocesses = nprocesses
+        self._engine = engine
         self.axisnames = [n for n, _ in binning]
         self.binedges = [np.array(edges, copy=True) for _, edges in binning]
         self.observables = observables
@@ -34,11 +272,22 @@ class BinnedSample(Sample):
         if cache_name:
             if cache_dir is None:
                 cache_dir = "/tmp/cache-binned-sample/"
-            data = cache(cache_name, func, tmpdir=cache_dir)
+            key = cache_key(self._cache_configuration(data, systematics, input_files))
+            data = cache(cache_name + "_" + key, func, tmpdir=cache_dir)
         else:
             data = func()
         self._model, self.N_sel, self.N_nosel = self._buildmodel(systematics, data, observables)
 
+    def _cache_configuration(self, data, systematics, input_files):
+        #everything that the cached histograms depend on
+        configuration = [type(self).__name__, self.axisnames, self.binedges, self.observables]
+        if systematics:
+            configuration += [type(systematics).__name__, systematics.parameter_names, systematics.spline_parameter_values]
+        if isinstance(data, EventColumns):
+            configuration += [data.coords, data.selweight, data.noselweight, data.systweight]
+        configuration += [file_identity(f) for f in (input_files or [])]
+        return configuration
+
     def _build_parameter_names(self, systematics):
         parameter_names = []
         if systematics:
@@ -53,38 +302,60 @@ class BinnedSample(Sample):
         det_weights, xsec_weights, flux_weights = None, None, None
         if systematics:
             det_weights, xsec_weights, flux_weights = systematics(self.parameter_names, systhist, hist)
-        return _BinnedModel(self.parameter_names, hist, observabledim, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights), hist, None
+        return _BinnedModel(self.parameter_names, hist, observabledim, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights, engine=self._engine), hist, None
 
     def __call__(self, x):
         if len(x) != len(self.parameter_names):
             raise ValueError("Sample called with wrong number of parameters")
-        return self._model.observable(x).flatten()
+        return self._model.observable_array(x)
+
+    def eval_batch(self, pars_matrix):
+        """Evaluate each row of pars_matrix with the model (see
+        BinnedModel.observable_batch), returns an (n, nobs) array.
+        """
+        return self._model.observable_batch(_check_batch(pars_matrix, self.parameter_names))
+
+    def jacobian(self, x):
+        if len(x) != len(self.parameter_names):
+            raise ValueError("Sample called with wrong number of parameters")
+        return self._model.jacobian(x)
 
     def array(self, x):
         return self._model(x)
 
     def _loaddata(self, data, systematics):
-        hist = SparseHistogram(self.binedges)
-        if systematics:
-            systhist = [[SparseHistogram(self.binedges) for val in values] for syst, values in systematics.spline_parameter_values]
-        else:
-            systhist = []
-        for coord, selweight, systweight in data:
-            hist.fill(coord, selweight)
-            for isyst in xrange(len(systhist)):
-                for ival in xrange(len(systhist[isyst])):
-                    systhist[isyst][ival].fill(coord, selweight * systweight[isyst][ival])
-        return hist, systhist
+        nvalues = _spline_value_counts(systematics)
+        create = functools.partial(_create_sample_histograms, self.binedges, nvalues)
+        if isinstance(data, EventColumns):
+            data.check(nvalues)
+            return _fill_histograms_from_columns(create, _fill_sample_columns, data)
+        return _fill_histograms(create, _fill_sample_histograms, data, self._nprocesses)
+
+################################################################################
+
+_default_probabilitycalc = None
+
+def default_probability_calculator():
+    """The prob3++ calculator used when none is supplied. There is one per
+    process so that samples with the same binning share a ProbabilityCache.
+    """
+    global _default_probabilitycalc
+    if _default_probabilitycalc is None:
+        import simplot.rootprob3pp.lib
+        import ROOT
+        _default_probabilitycalc = ROOT.crootprob3pp.Probability()
+    return _default_probabilitycalc
 
 ################################################################################
 
 class BinnedSampleWithOscillation(BinnedSample):
-    def __init__(self, name, binning, observables, data, enuaxis, flavaxis, distance, beammodeaxis=None, cache_name=None, systematics=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, cache_dir=None):
+    def __init__(self, name, binning, observables, data, enuaxis, flavaxis, distance, beammodeaxis=None, cache_name=None, systematics=None, probabilitycalc=None, oscparmode=OscParMode.SINSQTHETA, cache_dir=None, nprocesses=1, engine="dense", probabilitygrid=None, input_files=None):
         self._enu_axis_name = enuaxis
         self._flav_axis_name = flavaxis
         self._beam_mode_axis = beammodeaxis
         self._distance = distance
         self._probabilitycalc = probabilitycalc
+        self._probabilitygrid = probabilitygrid
         self._oscparmode = oscparmode
         super(BinnedSampleWithOscillation, self).__init__(name=name, 
                                                           binning=binning, 
@@ -93,8 +364,15 @@ class BinnedSampleWithOscillation(BinnedSample):
                                                           cache_name=cache_name,
                                                           systematics=systematics,
                                                           cache_dir=cache_dir,
+                                                          nprocesses=nprocesses,
+                                                          engine=engine,
+                                                          input_files=input_files,
         )
 
+    def _cache_configuration(self, data, systematics, input_files):
+        configuration = super(BinnedSampleWithOscillation, self)._cache_configuration(data, systematics, input_files)
+        return configuration + [self._enu_axis_name, self._flav_axis_name, self._beam_mode_axis, self._oscparmode]
+
     def _build_parameter_names(self, systematics):
         if self._oscparmode == OscParMode.SINSQ2THETA:
             parameter_names = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ2)
@@ -121,31 +399,16 @@ class BinnedSampleWithOscillation(BinnedSample):
             det_weights, xsec_weights, flux_weights = systematics(self.parameter_names, selsysthist, selhist)
         probabilitycalc = self._probabilitycalc
         if probabilitycalc is None:
-            #no user supplied probability calculator, use prob3++
-            import simplot.rootprob3pp.lib
-            import ROOT
-            probabilitycalc = ROOT.crootprob3pp.Probability()
-        return _BinnedModelWithOscillation(self.parameter_names, selhist, noselhist, observabledim, enudim, flavdim, beammodedim, distance, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights, probabilitycalc=probabilitycalc, oscparmode=self._oscparmode), selhist, noselhist
+            probabilitycalc = default_probability_calculator()
+        return _BinnedModelWithOscillation(self.parameter_names, selhist, noselhist, observabledim, enudim, flavdim, beammodedim, distance, det_weights=det_weights, xsec_weights=xsec_weights, flux_weights=flux_weights, probabilitycalc=probabilitycalc, oscparmode=self._oscparmode, engine=self._engine, probabilitygrid=self._probabilitygrid), selhist, noselhist
 
     def _loaddata(self, data, systematics):
-        selhist = SparseHistogram(self.binedges)
-        noselhist = SparseHistogram(self.binedges)
-        if systematics:
-            selsysthist = [[SparseHistogram(self.binedges) for val in values] for syst, values in systematics.spline_parameter_values]
-            noselsysthist = [[SparseHistogram(self.binedges) for val in values] for syst, values in systematics.spline_parameter_values]
-        else:
-            selsysthist = []
-            noselsysthist = []
-        for coord, selweight, noselweight, systweight in data:
-            if selweight != 0:
-                selhist.fill(coord, selweight)
-            noselhist.fill(coord, noselweight)
-            for isyst in xrange(len(selsysthist)):
-                for ival in xrange(len(selsysthist[isyst])):
-                    if selweight != 0:
-                        selsysthist[isyst][ival].fill(coord, selweight * systweight[isyst][ival])
-                    noselsysthist[isyst][ival].fill(coord, noselweight * systweight[isyst][ival])
-        return selhist, noselhist, selsysthist, noselsysthist
+        nvalues = _spline_value_counts(systematics)
+        create = functools.partial(_create_oscillation_histograms, self.binedges, nvalues)
+        if isinstance(data, EventColumns):
+            data.check(nvalues, oscillation=True)
+            return _fill_histograms_from_columns(create, _fill_oscillation_columns, data)
+        return _fill_histograms(create, _fill_oscillation_histograms, data, self._nprocesses)
 
 ################################################################################
 
@@ -170,6 +433,22 @@ class CombinedBinnedSample(Sample):
             raise ValueError("Sample called with wrong number of parameters")
         return np.concatenate([s(self._get_args(x, i)) for i, s in enumerate(self._samples)])
 
+    def eval_batch(self, pars_matrix):
+        pars_matrix = _check_batch(pars_matrix, self.parameter_names)
+        return np.concatenate([s.eval_batch(pars_matrix[:, self._par_map[i]]) for i, s in enumerate(self._samples)], axis=1)
+
+    def jacobian(self, x):
+        if len(x) != len(self.parameter_names):
+            raise ValueError("Sample called with wrong number of parameters")
+        x = np.asarray(x, dtype=float)
+        blocks = []
+        for i, s in enumerate(self._samples):
+            sample = s.jacobian(self._get_args(x, i))
+            block = np.zeros((sample.shape[0], len(x)), dtype=float)
+            block[:, self._par_map[i]] = sample
+            blocks.append(block)
+        return np.concatenate(blocks, axis=0)
+
     def _get_args(self, x, samplenum):
         x2 = np.fromiter(itertools.imap(x.__getitem__, self._par_map[samplenum]), x.dtype)
         return x2
@@ -6,20 +6,30 @@ import ROOT
 from simplot.mc.generators import GeneratorList, MultiVariateGaussianGenerator, GeneratorSubset
 from simplot.mc.montecarlo import ToyMC
 from simplot.mc.statistics import Covariance, Mean, calculate_statistics_from_toymc
-from simplot.cache import cache
+from simplot.cache import cache, cache_key
 
 from simplot.binnedmodel.xsecweights import SimpleInterpolatedWeightCalc
-from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample, OscParMode
+from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample, OscParMode, _check_batch, default_probability_calculator
 
 from simplot.binnedmodel.simplemodelwithosc import SimpleBinnedModelWithOscillation
 
 _PAR_BIN_FORMAT = "bin%02.0f"
+#toy experiments generated at once for the covariance matrix
+_COVARIANCE_BATCH_SIZE = 1000
 
 ################################################################################
 
 class SimpleMcBuilder(object):
+    """Builds a simplified ToyMC from a toymc. If cache_name is given the
+    covariance and splines are cached with a key made from cache_name and a
+    hash of the builder settings and the toymc (its parameters, their start
+    values and widths and its asimov prediction), so a change to the toymc or
+    the settings rebuilds them. The toy experiments for the covariance are
+    generated batchsize at a time (see calculate_statistics_from_toymc),
+    batchsize=None generates them one at a time.
+    """
 
-    def build(self, name, toymc, keep=None, cache_name=None, npe=1000, fixed=None):
+    def build(self, name, toymc, keep=None, cache_name=None, npe=1000, fixed=None, batchsize=_COVARIANCE_BATCH_SIZE):
         self.name = name
         try:
             #assume keep is dict(parnames, splinepoints)
@@ -30,18 +40,21 @@ class SimpleMcBuilder(object):
         except AttributeError:
             #assume keep is list(parnames)
             spline_points = None
-        cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=keep, npe=npe, cache_name=cache_name, fixed=fixed)
+        cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=keep, npe=npe, cache_name=cache_name, fixed=fixed, batchsize=batchsize)
+        if spline_points is None:
+            spline_points = self._autosplinepoints(toymc, keep)
         splines = self._generate_splines_with_cache(toymc=toymc, nominal=toymc.asimov().vec, keep=keep, spline_points=spline_points, cache_name=cache_name)
         ratevector = self._buildratevector(mean, splines)
         generator = self._buildgenerator(toymc, keep, cov)
         toymc = ToyMC(ratevector, generator)
         return toymc, cov
 
-    def _generate_covariance_with_cache(self, toymc, keep, npe=1000, cache_name=None, fixed=None):    
+    def _generate_covariance_with_cache(self, toymc, keep, npe=1000, cache_name=None, fixed=None, batchsize=_COVARIANCE_BATCH_SIZE):    
         def func(self=self, toymc=toymc, keep=keep):
-            return self._generate_covariance(toymc, keep, npe=npe, fixed=fixed)
+            return self._generate_covariance(toymc, keep, npe=npe, fixed=fixed, batchsize=batchsize)
         if cache_name is not None:
-            cov = cache("SimpleMcBuilderCovariance_" + cache_name, func)
+            key = cache_key(self._toymc_configuration(toymc), keep, npe, fixed)
+            cov = cache("SimpleMcBuilderCovariance_" + cache_name + "_" + key, func)
         else:
             cov = func()
         return cov
@@ -50,11 +63,17 @@ class SimpleMcBuilder(object):
         def func(self=self, toymc=toymc, nominal=nominal, keep=keep, spline_points=spline_points):
             return self._generate_splines(toymc, nominal, keep, spline_points)
         if cache_name is not None:
-            cov = cache("SimpleMcBuilderSplines_" + cache_name, func)
+            key = cache_key(self._toymc_configuration(toymc), nominal, keep, spline_points)
+            cov = cache("SimpleMcBuilderSplines_" + cache_name + "_" + key, func)
         else:
             cov = func()
         return cov
 
+    def _toymc_configuration(self, toymc):
+        generator = toymc.generator
+        sigma = [generator.getsigma(p) for p in generator.parameter_names]
+        return [list(generator.parameter_names), generator.start_values, sigma, toymc.asimov().vec]
+
     def _generate_splines(self, toymc, nominal, keep=None, spline_points=None):
         result = OrderedDict()
         if spline_points is None:
@@ -79,7 +98,7 @@ class SimpleMcBuilder(object):
             spline_points[par] = [float(ii)*sigma for ii in xrange(-5, 6)]
         return spline_points
 
-    def _generate_covariance(self, toymc, keep, npe=1000, fixed=None):
+    def _generate_covariance(self, toymc, keep, npe=1000, fixed=None, batchsize=_COVARIANCE_BATCH_SIZE):
         cov = Covariance(fractional=True)
         mean = Mean()
         generator = toymc.generator
@@ -92,7 +111,7 @@ class SimpleMcBuilder(object):
         name = self.name
         if name is not None:
             name = "generate covariance matrix for " + str(name)
-        calculate_statistics_from_toymc(toymc, [cov, mean], npe=npe, name=name)
+        calculate_statistics_from_toymc(toymc, [cov, mean], npe=npe, name=name, batchsize=batchsize)
         if keep is not None:
             generator.setfixed(None)
         return cov.eval(), mean.eval()
@@ -133,6 +152,31 @@ class SimpleModel(Sample):
         interpolatedweights = self._interpolatedweights(x)
         return interpolatedweights * binweights * self._nominal
 
+    def eval_batch(self, pars_matrix):
+        pars_matrix = _check_batch(pars_matrix, self.parameter_names)
+        binweights = pars_matrix[:, self._binweights_start:self._binweights_end]
+        interpolatedweights = np.ones(binweights.shape)
+        for wc in self._interp:
+            interpolatedweights *= wc.eval_batch(pars_matrix)
+        return interpolatedweights * binweights * self._nominal
+
+    def jacobian(self, x):
+        """Derivatives of the rates with respect to each parameter (see
+        Sample.jacobian). The rates are linear in the bin weights and the
+        spline parameters use the spline derivatives.
+        """
+        x = np.asarray(x, dtype=float)
+        binweights = x[self._binweights_start:self._binweights_end]
+        weights = [np.asarray(wc(x), dtype=float) for wc in self._interp]
+        result = np.zeros((len(self._nominal), len(x)), dtype=float)
+        bins = np.arange(len(self._nominal))
+        result[bins, self._binweights_start + bins] = np.prod(weights + [np.ones(len(self._nominal))], axis=0) * self._nominal
+        for ii, wc in enumerate(self._interp):
+            others = np.prod([w for jj, w in enumerate(weights) if jj != ii] + [np.ones(len(self._nominal))], axis=0)
+            for index in wc.parameter_indices():
+                result[:, index] += others * wc.derivative(x) * binweights * self._nominal
+        return result
+
     def _interpolatedweights(self, x):
         result = np.ones(len(self._nominal))
         for wc in self._interp:
@@ -142,10 +186,10 @@ class SimpleModel(Sample):
 ################################################################################
 
 class SimpleMcWithOscillationBuilder(SimpleMcBuilder):
-    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA):
+    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA, batchsize=_COVARIANCE_BATCH_SIZE):
         self.name = name
         oscpars = toymc.generator.parameter_names[:6]
-        cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=oscpars, npe=npe, cache_name=cache_name, fixed=fixed)
+        cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=oscpars, npe=npe, cache_name=cache_name, fixed=fixed, batchsize=batchsize)
         generator = self._buildgenerator(toymc, oscpars, cov)
         ratevector = self._buildratevector(oscpars, toymc, sample, probabilitycalc=probabilitycalc, oscparmode=oscparmode)
         toymc = ToyMC(ratevector, generator)
@@ -158,7 +202,7 @@ class SimpleMcWithOscillationBuilder(SimpleMcBuilder):
         N_nosel = self._transform_array(N_nosel, observables, enubinning, dim_enu, dim_nupdg)
         parnames = oscpars + [_PAR_BIN_FORMAT % (ii+binoffset) for ii in xrange(N_sel.shape[2])]
         if probabilitycalc is None:
-            probabilitycalc = ROOT.crootprob3pp.Probability()
+            probabilitycalc = default_probability_calculator()
         ratevector = SimpleBinnedModelWithOscillation(parnames, N_sel, N_nosel, enubinning, detdist, probabilitycalc=probabilitycalc, oscparmode=oscparmode)
         return ratevector
 
@@ -188,10 +232,10 @@ class SimpleMcWithOscillationBuilder(SimpleMcBuilder):
 
 class SimpleCombinedMcWithOscillationBuilder(SimpleMcWithOscillationBuilder):
 
-    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA):
+    def build(self, name, toymc, sample, cache_name=None, npe=1000, probabilitycalc=None, fixed=None, oscparmode=OscParMode.SINSQTHETA, batchsize=_COVARIANCE_BATCH_SIZE):
         self.name = name
         oscpars = toymc.generator.parameter_names[:6]
-        cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=oscpars, npe=npe, cache_name=cache_name, fixed=fixed)
+        cov, mean = self._generate_covariance_with_cache(toymc=toymc, keep=oscpars, npe=npe, cache_name=cache_name, fixed=fixed, batchsize=batchsize)
         generator = self._buildgenerator(toymc, oscpars, cov)
         ratevector = self._buildratevector(oscpars, toymc, sample, generator, probabilitycalc=probabilitycalc, oscparmode=oscparmode)
         toymc = ToyMC(ratevector, generator)
@@ -2,7 +2,7 @@ import numpy as np
 cimport numpy as np
 
 from simplot.mc.statistics import safedivide
-from simplot.binnedmodel.model import ProbabilityCache, OscParMode
+from simplot.binnedmodel.model import shared_probability_cache, OscParMode
 
 DEF _DIM_ENU = 0
 DEF _DIM_NUPDG = 1
@@ -37,7 +37,7 @@ cdef class SimpleBinnedModelWithOscillation:
         self.N_nosel = N_nosel
         self._N_nosel_projection = np.sum(N_nosel, axis=2)
         self._otherflav = np.array([1,0,3,2], dtype=int)
-        self._prob = ProbabilityCache(parnames, enubinning, [detdist], probabilitycalc=probabilitycalc, oscparmode=oscparmode)
+        self._prob = shared_probability_cache(parnames, enubinning, [detdist], probabilitycalc=probabilitycalc, oscparmode=oscparmode)
         self._cache3D = np.copy(N_sel)
         self._cache1D = np.copy(np.sum(N_sel, axis=(_DIM_NUPDG, _DIM_ENU)))
         return
@@ -49,6 +49,57 @@ cdef class SimpleBinnedModelWithOscillation:
         self._updateprediction(pars)
         return np.multiply(self._syst_weights(pars), self._cache1D)
 
+    def eval_batch(self, pars_matrix):
+        """eval for each row of pars_matrix, returns an (n, nobs) array.
+        The oscillated prediction is calculated once for each distinct set of
+        oscillation parameters.
+        """
+        pars_matrix = np.array(pars_matrix, dtype=float, ndmin=2, copy=False)
+        if pars_matrix.ndim != 2 or pars_matrix.shape[1] != len(self._parnames):
+            raise ValueError("SimpleBinnedModelWithOscillation called with wrong number of parameters")
+        result = np.empty((pars_matrix.shape[0], self._num_reco_bins), dtype=float)
+        if len(result) == 0:
+            return result
+        oscpars = pars_matrix[:, self._prob.parameter_indices()]
+        order = np.lexsort(oscpars.T[::-1])
+        #boundaries of groups of rows with identical oscillation parameters
+        changed = np.any(oscpars[order[1:]] != oscpars[order[:-1]], axis=1)
+        bounds = np.concatenate([[0], np.flatnonzero(changed) + 1, [len(order)]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            rows = order[start:stop]
+            self._updateprediction(pars_matrix[rows[0]])
+            result[rows] = pars_matrix[rows, _NUM_OSC_PARS:] * self._cache1D
+        return result
+
+    def jacobian(self, pars):
+        """Derivatives of the rates with respect to each parameter, an
+        (nobs, npars) array. The rates are linear in the bin weights and the
+        derivatives of the oscillation probabilities
+        (ProbabilityCache.derivatives) are propagated through the flavour
+        rotation.
+        """
+        pars = np.array(pars, dtype=float)
+        if pars.shape != (len(self._parnames),):
+            raise ValueError("SimpleBinnedModelWithOscillation called with wrong number of parameters")
+        self._updateprediction(pars)
+        result = np.zeros((self._num_reco_bins, len(pars)), dtype=float)
+        bins = np.arange(self._num_reco_bins)
+        result[bins, _NUM_OSC_PARS + bins] = self._cache1D
+        derivatives = self._prob.derivatives(pars)
+        for ii, index in enumerate(self._prob.parameter_indices()):
+            result[:, index] = self._syst_weights(pars) * self._rotated_rates(derivatives[ii])
+        return result
+
+    def _rotated_rates(self, posc):
+        # the selected rates summed over energy and flavour for the
+        # probabilities posc (as _updateprediction), these are linear in posc
+        flav = np.arange(4)
+        other = self._otherflav
+        nominal = self._N_nosel_projection
+        oscillated = posc[:, 0, flav, flav] * nominal + posc[:, 0, other, flav] * nominal[:, other]
+        weight = safedivide(oscillated, nominal)
+        return np.sum(self._eff * weight[:, :, np.newaxis] * self.N_nosel, axis=(_DIM_NUPDG, _DIM_ENU))
+
     cdef np.ndarray[np.float64_t, ndim=1] _syst_weights(self, np.ndarray[np.float64_t, ndim=1] pars):
         return pars[_NUM_OSC_PARS:]
 
@@ -60,6 +111,8 @@ cdef class SimpleBinnedModelWithOscillation:
 
 #    @cython.boundscheck(False)
     cdef void _osc_flav_rotation(self, pars):
+        #update oscillation probabilities
+        self._prob.update(pars)
         #get inputs
         cdef np.ndarray[double, ndim=4] posc = self._prob.array
         cdef np.ndarray[np.float64_t, ndim=3] nominal = self.N_nosel
@@ -68,8 +121,6 @@ cdef class SimpleBinnedModelWithOscillation:
         cdef Py_ssize_t Nenubins = self._num_enu_bins
         cdef Py_ssize_t Nrecobins = self._num_reco_bins
         cdef np.ndarray[dtype=Py_ssize_t, ndim=1] otherflav = self._otherflav
-        #update oscillation probabilities
-        self._prob.update(pars)
         #calculate
         cdef Py_ssize_t flav_j, flav_i, ienu, ireco
         cdef double pdis, papp, value, othervalue, nosc
@@ -1,6 +1,6 @@
 from collections import OrderedDict
 
-from simplot.binnedmodel.xsecweights import XsecWeights, InterpolatedWeightCalc
+from simplot.binnedmodel.xsecweights import StackedXsecWeights, InterpolatedWeightCalc
 from simplot.binnedmodel.fluxweights import FluxWeights
 
 ################################################################################
@@ -21,8 +21,10 @@ class Systematics(object):
 
 class SplineSystematics(Systematics):
 
-    def __init__(self, spline_parameter_values):
+    def __init__(self, spline_parameter_values, kind="linear"):
+        #kind is the interpolation between the knots (see spline_coefficients)
         self._spline_parameter_values = spline_parameter_values
+        self._kind = kind
 
     def __call__(self, parameter_names, systhist, nominalhist):
         xsec_weights = self._buildxsecweights(self.spline_parameter_values, parameter_names, systhist, nominalhist)
@@ -48,9 +50,9 @@ class SplineSystematics(Systematics):
                 l.sort() # sort by parameter value
                 weights = [x[1].array() for x in l] 
                 parval = [x[0] for x in l]
-                wc = InterpolatedWeightCalc(hist.array(), parval, weights, syst, parameter_names)
+                wc = InterpolatedWeightCalc(hist.array(), parval, weights, syst, parameter_names, kind=self._kind)
                 wclist.append(wc)
-            xsecweights = XsecWeights(hist.array(), wclist)
+            xsecweights = StackedXsecWeights(hist.array(), wclist)
         return xsecweights
 
     def _buildfluxweights(self):
@@ -126,8 +128,8 @@ class FluxSystematics(Systematics):
 ################################################################################
 
 class FluxAndSplineSystematics(Systematics):
-    def __init__(self, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap):
-        self._splinesyst = SplineSystematics(spline_parameter_values)
+    def __init__(self, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap, kind="linear"):
+        self._splinesyst = SplineSystematics(spline_parameter_values, kind=kind)
         self._fluxsyst = FluxSystematics(enudim, nupdgdim, beammodedim, fluxparametermap)
 
     @property
@@ -147,8 +149,8 @@ class FluxAndSplineSystematics(Systematics):
 ################################################################################
 
 class DetectorFluxAndSplineSystematics(FluxAndSplineSystematics):
-    def __init__(self, det_systematics, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap):
-        super(DetectorFluxAndSplineSystematics, self).__init__(spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap)
+    def __init__(self, det_systematics, spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap, kind="linear"):
+        super(DetectorFluxAndSplineSystematics, self).__init__(spline_parameter_values, enudim, nupdgdim, beammodedim, fluxparametermap, kind=kind)
         self._detector_systematics = det_systematics
 
     @property
@@ -0,0 +1,167 @@
+# cython: profile=False
+
+import numpy as np
+cimport numpy as np
+
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport sin, cos, asin, sqrt, M_PI
+
+from simplot.sparsehist.sparsehist cimport parallel_threads
+
+################################################################################
+
+DEF _NUM_FLAV = 3
+
+#phase of mass eigenstate i is _LOEFAC * m_i^2 [eV^2] * L [km] / E [GeV], as in Prob3++
+DEF _LOEFAC = 2.534
+
+cdef struct _Mixing:
+    # w[a][b][i] = conj(U[a][i]) * U[b][i], the contribution of mass eigenstate
+    # i to the amplitude of flavour a -> b
+    double wre[_NUM_FLAV][_NUM_FLAV][_NUM_FLAV]
+    double wim[_NUM_FLAV][_NUM_FLAV][_NUM_FLAV]
+    double msq[_NUM_FLAV]
+
+cdef class VacuumProbability:
+    """Three flavour neutrino oscillation probabilities in vacuum.
+
+    Has the interface of crootprob3pp.Probability (setAll, update,
+    setBaseline and getVacuumProbability) so that it can be used as the
+    probabilitycalc of BinnedSampleWithOscillation without ROOT and Prob3++.
+    Note that Prob3++ includes matter effects, this calculator does not.
+
+    Angles and deltacp are in radians, sdm is dm^2_21 and ldm is dm^2_31 in
+    eV^2 (as in crootprob3pp.Probability). Energies are in GeV and baselines
+    in km. Flavours are numbered as in Prob3++ (1=e, 2=mu, 3=tau) and cp is +1
+    for neutrinos and -1 for antineutrinos.
+    """
+    cdef double _theta12, _theta23, _theta13, _deltacp, _sdm, _ldm
+    cdef double _length
+    cdef bint _touched
+    cdef _Mixing _nu
+    cdef _Mixing _antinu
+
+    def __init__(self):
+        #same defaults as crootprob3pp.Probability
+        self.setAll(asin(sqrt(0.8495)) / 2.0, asin(sqrt(1.0)) / 2.0, asin(sqrt(0.1)) / 2.0, M_PI / 2.0, 7.6e-5, 2.4e-3)
+        self._length = 295.0
+        self.update()
+
+    def setAll(self, double theta12, double theta23, double theta13, double deltacp, double sdm, double ldm):
+        self._theta12 = theta12
+        self._theta23 = theta23
+        self._theta13 = theta13
+        self._deltacp = deltacp
+        self._sdm = sdm
+        self._ldm = ldm
+        self._touched = True
+
+    def setBaseline(self, double length):
+        self._length = length
+
+    def update(self):
+        _mixing(&self._nu, self._theta12, self._theta23, self._theta13, self._deltacp, self._sdm, self._ldm, 1)
+        _mixing(&self._antinu, self._theta12, self._theta23, self._theta13, self._deltacp, self._sdm, self._ldm, -1)
+        self._touched = False
+
+    cdef _Mixing* _get_mixing(self, int cp) except NULL:
+        if self._touched:
+            raise RuntimeError("VacuumProbability parameters were set without calling update")
+        if cp >= 0:
+            return &self._nu
+        return &self._antinu
+
+    def getVacuumProbability(self, int initFlavour, int finalFlavour, double energy, int cp=1):
+        _check_flavour(initFlavour)
+        _check_flavour(finalFlavour)
+        cdef _Mixing* mixing = self._get_mixing(cp)
+        return _probability(mixing, initFlavour - 1, finalFlavour - 1, _LOEFAC * self._length / energy)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def fillProbabilityTable(self, double[::1] energies, int nenergies, double[::1] baselines, int nbaselines, int cp, double[:, :, :, ::1] out):
+        """Fill out[ienergy, ibaseline, init-1, final-1] with the probabilities
+        for all flavours, energies and baselines in one pass.
+        """
+        if energies.shape[0] != nenergies or baselines.shape[0] != nbaselines:
+            raise ValueError("fillProbabilityTable given the wrong number of energies or baselines")
+        if out.shape[0] != nenergies or out.shape[1] != nbaselines or out.shape[2] != _NUM_FLAV or out.shape[3] != _NUM_FLAV:
+            raise ValueError("fillProbabilityTable output has the wrong shape", (out.shape[0], out.shape[1], out.shape[2], out.shape[3]))
+        cdef _Mixing* mixing = self._get_mixing(cp)
+        cdef Py_ssize_t n = nenergies * nbaselines
+        cdef Py_ssize_t ii, ienu, ibase
+        cdef int a, b
+        cdef double loe
+        with nogil:
+            for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                ienu = ii // nbaselines
+                ibase = ii % nbaselines
+                loe = _LOEFAC * baselines[ibase] / energies[ienu]
+                for a in range(_NUM_FLAV):
+                    for b in range(_NUM_FLAV):
+                        out[ienu, ibase, a, b] = _probability(mixing, a, b, loe)
+        return out
+
+################################################################################
+
+cdef _check_flavour(int flavour):
+    if not 1 <= flavour <= _NUM_FLAV:
+        raise ValueError("unknown neutrino flavour", flavour)
+    return
+
+cdef void _mixing(_Mixing* mixing, double theta12, double theta23, double theta13, double deltacp, double sdm, double ldm, int cp):
+    # PMNS matrix in the standard parametrisation, conjugated for antineutrinos
+    cdef double s12 = sin(theta12), c12 = cos(theta12)
+    cdef double s23 = sin(theta23), c23 = cos(theta23)
+    cdef double s13 = sin(theta13), c13 = cos(theta13)
+    cdef double cd = cos(deltacp), sd = sin(deltacp)
+    cdef double ure[_NUM_FLAV][_NUM_FLAV]
+    cdef double uim[_NUM_FLAV][_NUM_FLAV]
+    cdef int a, b, i
+    ure[0][0] = c12 * c13
+    uim[0][0] = 0.0
+    ure[0][1] = s12 * c13
+    uim[0][1] = 0.0
+    ure[0][2] = s13 * cd
+    uim[0][2] = -s13 * sd
+    ure[1][0] = -s12 * c23 - c12 * s23 * s13 * cd
+    uim[1][0] = -c12 * s23 * s13 * sd
+    ure[1][1] = c12 * c23 - s12 * s23 * s13 * cd
+    uim[1][1] = -s12 * s23 * s13 * sd
+    ure[1][2] = s23 * c13
+    uim[1][2] = 0.0
+    ure[2][0] = s12 * s23 - c12 * c23 * s13 * cd
+    uim[2][0] = -c12 * c23 * s13 * sd
+    ure[2][1] = -c12 * s23 - s12 * c23 * s13 * cd
+    uim[2][1] = -s12 * c23 * s13 * sd
+    ure[2][2] = c23 * c13
+    uim[2][2] = 0.0
+    if cp < 0:
+        for a in range(_NUM_FLAV):
+            for i in range(_NUM_FLAV):
+                uim[a][i] = -uim[a][i]
+    for a in range(_NUM_FLAV):
+        for b in range(_NUM_FLAV):
+            for i in range(_NUM_FLAV):
+                mixing.wre[a][b][i] = ure[a][i] * ure[b][i] + uim[a][i] * uim[b][i]
+                mixing.wim[a][b][i] = ure[a][i] * uim[b][i] - uim[a][i] * ure[b][i]
+    mixing.msq[0] = 0.0
+    mixing.msq[1] = sdm
+    mixing.msq[2] = ldm
+    return
+
+cdef inline double _probability(_Mixing* mixing, int a, int b, double loe) nogil:
+    # |sum_i w[a][b][i] * exp(-i * msq[i] * loe)|^2
+    cdef double are = 0.0, aim = 0.0, phase, c, s
+    cdef int i
+    for i in range(_NUM_FLAV):
+        phase = mixing.msq[i] * loe
+        c = cos(phase)
+        s = sin(phase)
+        are = are + mixing.wre[a][b][i] * c + mixing.wim[a][b][i] * s
+        aim = aim + mixing.wim[a][b][i] * c - mixing.wre[a][b][i] * s
+    return are * are + aim * aim
+
+################################################################################
@@ -3,16 +3,174 @@
 import numpy as np
 cimport numpy as np
 
-from simplot.sparsehist.sparsehist cimport SparseArray, SparseArrayIterator, array_bisect_right, sparse_array_interpolation
+from simplot.sparsehist.sparsehist cimport SparseArray, SparseArrayIterator, array_bisect_right, sparse_array_interpolation, same_pattern, parallel_threads
 
 from libc.stdint cimport uint64_t
 from libcpp.vector cimport vector
 
 import itertools
 from bisect import bisect_right
+import scipy.sparse
+
+from simplot.binnedmodel.dependencies import ParameterDependencies, parameter_indices
 
 cimport cython
 from cython.operator cimport preincrement, dereference
+from cython.parallel cimport prange
+################################################################################
+
+_SPLINE_KINDS = ("linear", "natural", "monotone")
+
+def spline_coefficients(xvec, yvalues, kind="linear"):
+    """Coefficients of the spline through the knots (xvec, yvalues) of each
+    bin. yvalues has shape (nknots, nbins) and the result has shape
+    (nintervals, 4, nbins), on interval i the spline is
+    c[i, 0] + t*(c[i, 1] + t*(c[i, 2] + t*c[i, 3])) with t = x - xvec[i].
+    kind is "linear", "natural" (natural cubic spline) or "monotone"
+    (Fritsch-Carlson monotone cubic, which does not overshoot the knots).
+    """
+    _check_kind(kind)
+    x = np.asarray(xvec, dtype=float)
+    y = np.asarray(yvalues, dtype=float)
+    nknots = len(x)
+    if y.ndim != 2 or y.shape[0] != nknots:
+        raise ValueError("spline knot values have the wrong shape", y.shape, nknots)
+    result = np.zeros((max(nknots - 1, 1), 4, y.shape[1]), dtype=float)
+    result[:, 0] = y[:max(nknots - 1, 1)]
+    if nknots == 1:
+        return result
+    h = np.diff(x)[:, np.newaxis]
+    delta = np.diff(y, axis=0) / h
+    if kind == "linear":
+        result[:, 1] = delta
+    elif kind == "natural":
+        m = _natural_second_derivatives(h[:, 0], delta)
+        result[:, 1] = delta - h * (2.0 * m[:-1] + m[1:]) / 6.0
+        result[:, 2] = m[:-1] / 2.0
+        result[:, 3] = (m[1:] - m[:-1]) / (6.0 * h)
+    else:
+        m = _monotone_slopes(h[:, 0], delta)
+        result[:, 1] = m[:-1]
+        result[:, 2] = (3.0 * delta - 2.0 * m[:-1] - m[1:]) / h
+        result[:, 3] = (m[:-1] + m[1:] - 2.0 * delta) / (h * h)
+    return result
+
+def _check_kind(kind):
+    if kind not in _SPLINE_KINDS:
+        raise ValueError("unknown spline kind", kind, _SPLINE_KINDS)
+    return kind
+
+def _natural_second_derivatives(h, delta):
+    # tridiagonal system for the second derivatives at the interior knots,
+    # zero at the end knots
+    nknots = len(h) + 1
+    m = np.zeros((nknots, delta.shape[1]), dtype=float)
+    ninterior = nknots - 2
+    if ninterior < 1:
+        return m
+    sub = h[:-1]
+    diag = 2.0 * (h[:-1] + h[1:])
+    sup = h[1:]
+    rhs = 6.0 * (delta[1:] - delta[:-1])
+    cprime = np.zeros(ninterior, dtype=float)
+    dprime = np.zeros_like(rhs)
+    cprime[0] = sup[0] / diag[0]
+    dprime[0] = rhs[0] / diag[0]
+    for j in xrange(1, ninterior):
+        denom = diag[j] - sub[j] * cprime[j - 1]
+        cprime[j] = sup[j] / denom
+        dprime[j] = (rhs[j] - sub[j] * dprime[j - 1]) / denom
+    for j in xrange(ninterior - 1, -1, -1):
+        m[j + 1] = dprime[j] - cprime[j] * m[j + 2]
+    return m
+
+def _monotone_slopes(h, delta):
+    # weighted harmonic mean of the neighbouring secants (zero at extrema)
+    # and the shape preserving three point formula at the ends
+    nknots = len(h) + 1
+    m = np.zeros((nknots, delta.shape[1]), dtype=float)
+    if nknots == 2:
+        m[0] = delta[0]
+        m[1] = delta[0]
+        return m
+    w1 = (2.0 * h[1:] + h[:-1])[:, np.newaxis]
+    w2 = (h[1:] + 2.0 * h[:-1])[:, np.newaxis]
+    d0 = delta[:-1]
+    d1 = delta[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        interior = (w1 + w2) / (w1 / d0 + w2 / d1)
+    m[1:-1] = np.where(d0 * d1 > 0.0, interior, 0.0)
+    m[0] = _monotone_end_slope(h[0], h[1], delta[0], delta[1])
+    m[-1] = _monotone_end_slope(h[-1], h[-2], delta[-1], delta[-2])
+    return m
+
+def _monotone_end_slope(h0, h1, d0, d1):
+    m = ((2.0 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+    m = np.where(np.sign(m) != np.sign(d0), 0.0, m)
+    return np.where((np.sign(d0) != np.sign(d1)) & (np.abs(m) > np.abs(3.0 * d0)), 3.0 * d0, m)
+
+cdef Py_ssize_t _locate_interval(vector[double]& xvec, double x, double* t, bint* inside):
+    # spline interval containing x and the offset t from its first knot,
+    # outside of the knots the end values are used. inside is set if x is
+    # within the knots, including the end knots where the derivative is the
+    # one sided slope of the end interval.
+    cdef Py_ssize_t last = xvec.size() - 1
+    cdef Py_ssize_t i
+    inside[0] = False
+    if last <= 0 or x < xvec[0]:
+        t[0] = 0.0
+        return 0
+    if x >= xvec[last]:
+        t[0] = xvec[last] - xvec[last - 1]
+        inside[0] = x == xvec[last]
+        return last - 1
+    i = array_bisect_right(xvec, x) - 1
+    t[0] = x - xvec[i]
+    inside[0] = True
+    return i
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _horner(double[:, :, ::1] coefficients, Py_ssize_t interval, double t, double* out, bint derivative) nogil:
+    # out = spline value (or derivative) on interval at offset t for all bins
+    cdef Py_ssize_t n = coefficients.shape[2]
+    cdef Py_ssize_t ii
+    if n == 0:
+        return
+    cdef double* a = &coefficients[interval, 0, 0]
+    cdef double* b = a + n
+    cdef double* c = b + n
+    cdef double* d = c + n
+    if derivative:
+        for ii in xrange(n):
+            out[ii] = (3.0*d[ii]*t + 2.0*c[ii])*t + b[ii]
+    else:
+        for ii in xrange(n):
+            out[ii] = ((d[ii]*t + c[ii])*t + b[ii])*t + a[ii]
+    return
+
+cdef np.ndarray _align(SparseArray nominal, SparseArray weight):
+    # values of weight at the stored bins of the (frozen) nominal array, 0
+    # where the weight has no entry
+    weight.freeze()
+    if weight._shape == nominal._shape and same_pattern(nominal, weight):
+        return weight._values
+    if weight._nfrozen == 0:
+        return np.zeros(nominal._nfrozen, dtype=float)
+    position = np.searchsorted(weight._keys, nominal._keys)
+    found = position < weight._nfrozen
+    found[found] = weight._keys[position[found]] == nominal._keys[found]
+    return np.where(found, weight._values[np.minimum(position, weight._nfrozen - 1)], 0.0)
+
+cdef SparseArray _copy_into(SparseArray arr, SparseArray out):
+    # arr copied into out (a new array if None or of another shape), so
+    # that the caller owns the result and not a buffer reused between calls
+    arr.freeze()
+    if out is None or out.shape() != arr.shape():
+        out = SparseArray(arr.shape())
+    out._assign(arr)
+    return out
+
 ################################################################################
 
 class XsecWeights:
@@ -22,26 +180,48 @@ class XsecWeights:
         #self._arr = arr
         self._nosel = nosel
         self._xseccalc = weightcalc
+        self._buffer = None
+        #partial products of the weights, only the ones after the first
+        #weight whose parameter changed are recalculated
+        self._dependencies = ParameterDependencies([parameter_indices(calc) for calc in weightcalc])
+        self._partials = [SparseArray(shape) for _ in weightcalc]
 
     def __call__(self, pars):
-        return self._eval(pars)
+        return self._eval_into(pars, None)
+
+    def _eval_into(self, pars, out):
+        # the weights copied into out (see _copy_into), models keep their
+        # weights in out between evaluations
+        return _copy_into(self._eval(pars), out)
+
+    def parameter_indices(self):
+        return self._dependencies.parameter_indices()
 
     def _ones(self):
-        cdef SparseArray arr = SparseArray(self._shape)
+        #the product is accumulated in a buffer that is reused between calls
         cdef SparseArray nosel = self._nosel
-        cdef SparseArrayIterator it = nosel._data.begin();
-        cdef SparseArrayIterator end = nosel._data.end();
-        while it != end:
-            arr._data[dereference(it).first] = 1.0
-            preincrement(it)
-        return arr
+        cdef SparseArray ones = self._buffer
+        if ones is None or not ones.isfrozen():
+            nosel.freeze()
+            ones = nosel._frozen_like(np.ones(nosel._nfrozen, dtype=float))
+            self._buffer = ones
+        return ones
 
     def _eval(self, pars):
+        # the product is one of the partial products, which are overwritten
+        # by the next call
         #start off with array of ones
         arr = self._ones()
-        #product of weights
-        other = self._update(pars)
-        return self._product(arr, other)
+        changed = self._dependencies.changed(pars)
+        recalculate = False
+        for ii, calc in enumerate(self._xseccalc):
+            if changed[ii]:
+                calc.update(pars)
+                recalculate = True
+            if recalculate:
+                arr.multiply(calc.array(), out=self._partials[ii])
+            arr = self._partials[ii]
+        return arr
 
     def _update(self, pars):
         cdef np.ndarray[object, ndim=1] other = np.zeros(dtype=object, shape=(len(self._xseccalc),));
@@ -80,6 +260,240 @@ class XsecWeights:
 
 ################################################################################
 
+DEF _BLOCK_SIZE = 2048
+
+cdef class StackedXsecWeights:
+    """Product of the weights of a list of InterpolatedWeightCalc.
+
+    The knot weights of all systematics are stored in one dense
+    (nsyst, nknots, nnonzero) tensor aligned to the frozen sparsity pattern
+    of the nominal array (systematics with fewer knots repeat their last
+    knot). Each call locates the knot interval of every parameter and then
+    interpolates and multiplies all of the weights of each bin in a single
+    pass. Gives the same result as XsecWeights for these weight calculators.
+    If any of them uses a cubic spline kind the tensor holds the spline
+    coefficients (nsyst, nintervals, 4, nnonzero) instead.
+    """
+    cdef SparseArray _nominal
+    cdef SparseArray _out
+    cdef np.ndarray _tensor
+    cdef np.ndarray _xknots
+    cdef np.ndarray _nknots
+    cdef np.ndarray _parnum
+    cdef np.ndarray _lower
+    cdef np.ndarray _upper
+    cdef np.ndarray _fraction
+    cdef np.ndarray _previous
+    cdef bint _spline
+
+    def __init__(self, SparseArray nosel, weightcalc):
+        cdef InterpolatedWeightCalc calc
+        nosel.freeze()
+        self._nominal = nosel
+        calcs = list(weightcalc)
+        nsyst = len(calcs)
+        maxknots = max([1] + [(<InterpolatedWeightCalc?> c)._xvec.size() for c in calcs])
+        self._tensor = np.zeros((nsyst, maxknots, nosel._nfrozen), dtype=float)
+        self._xknots = np.zeros((nsyst, maxknots), dtype=float)
+        self._nknots = np.zeros(nsyst, dtype=np.intp)
+        self._parnum = np.zeros(nsyst, dtype=np.intp)
+        self._spline = False
+        for calc in calcs:
+            self._spline = self._spline or calc._kind != "linear"
+        if self._spline:
+            #spline coefficients (nsyst, nintervals, 4, nnonzero), linear
+            #systematics are written as splines too
+            self._tensor = np.zeros((nsyst, max(maxknots - 1, 1), 4, nosel._nfrozen), dtype=float)
+        for isyst, calc in enumerate(calcs):
+            nknots = calc._xvec.size()
+            self._nknots[isyst] = nknots
+            self._parnum[isyst] = calc._parnum
+            for iknot in xrange(maxknots):
+                knot = min(iknot, nknots - 1)
+                self._xknots[isyst, iknot] = calc._xvec[knot]
+                if not self._spline:
+                    self._tensor[isyst, iknot] = _align(nosel, calc._yvec[knot])
+            if self._spline:
+                coefficients = calc._spline_coefficients()
+                self._tensor[isyst, :len(coefficients)] = coefficients
+        self._lower = np.zeros(nsyst, dtype=np.intp)
+        self._upper = np.zeros(nsyst, dtype=np.intp)
+        self._fraction = np.zeros(nsyst, dtype=float)
+        self._previous = None
+        self._out = nosel._frozen_like(np.ones(nosel._nfrozen, dtype=float))
+
+    def __call__(self, pars):
+        return self._eval_into(pars, None)
+
+    def _eval_into(self, pars, out):
+        # as XsecWeights._eval_into
+        return _copy_into(self._eval(pars), out)
+
+    def parameter_indices(self):
+        return sorted(set(self._parnum.tolist()))
+
+    def jacobian(self, pars):
+        """Derivatives of the stored weights with respect to pars as a
+        sparse (nonzero bins, len(pars)) matrix.
+        """
+        x = np.asarray(pars, dtype=float)[self._parnum]
+        values, derivatives = self._factors(x)
+        nsyst, n = values.shape
+        #product of the other systematics from the products before and after
+        before = np.ones((nsyst + 1, n), dtype=float)
+        after = np.ones((nsyst + 1, n), dtype=float)
+        for isyst in xrange(nsyst):
+            before[isyst + 1] = before[isyst] * values[isyst]
+            after[nsyst - isyst - 1] = after[nsyst - isyst] * values[nsyst - isyst - 1]
+        columns = derivatives * before[:-1] * after[1:]
+        rows = np.tile(np.arange(n), nsyst)
+        parameters = np.repeat(self._parnum, n)
+        return scipy.sparse.csr_matrix((columns.ravel(), (rows, parameters)), shape=(n, len(pars)))
+
+    def _factors(self, np.ndarray[double, ndim=1] x):
+        # weight and derivative of each systematic at x, (nsyst, nonzero bins)
+        # arrays. The derivative is zero outside of the knots and one sided
+        # on the end knots.
+        self._locate(x)
+        tensor = self._tensor
+        values = np.empty((len(x), self._nominal._nfrozen), dtype=float)
+        derivatives = np.zeros_like(values)
+        for isyst in xrange(len(x)):
+            xknots = self._xknots[isyst, :self._nknots[isyst]]
+            i, j = self._lower[isyst], self._upper[isyst]
+            if self._spline:
+                t = self._fraction[isyst]
+                c = tensor[isyst, i]
+                values[isyst] = ((c[3]*t + c[2])*t + c[1])*t + c[0]
+                if xknots[0] <= x[isyst] <= xknots[-1] and len(xknots) > 1:
+                    derivatives[isyst] = (3.0*c[3]*t + 2.0*c[2])*t + c[1]
+                continue
+            f = self._fraction[isyst]
+            values[isyst] = f*tensor[isyst, j] + (1.0-f)*tensor[isyst, i]
+            if xknots[0] <= x[isyst] <= xknots[-1] and len(xknots) > 1:
+                #the end knots use the slope of the end interval
+                i = min(i, len(xknots) - 2)
+                derivatives[isyst] = (tensor[isyst, i + 1] - tensor[isyst, i]) / (xknots[i + 1] - xknots[i])
+        return values, derivatives
+
+    def _eval(self, pars):
+        # the product in a buffer that is overwritten by the next call
+        x = np.asarray(pars, dtype=float)[self._parnum]
+        if self._previous is not None and np.array_equal(x, self._previous):
+            return self._out
+        self._locate(x)
+        self._product()
+        self._previous = x
+        return self._out
+
+    cdef _locate(self, np.ndarray[double, ndim=1] x):
+        # knot interval and interpolation fraction of each systematic, the
+        # end knot is used outside of the knot range (as in
+        # InterpolatedWeightCalc)
+        cdef np.ndarray[double, ndim=2] xknots = self._xknots
+        cdef np.ndarray[np.intp_t, ndim=1] nknots = self._nknots
+        cdef np.ndarray[np.intp_t, ndim=1] lower = self._lower
+        cdef np.ndarray[np.intp_t, ndim=1] upper = self._upper
+        cdef np.ndarray[double, ndim=1] fraction = self._fraction
+        cdef Py_ssize_t isyst, i, last
+        for isyst in xrange(x.shape[0]):
+            last = nknots[isyst] - 1
+            if self._spline:
+                #interval and offset from its first knot
+                if x[isyst] <= xknots[isyst, 0] or last == 0:
+                    lower[isyst] = 0
+                    fraction[isyst] = 0.0
+                    continue
+                i = 0
+                while i < last - 1 and xknots[isyst, i + 1] <= x[isyst]:
+                    i += 1
+                lower[isyst] = i
+                fraction[isyst] = min(x[isyst], xknots[isyst, last]) - xknots[isyst, i]
+                continue
+            if x[isyst] <= xknots[isyst, 0] or last == 0:
+                i = 0
+            elif x[isyst] >= xknots[isyst, last]:
+                i = last
+            else:
+                i = 0
+                while xknots[isyst, i + 1] <= x[isyst]:
+                    i += 1
+                lower[isyst] = i
+                upper[isyst] = i + 1
+                fraction[isyst] = (x[isyst] - xknots[isyst, i]) / (xknots[isyst, i + 1] - xknots[isyst, i])
+                continue
+            lower[isyst] = i
+            upper[isyst] = i
+            fraction[isyst] = 0.0
+        return
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _product(self):
+        if self._spline:
+            return self._spline_product()
+        cdef double[:, :, ::1] tensor = self._tensor
+        cdef np.intp_t[::1] lower = self._lower
+        cdef np.intp_t[::1] upper = self._upper
+        cdef double[::1] fraction = self._fraction
+        cdef double* result = self._out._vptr
+        cdef Py_ssize_t nsyst = tensor.shape[0]
+        cdef Py_ssize_t n = tensor.shape[2]
+        cdef Py_ssize_t nblocks = (n + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+        cdef Py_ssize_t iblock, start, stop, ii, isyst
+        cdef double f
+        cdef double* y0
+        cdef double* y1
+        # each block of bins stays in cache while the weights of all of the
+        # systematics are multiplied in, the knot rows are read contiguously
+        with nogil:
+            for iblock in prange(nblocks, num_threads=parallel_threads(n), schedule="static"):
+                start = iblock * _BLOCK_SIZE
+                stop = min(start + _BLOCK_SIZE, n)
+                for ii in xrange(start, stop):
+                    result[ii] = 1.0
+                for isyst in xrange(nsyst):
+                    f = fraction[isyst]
+                    y0 = &tensor[isyst, lower[isyst], 0]
+                    y1 = &tensor[isyst, upper[isyst], 0]
+                    for ii in xrange(start, stop):
+                        result[ii] = result[ii] * (f*y1[ii] + (1.0-f)*y0[ii])
+        return
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _spline_product(self):
+        cdef double[:, :, :, ::1] tensor = self._tensor
+        cdef np.intp_t[::1] interval = self._lower
+        cdef double[::1] offset = self._fraction
+        cdef double* result = self._out._vptr
+        cdef Py_ssize_t nsyst = tensor.shape[0]
+        cdef Py_ssize_t n = tensor.shape[3]
+        cdef Py_ssize_t nblocks = (n + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+        cdef Py_ssize_t iblock, start, stop, ii, isyst
+        cdef double t
+        cdef double* a
+        cdef double* b
+        cdef double* c
+        cdef double* d
+        with nogil:
+            for iblock in prange(nblocks, num_threads=parallel_threads(n), schedule="static"):
+                start = iblock * _BLOCK_SIZE
+                stop = min(start + _BLOCK_SIZE, n)
+                for ii in xrange(start, stop):
+                    result[ii] = 1.0
+                for isyst in xrange(nsyst):
+                    t = offset[isyst]
+                    a = &tensor[isyst, interval[isyst], 0, 0]
+                    b = a + n
+                    c = b + n
+                    d = c + n
+                    for ii in xrange(start, stop):
+                        result[ii] = result[ii] * (((d[ii]*t + c[ii])*t + b[ii])*t + a[ii])
+        return
+
+################################################################################
+
 class NormWeightCalc:
     def __init__(self, shape, binmap, parname, parameternames):
         weightshape = [0 for s in shape]
@@ -106,6 +520,9 @@ class NormWeightCalc:
         self._set(pars[self._parnum])
         return
 
+    def parameter_indices(self):
+        return [self._parnum]
+
     def _reset(self):
         return self._setall(1.0)
 
@@ -139,22 +556,49 @@ class NormWeightCalc:
 ################################################################################
 
 cdef class InterpolatedWeightCalc:
+    """Weights interpolated between the arrays at the knots parvalues.
+    kind is "linear" or a cubic spline kind of spline_coefficients, whose
+    coefficients are calculated once.
+    """
     cdef int _parnum;
     cdef vector[double] _xvec;
     cdef list _yvec;
     cdef SparseArray _arr;
+    cdef SparseArray _buffer;
     #SparseArray self._arr;
     cdef str _parname;
-    def __init__(self, nominalvalues, parvalues, arrays, parname, parameternames):
+    cdef str _kind;
+    cdef SparseArray _nominal;
+    cdef np.ndarray _coefficients;
+    def __init__(self, nominalvalues, parvalues, arrays, parname, parameternames, kind="linear"):
+        self._kind = _check_kind(kind)
         self._check_is_sorted(parvalues)
         self._parnum = self._findparameter(parname, parameternames)
         self._xvec = parvalues
+        #the weights share the (frozen) sparsity pattern of the nominal array
+        nominalvalues.freeze()
         self._yvec = [arr/nominalvalues for arr in arrays]
         self._arr = None
+        self._buffer = SparseArray(nominalvalues.shape())
         self._parname = parname
         #check inputs
         if not len(arrays) == len(self._xvec):
             raise Exception("InterpolatedWeightCalc wrong number of input arrays", parname, len(parvalues), len(arrays))
+        self._nominal = nominalvalues
+        self._coefficients = None
+        if kind != "linear":
+            self._buffer = self._nominal._frozen_like(np.zeros(self._nominal._nfrozen, dtype=float))
+            self._spline_coefficients()
+
+    cdef np.ndarray _spline_coefficients(self):
+        # aligned to the stored bins of the nominal array
+        cdef SparseArray y
+        if self._coefficients is None:
+            values = np.zeros((len(self._yvec), self._nominal._nfrozen), dtype=float)
+            for iknot, y in enumerate(self._yvec):
+                values[iknot] = _align(self._nominal, y)
+            self._coefficients = spline_coefficients(self._xvec, values, self._kind)
+        return self._coefficients
 
     def _check_is_sorted(self, values, msg=None):
         l1 = list(values)
@@ -179,18 +623,42 @@ cdef class InterpolatedWeightCalc:
 
     def __call__(self, x):
         self.update(x)
-        return self.array()
+        return _copy_into(self.array(), None)
 
     def array(self):
+        """The weights at the last update, a buffer that the next update
+        overwrites (unlike the result of a call).
+        """
         return self._arr
 
+    def parameter_indices(self):
+        return [self._parnum]
+
     def update(self, pars):
         #for i in xrange(len(pars)):
         #    print "DEBUG", i, pars[i]
         x = pars[self._parnum]
         self._arr = self.eval(x)
 
+    def derivative(self, pars):
+        """Derivative of the weights with respect to the parameter (zero
+        outside of the knots and one sided on the end knots).
+        """
+        cdef SparseArray out = self._nominal._frozen_like(np.zeros(self._nominal._nfrozen, dtype=float))
+        return self._spline_eval(pars[self._parnum], True, out)
+
+    cdef SparseArray _spline_eval(self, double x, bint derivative, SparseArray out):
+        cdef double t
+        cdef bint inside
+        cdef Py_ssize_t i = _locate_interval(self._xvec, x, &t, &inside)
+        if derivative and not inside:
+            return out
+        _horner(self._spline_coefficients(), i, t, out._vptr, derivative)
+        return out
+
     cdef SparseArray eval(self, double x):
+        if self._kind != "linear":
+            return self._spline_eval(x, False, self._buffer)
         cdef int last = self._xvec.size() - 1
         if x <= self._xvec[0]:
             return self._yvec[0]
@@ -208,7 +676,7 @@ cdef class InterpolatedWeightCalc:
     cdef SparseArray _interp(self, double x, double x0, double x1, SparseArray y0, SparseArray y1):
         cdef double f = (x-x0) / (x1-x0)
         #return f*y1 + (1.0-f)*y0
-        return sparse_array_interpolation(f, y0, y1)
+        return sparse_array_interpolation(f, y0, y1, self._buffer)
 
 ################################################################################
 
@@ -219,7 +687,10 @@ cdef class SimpleInterpolatedWeightCalc:
     cdef vector[double] _arr;
     #SparseArray self._arr;
     cdef str _parname;
-    def __init__(self, nominalvalues, parvalues, arrays, parname, parameternames):
+    cdef str _kind;
+    cdef np.ndarray _coefficients;
+    def __init__(self, nominalvalues, parvalues, arrays, parname, parameternames, kind="linear"):
+        self._kind = _check_kind(kind)
         self._check_is_sorted(parvalues)
         self._parnum = self._findparameter(parname, parameternames)
         self._xvec = parvalues
@@ -229,6 +700,9 @@ cdef class SimpleInterpolatedWeightCalc:
         #check inputs
         if not len(arrays) == len(self._xvec):
             raise Exception("SimpleInterpolatedWeightCalc wrong number of input arrays", parname, len(parvalues), len(arrays))
+        self._coefficients = None
+        if kind != "linear":
+            self._coefficients = spline_coefficients(self._xvec, np.array(self._yvec, dtype=float).reshape((len(self._yvec), len(nominalvalues))), kind)
 
     def _check_is_sorted(self, values, msg=None):
         l1 = list(values)
@@ -258,13 +732,59 @@ cdef class SimpleInterpolatedWeightCalc:
     def array(self):
         return self._arr
 
+    def parameter_indices(self):
+        return [self._parnum]
+
     def update(self, pars):
         #for i in xrange(len(pars)):
         #    print "DEBUG", i, pars[i]
         x = pars[self._parnum]
         self._arr = self.eval(x)
 
+    def derivative(self, pars):
+        """Derivative of the weights with respect to the parameter (zero
+        outside of the knots and one sided on the end knots).
+        """
+        cdef double t
+        cdef bint inside
+        cdef Py_ssize_t i
+        coefficients = self._coefficients
+        if coefficients is None:
+            coefficients = spline_coefficients(self._xvec, np.array(self._yvec, dtype=float).reshape((len(self._yvec), self._arr.size())), "linear")
+        out = np.zeros(coefficients.shape[2], dtype=float)
+        i = _locate_interval(self._xvec, pars[self._parnum], &t, &inside)
+        if inside:
+            out = coefficients[i, 1] + t*(2.0*coefficients[i, 2] + t*3.0*coefficients[i, 3])
+        return out
+
+    def eval_batch(self, pars_matrix):
+        """The weights for each row of pars_matrix as an (n, nbins) array."""
+        x = np.asarray(pars_matrix, dtype=float)[:, self._parnum]
+        xvec = np.array(self._xvec)
+        if self._coefficients is not None:
+            c = self._coefficients
+            i = np.clip(np.searchsorted(xvec, x, side="right") - 1, 0, len(c) - 1)
+            t = (np.clip(x, xvec[0], xvec[-1]) - xvec[i])[:, np.newaxis]
+            c = c[i]
+            return ((c[:, 3]*t + c[:, 2])*t + c[:, 1])*t + c[:, 0]
+        yvec = np.array(self._yvec, dtype=float)
+        if len(xvec) == 1:
+            return np.repeat(yvec, len(x), axis=0)
+        i = np.clip(np.searchsorted(xvec, x, side="right") - 1, 0, len(xvec) - 2)
+        x = np.clip(x, xvec[0], xvec[-1])
+        f = ((x - xvec[i]) / (xvec[i+1] - xvec[i]))[:, np.newaxis]
+        return f*yvec[i+1] + (1.0-f)*yvec[i]
+
     cdef vector[double] eval(self, double x):
+        cdef double t
+        cdef bint inside
+        cdef vector[double] y
+        cdef Py_ssize_t interval
+        if self._coefficients is not None:
+            y = vector[double](self._coefficients.shape[2])
+            interval = _locate_interval(self._xvec, x, &t, &inside)
+            _horner(self._coefficients, interval, t, y.data(), False)
+            return y
         cdef int last = self._xvec.size() - 1
         if x <= self._xvec[0]:
             return self._yvec[0]
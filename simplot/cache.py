@@ -1,7 +1,11 @@
 import hashlib
+from collections import OrderedDict
 import os
+import struct
+import tempfile
 import numpy
 import cPickle as pickle
+from cStringIO import StringIO
 import ROOT
 
 _DEFAULT_TMPDIR = "/tmp/simplot_cache"
@@ -9,14 +13,17 @@ _DEFAULT_TMPDIR = "/tmp/simplot_cache"
 ###############################################################################
 
 def cache(uniquestr, callable_, filelist=None, tmpdir=_DEFAULT_TMPDIR):
-    '''A simple interface for CacheNumpy object.
+    '''A simple interface for CacheMemoryMap object.
     If a cache already exists it reads it,
     otherwise is evaluates the callable_ (with no arguments)
     and expects it to return data is a form that can be written to disk. 
     If a filelist is given, compares the file modification times to the cache file.
     If he files have been modified since the cache was written, then the cache is overriden. 
+    Note that this used to be a CachePickle. The data is still pickled, but
+    numpy arrays in it are now returned as copy-on-write memory maps of the
+    cache file (numpy.memmap) rather than in-memory copies.
     '''
-    cn = CachePickle(uniquestr, tmpdir=tmpdir)
+    cn = CacheMemoryMap(uniquestr, tmpdir=tmpdir)
     if cn.exists() and (filelist is None or cn.newerthan(*filelist)):
         data = cn.read()
     else:
@@ -44,6 +51,50 @@ def cache_root(uniquestr, callable_, filelist=None, tmpdir=_DEFAULT_TMPDIR):
         cn.write(data)
     return data
 
+def cache_key(*objects):
+    '''A hex digest identifying objects, for use in the uniquestr of cache.
+    numpy arrays are hashed by dtype, shape and contents, lists, tuples, sets
+    and dicts element by element and anything else by its repr.
+    Use file_identity to include input files in the key.
+    '''
+    h = hashlib.sha1()
+    _update_key(h, objects)
+    return h.hexdigest()
+
+def file_identity(path):
+    '''(absolute path, size, modification time) of a file, which changes when the file is rewritten.'''
+    path = os.path.abspath(path)
+    return (path, os.path.getsize(path), os.path.getmtime(path))
+
+def _update_key(h, obj):
+    if isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            h.update("objectarray%r" % (obj.shape,))
+            _update_key(h, obj.tolist())
+        else:
+            arr = numpy.ascontiguousarray(obj)
+            h.update("array%s%r" % (arr.dtype.str, arr.shape))
+            h.update(arr.data)
+    elif isinstance(obj, dict):
+        items = obj.items()
+        if not isinstance(obj, OrderedDict):
+            items = sorted(items)
+        h.update("dict%d" % len(items))
+        for k, v in items:
+            _update_key(h, k)
+            _update_key(h, v)
+    elif isinstance(obj, (set, frozenset)):
+        h.update("set%d" % len(obj))
+        for x in sorted(obj):
+            _update_key(h, x)
+    elif isinstance(obj, (list, tuple)):
+        h.update("%s%d" % (type(obj).__name__, len(obj)))
+        for x in obj:
+            _update_key(h, x)
+    else:
+        h.update(repr(obj))
+    return
+
 ###############################################################################
 
 class Cache(object):
@@ -161,6 +212,81 @@ class CachePickle(Cache):
 
 ###############################################################################
 
+class CacheMemoryMap(Cache):
+    '''Pickle with the numpy arrays written out of band as raw buffers.
+
+    The file contains the array buffers, then the pickle stream, then the
+    offset of the pickle stream. On reading the arrays are copy-on-write
+    memory maps of the file, so large cached objects (e.g. the key and value
+    arrays of a SparseHistogram) load without being copied or parsed.
+    '''
+    _ALIGNMENT = 64
+    _OFFSET = struct.Struct("<Q")
+
+    def __init__(self, uniquestr, prefix="tmp", tmpdir=_DEFAULT_TMPDIR):
+        super(CacheMemoryMap, self).__init__(uniquestr=uniquestr, prefix=prefix, postfix=".mmap", tmpdir=tmpdir)
+
+    def read(self):
+        fname = self.tmpfilename()
+        buf = numpy.memmap(fname, dtype=numpy.uint8, mode="c")
+        def persistent_load(pid):
+            offset, dtype, shape = pid
+            return numpy.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        with open(fname, "rb") as infile:
+            infile.seek(-self._OFFSET.size, os.SEEK_END)
+            offset, = self._OFFSET.unpack(infile.read(self._OFFSET.size))
+            infile.seek(offset)
+            unpickler = pickle.Unpickler(infile)
+            unpickler.persistent_load = persistent_load
+            data = unpickler.load()
+        return data
+
+    def write(self, data):
+        '''The file is written under a temporary name and renamed, so that
+        other jobs never read a partial file and processes that still map
+        the previous file are not affected.
+        '''
+        fname = self.tmpfilename()
+        fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(fname) + ".", dir=os.path.dirname(fname))
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                self._write(outfile, data)
+            #mkstemp creates the file readable by this user only
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpname, 0666 & ~umask)
+            os.rename(tmpname, fname)
+        except:
+            os.remove(tmpname)
+            raise
+        return
+
+    def _write(self, outfile, data):
+        written = {}
+        def persistent_id(obj):
+            if type(obj) not in (numpy.ndarray, numpy.memmap) or obj.dtype.fields is not None or obj.dtype.hasobject:
+                return None
+            try:
+                return written[id(obj)][1]
+            except KeyError:
+                pass
+            outfile.write("\0" * (-outfile.tell() % self._ALIGNMENT))
+            pid = (outfile.tell(), obj.dtype.str, obj.shape)
+            obj.tofile(outfile)
+            #keep obj alive so that its id is not reused
+            written[id(obj)] = (obj, pid)
+            return pid
+        stream = StringIO()
+        pickler = pickle.Pickler(stream, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(data)
+        offset = outfile.tell()
+        outfile.write(stream.getvalue())
+        outfile.write(self._OFFSET.pack(offset))
+        return
+
+###############################################################################
+
 def _test_numpy_cache():
     test_dict = { "A":1, "B":2, "C":3 }
     test_numpy = numpy.ones(shape=(3, 2))
@@ -65,6 +65,18 @@ class ToyMC:
         vec = self.ratevector(pars)
         return ToyMCExperiment(pars, vec)
     
+    def generate_batch(self, n):
+        """Generate n experiments.
+        The rate vector is evaluated for all of them at once if it provides eval_batch.
+        """
+        pars = [self.generator() for _ in xrange(n)]
+        eval_batch = getattr(self.ratevector, "eval_batch", None)
+        if eval_batch is not None and n > 0:
+            vecs = eval_batch(np.array(pars))
+        else:
+            vecs = [self.ratevector(p) for p in pars]
+        return [ToyMCExperiment(p, v) for p, v in zip(pars, vecs)]
+
     def _infostring(self):
         sio = StringIO.StringIO()
         asimov = self.asimov()
@@ -11,10 +11,33 @@ from simplot.progress import printprogress
 
 ###############################################################################
 
-def calculate_statistics_from_toymc(toymc, statistics, npe, transform=None, name=None):
+def calculate_statistics_from_toymc(toymc, statistics, npe, transform=None, name=None, batchsize=None):
+    """Experiments are generated one at a time unless batchsize is given, they
+    are then generated batchsize at a time if toymc provides generate_batch.
+    A batch keeps batchsize experiments in memory at once.
+    """
     if transform is None:
         transform = attrgetter("vec")
-    return calculate_statistics(toymc, statistics, npe, transform=transform, name=name)
+    generator = toymc
+    if batchsize is not None and hasattr(toymc, "generate_batch"):
+        generator = _BatchedGenerator(toymc, npe, batchsize).next
+    return calculate_statistics(generator, statistics, npe, transform=transform, name=name)
+
+class _BatchedGenerator(object):
+    def __init__(self, toymc, npe, batchsize):
+        if batchsize < 1:
+            raise ValueError("batchsize must be at least 1", batchsize)
+        self._toymc = toymc
+        self._remaining = npe
+        self._batchsize = batchsize
+        self._batch = collections.deque()
+
+    def next(self):
+        if not self._batch:
+            n = max(min(self._batchsize, self._remaining), 1)
+            self._batch.extend(self._toymc.generate_batch(n))
+            self._remaining -= n
+        return self._batch.popleft()
 
 def calculate_statistics(generator, statistics, npe, transform=None, name=None):
     try:
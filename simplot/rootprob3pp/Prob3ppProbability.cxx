@@ -1,5 +1,8 @@
 #include "Prob3ppProbability.hxx"
 
+//matter density (g/cm^3) used for propagation along the baseline
+static const double kDensity = 2.6;
+
 int crootprob3pp::Flavour::frompdg(int pdg)
 {
 	if(abs(pdg) == 12)
@@ -173,10 +176,52 @@ double crootprob3pp::Probability::getVacuumProbability(int initFlavour, int fina
     double sinsq_theta23 = sinsq(theta23);
     double dm32 = ldm - sdm;
 	this->bargerprop->SetMNS(sinsq_theta12, sinsq_theta13, sinsq_theta23, sdm, dm32, this->deltacp, energy, kSquared, cp);
-	this->bargerprop->propagateLinear(cp, this->length, 2.6);
+	this->bargerprop->propagateLinear(cp, this->length, kDensity);
 	//double p = this->bargerprop->GetVacuumProb(cp*initFlavour, cp*finalFlavour, energy, this->length);
 	double p = this->bargerprop->GetProb(cp*initFlavour, cp*finalFlavour);
 	return p;
 }
 
 
+
+void crootprob3pp::Probability::fillProbabilityTable(const double* energies, int nenergies, const double* baselines, int nbaselines, int cp, double* out)
+{
+	/***************************************************************************
+	 * Fills out[ienergy][ibaseline][init-1][final-1] (a contiguous array of   *
+	 * nenergies*nbaselines*3*3 doubles) with the probabilities of all flavour *
+	 * transitions. The mixing matrix is set once and each propagation gives  *
+	 * all nine transitions, instead of one SetMNS and propagation per call to *
+	 * getVacuumProbability.                                                   *
+	 ***************************************************************************/
+	if (this->istouched)
+	{
+		throw std::exception();
+	}
+	if (nenergies <= 0 || nbaselines <= 0)
+	{
+		return;
+	}
+	double sinsq_theta12 = sinsq(theta12);
+	double sinsq_theta13 = sinsq(theta13);
+	double sinsq_theta23 = sinsq(theta23);
+	double dm32 = ldm - sdm;
+	//the mixing matrix does not depend on the energy
+	this->bargerprop->SetMNS(sinsq_theta12, sinsq_theta13, sinsq_theta23, sdm, dm32, this->deltacp, energies[0], kSquared, cp);
+	for (int ienergy = 0; ienergy < nenergies; ++ienergy)
+	{
+		this->bargerprop->SetEnergy(energies[ienergy]);
+		for (int ibaseline = 0; ibaseline < nbaselines; ++ibaseline)
+		{
+			this->bargerprop->propagateLinear(cp, baselines[ibaseline], kDensity);
+			double* p = out + (ienergy * nbaselines + ibaseline) * kNumFlavours * kNumFlavours;
+			for (int i = 0; i < kNumFlavours; ++i)
+			{
+				for (int j = 0; j < kNumFlavours; ++j)
+				{
+					p[i * kNumFlavours + j] = this->bargerprop->GetProb(cp * (i + 1), cp * (j + 1));
+				}
+			}
+		}
+	}
+	return;
+}
@@ -40,6 +40,7 @@ private:
     double length;
 
     static const bool kSquared = 1;
+    static const int kNumFlavours = 3;
 
 public:
 
@@ -73,6 +74,8 @@ public:
 
     double getVacuumProbability(int initFlavour, int finalFlavour, double energy, int cp=1);
 
+    void fillProbabilityTable(const double* energies, int nenergies, const double* baselines, int nbaselines, int cp, double* out);
+
 private:
     bool istouched;
 
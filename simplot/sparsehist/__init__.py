@@ -2,3 +2,7 @@
 from .sparsehist import SparseHistogram
 from .sparsehist import SparseArray
 
+from .sparsehist import ProjectionPlan
+from .sparsehist import SparseExpression
+from .sparsehist import set_num_threads, get_num_threads
+from .sparsehist import share_patterns
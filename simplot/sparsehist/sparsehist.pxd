@@ -2,6 +2,7 @@ from unordered_map cimport unordered_map as std_map
 from libcpp.vector cimport vector
 from libcpp cimport bool
 from libc.stdint cimport uint64_t
+cimport numpy
 
 ctypedef std_map[uint64_t, double] SparseArrayContainer
 ctypedef std_map[uint64_t, double].iterator SparseArrayIterator
@@ -11,12 +12,31 @@ cdef class SparseArray:
     cdef vector[uint64_t] _dimscale
     #cdef unordered_map[uint64_t, double] _data
     cdef SparseArrayContainer _data
+    #frozen storage: sorted keys and a contiguous value buffer.
+    cdef bint _frozen
+    cdef numpy.ndarray _keys
+    cdef numpy.ndarray _values
+    cdef uint64_t* _kptr
+    cdef double* _vptr
+    cdef Py_ssize_t _nfrozen
 
     cdef uint64_t key(self, vector[uint64_t]& index);
     cdef vector[uint64_t] decodekey(self, uint64_t key);
     cdef void set(self, vector[uint64_t]& index, double value);
     cdef double get(self, vector[uint64_t]& index);
     cdef void add(self, vector[uint64_t]& index, double value);
+    cdef double getkey(self, uint64_t key);
+    cdef void setkey(self, uint64_t key, double value);
+    cdef void addkey(self, uint64_t key, double value);
+    cdef Py_ssize_t findkey(self, uint64_t key);
+
+    cdef tuple _sorted_storage(self);
+    cdef _setstorage(self, numpy.ndarray keys, numpy.ndarray values);
+    cdef _clearmap(self);
+    cdef SparseArray _frozen_like(self, numpy.ndarray values);
+    cdef _pattern_into(self, SparseArray out);
+    cdef _reset(self);
+    cdef _assign(self, SparseArray src);
 
     cdef _check_bounds(self, vector[uint64_t]& index);
     cdef int _check_shape(self, rhs);
@@ -24,11 +44,37 @@ cdef class SparseArray:
     #cdef SparseArray _multiply_array_with_copy(self, SparseArray rhs);
     #cdef SparseArray _multiply_array_inplace(self, SparseArray rhs);
 
+cdef class ProjectionPlan:
+    cdef vector[uint64_t] _shape
+    cdef vector[uint64_t] _keep
+    cdef vector[uint64_t] _newdimscale
+    cdef list _newshape
+    cdef dict _range
+    cdef uint64_t _size
+    cdef numpy.ndarray _keys
+    cdef numpy.ndarray _dest
+
+    cdef _build(self, SparseArray arr);
+    cdef _check_pattern(self, SparseArray arr);
+
+cdef class SparseExpression:
+    cdef int _op
+    cdef SparseExpression _lhs
+    cdef SparseExpression _rhs
+    cdef SparseArray _arr
+    cdef double _value
+    cdef bint _isconst
+    cdef vector[uint64_t] _shape
+
+    cdef _compile(self, list leaves, list program);
+    cdef int _patternmode(self);
+    cdef object _pattern(self);
+
 #cdef class Ones(SparseArray):
 #    pass
 
 cdef int array_bisect_right(vector[double]& arr, double x);
-cdef SparseArray sparse_array_interpolation(double f, SparseArray y0, SparseArray y1);
-
-#cdef extern from "<algorithm>" namespace "std" nogil:
-#    Iter lower_bound[Iter, T](Iter first, Iter last, const T& value)
+cdef SparseArray sparse_array_interpolation(double f, SparseArray y0, SparseArray y1, SparseArray out=*);
+cdef bint same_pattern(SparseArray lhs, SparseArray rhs);
+cdef double frozen_value(uint64_t* keys, double* values, Py_ssize_t n, uint64_t key) nogil;
+cdef int parallel_threads(Py_ssize_t n) nogil;
@@ -2,6 +2,19 @@
 DEF PROFILE_FLAG = False
 DEF SHAPE_IS_IDENTICAL = 1
 DEF SHAPE_IS_COMPATIBLE = 2
+DEF _OP_MUL = 0
+DEF _OP_DIV = 1
+DEF _OP_ADD = 2
+DEF _OP_SUB = 3
+DEF _OP_LEAF = 4
+DEF _OP_CONST = 5
+DEF _LOOKUP_TABLE_RATIO = 4
+DEF _PATTERN_LHS = 0
+DEF _PATTERN_RHS = 1
+DEF _PATTERN_UNION = 2
+DEF _BLOCK_SIZE = 256
+DEF _PARALLEL_MIN_SIZE = 16384
+DEF _MAP_NODE_SIZE = 32
 
 #from libcpp.unordered_map cimport unordered_map
 #from libcpp.map cimport map as std_map
@@ -15,13 +28,40 @@ cimport numpy
 
 cimport cython
 from cython.operator cimport preincrement, dereference
+from cython.parallel cimport prange, threadid
+cimport openmp
 
 from simplot.mplot.histogram import HistogramND, HistogramNDLabel
 
 from unordered_map cimport unordered_map as std_map
 from libcpp.vector cimport vector
 from libcpp cimport bool
-from libc.stdint cimport uint64_t
+from libc.stdint cimport uint64_t, int64_t
+from libc.string cimport memcmp
+
+###############################################################################
+
+cdef int _num_threads = openmp.omp_get_max_threads()
+
+def set_num_threads(int nthreads):
+    """Set the number of threads used by the SparseArray kernels.
+    The default is the OpenMP default (e.g. set by OMP_NUM_THREADS).
+    """
+    global _num_threads
+    if nthreads < 1:
+        raise ValueError("number of threads must be at least 1", nthreads)
+    _num_threads = nthreads
+    return
+
+def get_num_threads():
+    return _num_threads
+
+cdef int parallel_threads(Py_ssize_t n) nogil:
+    # number of threads for a loop over n entries, small loops are not worth
+    # starting threads for
+    if n < _PARALLEL_MIN_SIZE:
+        return 1
+    return _num_threads
 
 ###############################################################################
 
@@ -31,8 +71,12 @@ cdef class SparseArray:
     #cdef vector[uint64_t] _dimscale
     #cdef std_map[uint64_t, double] _data
 
-    def __cinit__(self, vector[uint64_t] shape, int minsize=10**7):
+    def __cinit__(self, vector[uint64_t] shape, int minsize=0):
         self._shape = shape
+        self._frozen = False
+        self._kptr = NULL
+        self._vptr = NULL
+        self._nfrozen = 0
         self.reserve(minsize)
         cdef uint64_t cumprod = 1
         for s in shape:
@@ -43,21 +87,165 @@ cdef class SparseArray:
                 self._dimscale.push_back(0)
 
     def sum(self):
+        cdef double total = 0.0
+        cdef Py_ssize_t ii
+        cdef Py_ssize_t n = self._nfrozen
+        cdef double* vptr = self._vptr
+        if self._frozen:
+            with nogil:
+                for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                    total += vptr[ii]
+            return total
         cdef SparseArrayIterator it = self._data.begin()
         cdef SparseArrayIterator end = self._data.end()
-        cdef double total = 0.0
         while it != end:
             total += dereference(it).second
             preincrement(it)
         return total
 
+    def isfrozen(self):
+        return self._frozen
+
+    def freeze(self):
+        """Fix the sparsity pattern of this array.
+
+        The hash map is replaced by a sorted key array and a contiguous value
+        buffer. Arrays that share a pattern are combined with elementwise
+        loops, no hashing is done. Setting a value at a key that is not in the
+        pattern converts the array back to a hash map (see thaw).
+        """
+        if self._frozen:
+            return self
+        keys, values = self._sorted_storage()
+        self._setstorage(keys, values)
+        self._clearmap()
+        return self
+
+    def thaw(self):
+        """Convert a frozen array back to hash map storage."""
+        if not self._frozen:
+            return self
+        cdef Py_ssize_t ii
+        for ii in xrange(self._nfrozen):
+            self._data[self._kptr[ii]] = self._vptr[ii]
+        self._frozen = False
+        self._keys = None
+        self._values = None
+        self._kptr = NULL
+        self._vptr = NULL
+        self._nfrozen = 0
+        return self
+
+    cdef tuple _sorted_storage(self):
+        # (keys, values) arrays of all entries sorted by key. The frozen
+        # storage is returned as it is, without a copy.
+        if self._frozen:
+            return self._keys, self._values
+        cdef Py_ssize_t n = self._data.size()
+        cdef numpy.ndarray[numpy.uint64_t, ndim=1] keys = numpy.empty(n, dtype=numpy.uint64)
+        cdef numpy.ndarray[numpy.float64_t, ndim=1] values = numpy.empty(n, dtype=numpy.float64)
+        cdef SparseArrayIterator it = self._data.begin()
+        cdef SparseArrayIterator end = self._data.end()
+        cdef Py_ssize_t ii = 0
+        while it != end:
+            keys[ii] = dereference(it).first
+            values[ii] = dereference(it).second
+            ii += 1
+            preincrement(it)
+        order = numpy.argsort(keys, kind="mergesort")
+        return keys[order], values[order]
+
+    cdef _setstorage(self, numpy.ndarray keys, numpy.ndarray values):
+        if not keys.shape[0] == values.shape[0]:
+            raise ValueError("SparseArray keys and values have different lengths", keys.shape[0], values.shape[0])
+        keys = numpy.ascontiguousarray(keys, dtype=numpy.uint64)
+        values = numpy.ascontiguousarray(values, dtype=numpy.float64)
+        cdef uint64_t[::1] kview = keys
+        cdef double[::1] vview = values
+        self._keys = keys
+        self._values = values
+        self._nfrozen = keys.shape[0]
+        if self._nfrozen > 0:
+            self._kptr = &kview[0]
+            self._vptr = &vview[0]
+        else:
+            self._kptr = NULL
+            self._vptr = NULL
+        self._frozen = True
+        return
+
+    cdef _clearmap(self):
+        #swap with an empty map to release the buckets as well as the nodes
+        cdef SparseArrayContainer empty
+        self._data.swap(empty)
+        return
+
+    cdef SparseArray _frozen_like(self, numpy.ndarray values):
+        # new frozen array that shares this (frozen) array's sparsity pattern
+        cdef SparseArray result = SparseArray(self._shape)
+        result._setstorage(self._keys, values)
+        return result
+
+    cdef _pattern_into(self, SparseArray out):
+        # give out this (frozen) array's sparsity pattern. The values are
+        # only preserved if out already had the pattern.
+        if out is self or same_pattern(self, out):
+            return
+        out._clearmap()
+        out._setstorage(self._keys, numpy.empty(self._nfrozen, dtype=numpy.float64))
+        return
+
+    cdef _reset(self):
+        # remove all entries, the hash map keeps its buckets for reuse
+        self._data.clear()
+        if self._frozen:
+            self._frozen = False
+            self._keys = None
+            self._values = None
+            self._kptr = NULL
+            self._vptr = NULL
+            self._nfrozen = 0
+        return
+
+    cdef _assign(self, SparseArray src):
+        # make this array a copy of src (which must have the same shape)
+        if src is self:
+            return
+        if src._frozen:
+            src._pattern_into(self)
+            numpy.copyto(self._values, src._values)
+        else:
+            self._reset()
+            self._data = src._data
+        return
+
     def shape(self):
         return self._shape
 
-    def reserve(self, size):
-        #self._data.rehash(size)
+    def reserve(self, size_t size):
+        """Allocate hash map buckets for at least size entries."""
+        if not self._frozen:
+            self._data.reserve(size)
+        return
+
+    def rehash(self, size_t nbuckets=0):
+        """Rebuild the hash map with at least nbuckets buckets. The default
+        releases buckets that are not needed for the current entries.
+        """
+        self._data.rehash(nbuckets)
         return
 
+    def memory_usage(self):
+        """Approximate number of bytes used to store the entries.
+        Hash map nodes are counted as _MAP_NODE_SIZE bytes (key, value and
+        next pointer after allocator rounding). A key array shared with other
+        frozen arrays is counted in full.
+        """
+        cdef size_t total = self._data.bucket_count() * sizeof(void*) + self._data.size() * _MAP_NODE_SIZE
+        if self._frozen:
+            total += self._keys.nbytes + self._values.nbytes
+        return total
+
     def __str__(self):
         return r"SparseArray(%.2e%%, %.2e/%.2e)" % (100.*self.occupancy(), self.actual_size(), self.max_size())
         #return r"SparseArray(%.2e%%, %.2e/%.2e, buckets=%s, load_factor=%s, max_load_factor=%s)" % (100.*self.occupancy(), self.actual_size(), self.max_size(), self._data.bucket_count(), self._data.load_factor(), self._data.max_load_factor())
@@ -66,8 +254,12 @@ cdef class SparseArray:
         return self.actual_size()
 
     def __iter__(self):
-        for key, value in self._data:
-            yield self.decodekey(key), value
+        if self._frozen:
+            for key, value in zip(self._keys, self._values):
+                yield self.decodekey(key), value
+        else:
+            for key, value in self._data:
+                yield self.decodekey(key), value
 
     def __setitem__(self, index, double value):
         self.set(index, value)
@@ -84,29 +276,69 @@ cdef class SparseArray:
         return size
 
     def actual_size(self):
-        return len(self._data)
+        if self._frozen:
+            return self._nfrozen
+        return self._data.size()
 
     def occupancy(self):
         return float(self.actual_size())/float(self.max_size())
 
     cdef double get(self, vector[uint64_t]& index):
-        cdef uint64_t key = self.key(index)
-        cdef SparseArrayIterator it = self._data.find(key)
+        return self.getkey(self.key(index))
+
+    cdef void set(self, vector[uint64_t]& index, double value):
+        self.setkey(self.key(index), value)
+        return
+
+    cdef void add(self, vector[uint64_t]& index, double value):
+        self.addkey(self.key(index), value)
+        return
+
+    cdef double getkey(self, uint64_t key):
+        cdef Py_ssize_t ii
+        cdef SparseArrayIterator it
+        if self._frozen:
+            ii = self.findkey(key)
+            if ii < 0:
+                return 0.0
+            return self._vptr[ii]
+        it = self._data.find(key)
         if (it != self._data.end()):
             return dereference(it).second;
         else:
             return 0.0
 
-    cdef void set(self, vector[uint64_t]& index, double value):
-        cdef uint64_t key = self.key(index)
+    cdef void setkey(self, uint64_t key, double value):
+        cdef Py_ssize_t ii
+        if self._frozen:
+            ii = self.findkey(key)
+            if ii >= 0:
+                self._vptr[ii] = value
+                return
+            #new entry, the pattern changes
+            self.thaw()
         self._data[key] = value
         return
 
-    cdef void add(self, vector[uint64_t]& index, double value):
-        cdef uint64_t key = self.key(index)
+    cdef void addkey(self, uint64_t key, double value):
+        cdef Py_ssize_t ii
+        if self._frozen:
+            ii = self.findkey(key)
+            if ii >= 0:
+                self._vptr[ii] += value
+                return
+            #new entry, the pattern changes
+            self.thaw()
         self._data[key] += value
         return
 
+    cdef Py_ssize_t findkey(self, uint64_t key):
+        # position of key in the frozen storage or -1 if it is not present.
+        cdef Py_ssize_t ii = _searchsorted(self._kptr, self._nfrozen, key)
+        if ii < self._nfrozen and self._kptr[ii] == key:
+            return ii
+        return -1
+
     cdef uint64_t key(self, vector[uint64_t]& index):
         self._check_bounds(index)
         cdef uint64_t key = 0
@@ -144,128 +376,233 @@ cdef class SparseArray:
         return
 
     @cython.profile(PROFILE_FLAG)
-    def project(self, vector[uint64_t] keep, range_=None):
+    def project(self, vector[uint64_t] keep, range_=None, SparseArray out=None):
+        """Sum over all axes that are not in keep.
+        If out is given, the result is written into it and out is returned.
+        """
         newshape = [self._shape[k] for k in keep]
-        cdef SparseArray result = SparseArray(newshape)
-        #for key, value in self._data:
-        #    index = self.decodekey(key)
-        #    if range_ is None or self._within_range(index, range_):
-        #        index = [index[k] for k in keep]
-        #        result.add(index, value)
+        cdef SparseArray result
+        if out is None:
+            result = SparseArray(newshape)
+        elif out is self:
+            out._assign(self.project(keep, range_=range_))
+            return out
+        else:
+            _check_output(out, newshape)
+            result = out
+            result._reset()
+        cdef _KeyProjection projection = _KeyProjection(self._shape, self._dimscale, keep, result._dimscale, range_)
+        cdef int64_t newkey
+        cdef Py_ssize_t ii
+        if self._frozen:
+            for ii in xrange(self._nfrozen):
+                newkey = projection.project(self._kptr[ii])
+                if newkey >= 0:
+                    result.addkey(newkey, self._vptr[ii])
+            return result
         cdef SparseArrayIterator it = self._data.begin()
         cdef SparseArrayIterator end = self._data.end()
-        cdef uint64_t key;
-        cdef vector[uint64_t] index
-        cdef vector[uint64_t] newindex = newshape
-        cdef uint64_t nkeep = keep.size()
         while it != end:
-            key = dereference(it).first
-            value = dereference(it).second
-            index = self.decodekey(key)
-            if range_ is None or self._within_range(index, range_):
-                for ii in xrange(nkeep):
-                    newindex[ii] = index[keep[ii]]
-                result.add(newindex, value)
+            newkey = projection.project(dereference(it).first)
+            if newkey >= 0:
+                result.addkey(newkey, dereference(it).second)
             preincrement(it)
         return result
 
     def flatten(self):
         result = numpy.zeros(self.max_size())
+        if self._frozen:
+            result[self._keys] = self._values
+            return result
         for k, v in self._data:
             result[k] = v
         return result
 
-    def _within_range(self, vector[uint64_t] index, dict range_):
-        for k, v in range_.iteritems():
-            if not v[0] <= index[k] < v[1]:
-                return False
-        return  True        
+    def to_arrays(self):
+        """Return the entries as (keys, values) numpy arrays sorted by key.
+
+        The key of an entry is its position in flatten(). For a frozen array
+        the storage itself is returned without a copy (writing to values
+        modifies this array, keys must not be modified). Otherwise the
+        entries are copied once.
+        """
+        return self._sorted_storage()
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def to_indices(self):
+        """Return the entries as an (nentries, ndim) index matrix and values.
+        The values are the same array as returned by to_arrays. Axes of size
+        0 (broadcast) have index 0.
+        """
+        keys, values = self._sorted_storage()
+        cdef uint64_t[::1] kview = keys
+        cdef Py_ssize_t n = kview.shape[0]
+        cdef Py_ssize_t ndim = self._shape.size()
+        cdef numpy.ndarray indices = numpy.zeros((n, ndim), dtype=numpy.uint64)
+        cdef uint64_t[:, ::1] iview = indices
+        cdef Py_ssize_t ii, d
+        cdef uint64_t scale, size
+        for d in range(ndim):
+            scale = self._dimscale[d]
+            size = self._shape[d]
+            if size == 0:
+                continue
+            with nogil:
+                for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                    iview[ii, d] = (kview[ii] / scale) % size
+        return indices, values
+
+    def to_scipy(self, format="csr"):
+        """Return a 2D array as a scipy.sparse matrix ("coo" or "csr" format).
+        Higher dimensional arrays should be projected to 2D first.
+        """
+        import scipy.sparse
+        if self._shape.size() != 2:
+            raise ValueError("to_scipy requires a 2D array", self.shape())
+        indices, values = self.to_indices()
+        shape = tuple(max(s, 1) for s in self._shape)
+        result = scipy.sparse.coo_matrix((values, (indices[:, 0], indices[:, 1])), shape=shape)
+        return result.asformat(format)
+
+    @staticmethod
+    def from_arrays(shape, keys, values):
+        """Create a frozen array from keys (see to_arrays) and values.
+
+        Duplicate keys are summed. If the keys are already sorted and unique
+        (e.g. from to_arrays) the arrays are used as the storage without a
+        copy.
+        """
+        cdef SparseArray result = SparseArray(shape)
+        keys = numpy.asarray(keys, dtype=numpy.uint64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not (keys.ndim == 1 and values.shape == keys.shape):
+            raise ValueError("from_arrays expects one value per key", keys.shape, values.shape)
+        if keys.shape[0] > 0 and keys.max() >= result.max_size():
+            raise IndexError("key out of bounds", keys.max(), result.max_size())
+        if not numpy.all(keys[1:] > keys[:-1]):
+            order = numpy.argsort(keys, kind="mergesort")
+            keys = keys[order]
+            values = values[order]
+            first = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+            keys = keys[first]
+            values = numpy.add.reduceat(values, first)
+        result._setstorage(keys, values)
+        return result
+
+    @staticmethod
+    def from_indices(shape, indices, values):
+        """Create a frozen array from an (nentries, ndim) index matrix and
+        values (see to_indices). Duplicate indices are summed.
+        """
+        cdef SparseArray result = SparseArray(shape)
+        indices = numpy.asarray(indices, dtype=numpy.uint64)
+        if not (indices.ndim == 2 and indices.shape[1] == result._shape.size()):
+            raise ValueError("from_indices expects an (nentries, ndim) index matrix", indices.shape, result.shape())
+        upper = numpy.array([s if s > 0 else 1 for s in result._shape], dtype=numpy.uint64)
+        if numpy.any(indices >= upper):
+            raise IndexError("index out of bounds", result.shape())
+        keys = numpy.dot(indices, numpy.array(result._dimscale, dtype=numpy.uint64))
+        return SparseArray.from_arrays(shape, keys, values)
+
+    @staticmethod
+    def from_scipy(matrix):
+        """Create a frozen 2D array from a scipy.sparse matrix."""
+        coo = matrix.tocoo()
+        indices = numpy.column_stack((coo.row, coo.col))
+        return SparseArray.from_indices(list(coo.shape), indices, coo.data)
 
     @cython.profile(PROFILE_FLAG)
     cdef int _check_shape(self, rhs):
-        cdef vector[uint64_t] ls = self.shape()
-        cdef vector[uint64_t] rs = rhs.shape()
-        if vector_content_identical(ls, rs):
+        cdef SparseArray r = rhs
+        if vector_content_identical(self._shape, r._shape):
             return SHAPE_IS_IDENTICAL
-        if not _compatible_shape(ls, rs):
+        if not _compatible_shape(self._shape, r._shape):
             raise Exception("Arrays have incompatible shape")
         return SHAPE_IS_COMPATIBLE
 
     @cython.profile(PROFILE_FLAG)
     def __mul__(lhs, rhs):
         # implement result = lhs * rhs
+        if isinstance(lhs, SparseExpression) or isinstance(rhs, SparseExpression):
+            return NotImplemented
         if isinstance(lhs, float):
             lhs = _makescalar(lhs, rhs.shape())
-        #convert to SparseArray
-        cdef SparseArray l = lhs
-        cdef SparseArray r = rhs
-        cdef int mode = l._check_shape(r)
-        if mode == SHAPE_IS_IDENTICAL:
-            return _multiply_identical_shape_array_with_copy(l, r)
-        else:
-            return _multiply_array_with_copy(lhs, rhs)
+        if isinstance(rhs, float):
+            rhs = _makescalar(rhs, lhs.shape())
+        return _binary_op_with_copy(lhs, rhs, _OP_MUL)
+
+    @cython.profile(PROFILE_FLAG)
+    def __add__(lhs, rhs):
+        if isinstance(lhs, SparseExpression) or isinstance(rhs, SparseExpression):
+            return NotImplemented
+        return _binary_op_with_copy(lhs, rhs, _OP_ADD)
+
+    @cython.profile(PROFILE_FLAG)
+    def __sub__(lhs, rhs):
+        if isinstance(lhs, SparseExpression) or isinstance(rhs, SparseExpression):
+            return NotImplemented
+        return _binary_op_with_copy(lhs, rhs, _OP_SUB)
 
     @cython.profile(PROFILE_FLAG)
-    def __add__(SparseArray lhs, SparseArray rhs):
-        if not lhs.shape() == rhs.shape():
-            raise Exception("cannot __add__, incompatible shape.")
-        return _add_array_with_copy(lhs, rhs)
+    def __div__(lhs, rhs):
+        # implement result = lhs / rhs, zero where rhs is zero
+        if isinstance(lhs, SparseExpression) or isinstance(rhs, SparseExpression):
+            return NotImplemented
+        return _binary_op_with_copy(lhs, rhs, _OP_DIV)
 
     @cython.profile(PROFILE_FLAG)
-    def __sub__(SparseArray lhs, SparseArray rhs):
-        if not lhs.shape() == rhs.shape():
-            raise Exception("cannot __add__, incompatible shape.")
-        return _subtract_array_with_copy(lhs, rhs)
+    def __truediv__(lhs, rhs):
+        if isinstance(lhs, SparseExpression) or isinstance(rhs, SparseExpression):
+            return NotImplemented
+        return _binary_op_with_copy(lhs, rhs, _OP_DIV)
 
     @cython.profile(PROFILE_FLAG)
     def __imul__(SparseArray self, SparseArray rhs):
         # implement: lhs *= rhs
-        cdef int mode = rhs._check_shape(self) # intentionally the opposite order to __mul__
-        if mode == SHAPE_IS_IDENTICAL:
-            return _multiply_identical_shape_array_inplace(self, rhs)
-        else:
-            return _multiply_array_inplace(self, rhs)
+        return _binary_op_inplace(self, rhs, _OP_MUL)
 
     @cython.profile(PROFILE_FLAG)
-    def __div__(SparseArray self, SparseArray rhs):
-        # implement result = lhs / rhs
-        self._check_shape(rhs)
-        return self._divide_array_with_copy(rhs)
+    def __iadd__(SparseArray self, SparseArray rhs):
+        return _binary_op_inplace(self, rhs, _OP_ADD)
+
+    @cython.profile(PROFILE_FLAG)
+    def __isub__(SparseArray self, SparseArray rhs):
+        return _binary_op_inplace(self, rhs, _OP_SUB)
 
     @cython.profile(PROFILE_FLAG)
     def __idiv__(SparseArray self, SparseArray rhs):
-        # implement: lhs /= rhs
-        rhs._check_shape(self) # intentionally the opposite order to __mul__
-        return self._divide_array_inplace(rhs)
-        
-    def _divide_array_with_copy(self, SparseArray rhs):
-        result = SparseArray(rhs.shape())
-        cdef double x = 0.0
-        for index, value in rhs:
-            if value != 0:
-                x = self[index] / value
-            else:
-                x = 0
-            result.set(index, x)
-        return result
+        # implement: lhs /= rhs, zero where rhs is zero
+        return _binary_op_inplace(self, rhs, _OP_DIV)
 
-    def _divide_array_inplace(self, SparseArray rhs):
-        cdef double x = 0.0
-        for index, value in self:
-            if value != 0:
-                x = rhs[index] / value
-            else:
-                x = 0.0
-            self.set(index, x)
-        return self
+    @cython.profile(PROFILE_FLAG)
+    def __itruediv__(SparseArray self, SparseArray rhs):
+        return _binary_op_inplace(self, rhs, _OP_DIV)
+
+    def lazy(self):
+        """Return a SparseExpression of this array (see SparseExpression)."""
+        return SparseExpression(self)
+
+    def multiply(self, SparseArray rhs, SparseArray out=None):
+        """Return self * rhs.
+        If out is given, the result is written into it and out is returned. No
+        memory is allocated if out already has the sparsity pattern of the
+        result, e.g. when it is reused between repeated evaluations.
+        """
+        return _binary_op_with_copy(self, rhs, _OP_MUL, out)
 
     def __reduce__(self):
-        dictit = iter(self)
-        constructor = SparseArray
-        args = (list(self._shape),)
-        return (constructor, args, None, None, dictit)
+        # pickled as the sorted key and value arrays, which are stored as raw
+        # buffers. Unpickled arrays are frozen.
+        keys, values = self._sorted_storage()
+        constructor = _unpickle_sparsearray
+        args = (list(self._shape), keys, values)
+        return (constructor, args)
 
     def clone(self):
+        if self._frozen:
+            return self._frozen_like(numpy.copy(self._values))
         ret = SparseArray(self._shape)
         cdef SparseArrayIterator it = self._data.begin()
         cdef SparseArrayIterator end = self._data.end()
@@ -278,104 +615,312 @@ cdef class SparseArray:
             preincrement(it)
         return ret
 
-@cython.profile(PROFILE_FLAG)
-cdef SparseArray _multiply_array_with_copy(SparseArray lhs, SparseArray rhs):
-        cdef SparseArray result = SparseArray(rhs.shape())
-        cdef SparseArrayIterator it = rhs._data.begin()
-        cdef SparseArrayIterator end = rhs._data.end()
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = rhs.decodekey(key)
-            x = lhs.get(index) * dereference(it).second
-            result.set(index, x)
-            preincrement(it)
-        return result
+# Binary operators.
+#
+# All operators work directly on keys. When both operands have the same shape
+# the keys are used as they are. When one operand is broadcast along some
+# axes (size 0) the keys of the full operand are mapped onto the broadcast
+# operand with integer arithmetic (see _reducekey).
+#
+# Result patterns:
+#   lhs * rhs, lhs / rhs : pattern of rhs (or of the non-broadcast operand)
+#   lhs + rhs, lhs - rhs : union of both patterns (or the non-broadcast operand)
+#   in-place operators   : pattern of lhs (new keys are only added by += and -=)
 
 @cython.profile(PROFILE_FLAG)
-cdef SparseArray _multiply_identical_shape_array_with_copy(SparseArray lhs, SparseArray rhs):
-        cdef SparseArray result = SparseArray(rhs.shape())
-        cdef SparseArrayIterator it = rhs._data.begin()
-        cdef SparseArrayIterator end = rhs._data.end()
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            x = lhs._data[key] * dereference(it).second
-            result._data[key] = x
-            preincrement(it)
-        return result
+cdef SparseArray _binary_op_with_copy(SparseArray lhs, SparseArray rhs, int op, SparseArray out=None):
+    if vector_content_identical(lhs._shape, rhs._shape):
+        if op == _OP_ADD or op == _OP_SUB:
+            return _union_op(lhs, rhs, op, out)
+        return _pattern_op(rhs, lhs, op, False, out)
+    if _compatible_shape(lhs._shape, rhs._shape):
+        return _pattern_op(rhs, lhs, op, False, out)
+    if _compatible_shape(rhs._shape, lhs._shape):
+        return _pattern_op(lhs, rhs, op, True, out)
+    raise Exception("Arrays have incompatible shape", lhs.shape(), rhs.shape())
 
 @cython.profile(PROFILE_FLAG)
-cdef SparseArray _multiply_array_inplace(SparseArray lhs, SparseArray rhs):
-        cdef SparseArrayIterator it = lhs._data.begin()
-        cdef SparseArrayIterator end = lhs._data.end()
-        cdef uint64_t key;
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = rhs.decodekey(key)
-            x = rhs.get(index) * dereference(it).second
-            lhs.set(index, x)
-            preincrement(it)
-        return lhs
+cdef SparseArray _binary_op_inplace(SparseArray lhs, SparseArray rhs, int op):
+    cdef double scale
+    if vector_content_identical(lhs._shape, rhs._shape):
+        if op == _OP_ADD or op == _OP_SUB:
+            scale = -1.0 if op == _OP_SUB else 1.0
+            if same_pattern(lhs, rhs):
+                if op == _OP_ADD:
+                    numpy.add(lhs._values, rhs._values, out=lhs._values)
+                else:
+                    numpy.subtract(lhs._values, rhs._values, out=lhs._values)
+            else:
+                _accumulate(lhs, rhs, scale)
+            return lhs
+        return _pattern_op(lhs, rhs, op, True, lhs)
+    if _compatible_shape(rhs._shape, lhs._shape):
+        return _pattern_op(lhs, rhs, op, True, lhs)
+    raise Exception("Arrays have incompatible shape", lhs.shape(), rhs.shape())
 
 @cython.profile(PROFILE_FLAG)
-cdef SparseArray _multiply_identical_shape_array_inplace(SparseArray lhs, SparseArray rhs):
-        cdef SparseArrayIterator it = lhs._data.begin()
-        cdef SparseArrayIterator end = lhs._data.end()
-        cdef uint64_t key;
-        cdef double x = 0.0
-        while it != end:
-            key = dereference(it).first
-            x = rhs._data[key] * dereference(it).second
-            lhs._data[key] = x
-            preincrement(it)
-        return lhs
+cdef SparseArray _pattern_op(SparseArray pattern, SparseArray other, int op, bint patternisleft, SparseArray out):
+    # Evaluate op at every entry of pattern, other is looked up by key. The
+    # result is written into out (a new array if out is None, in-place if out
+    # is pattern).
+    if out is None:
+        out = SparseArray(pattern._shape)
+    else:
+        _check_output(out, pattern._shape)
+        if out is other and not (out is pattern or same_pattern(out, pattern)):
+            #out is overwritten before other is read
+            out._assign(_pattern_op(pattern, other, op, patternisleft, None))
+            return out
+    cdef bint reduce = not vector_content_identical(pattern._shape, other._shape)
+    cdef vector[uint64_t] scale, size, target
+    if reduce:
+        _reduction(pattern, other, scale, size, target)
+    cdef double* optr
+    cdef double* ovptr
+    cdef double* pvptr
+    cdef double value, othervalue
+    cdef uint64_t key
+    cdef Py_ssize_t ii
+    cdef Py_ssize_t n = pattern._nfrozen
+    cdef numpy.ndarray table
+    cdef Py_ssize_t* tptr = NULL
+    cdef SparseArrayIterator it, end
+    if pattern._frozen:
+        pattern._pattern_into(out)
+        optr = out._vptr
+        pvptr = pattern._vptr
+        if not reduce and same_pattern(pattern, other):
+            ovptr = other._vptr
+            with nogil:
+                if patternisleft:
+                    for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                        optr[ii] = _apply_op(op, pvptr[ii], ovptr[ii])
+                else:
+                    for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                        optr[ii] = _apply_op(op, ovptr[ii], pvptr[ii])
+        elif other._frozen:
+            if _use_lookup_table(other, n):
+                table = _lookup_table(other)
+                tptr = <Py_ssize_t*> table.data
+            with nogil:
+                _lookup_op(op, patternisleft, n, pattern._kptr, pvptr, optr, other._kptr, other._vptr, other._nfrozen, tptr, reduce, scale, size, target)
+        else:
+            for ii in xrange(n):
+                key = pattern._kptr[ii]
+                if reduce:
+                    key = _reducekey(key, scale, size, target)
+                othervalue = other.getkey(key)
+                if patternisleft:
+                    optr[ii] = _apply_op(op, pvptr[ii], othervalue)
+                else:
+                    optr[ii] = _apply_op(op, othervalue, pvptr[ii])
+        return out
+    cdef bint inplace = out is pattern
+    if not inplace:
+        out._reset()
+    it = pattern._data.begin()
+    end = pattern._data.end()
+    while it != end:
+        key = dereference(it).first
+        value = dereference(it).second
+        if reduce:
+            othervalue = other.getkey(_reducekey(key, scale, size, target))
+        else:
+            othervalue = other.getkey(key)
+        if patternisleft:
+            value = _apply_op(op, value, othervalue)
+        else:
+            value = _apply_op(op, othervalue, value)
+        if inplace:
+            dereference(it).second = value
+        else:
+            out._data[key] = value
+        preincrement(it)
+    return out
+
+cdef void _lookup_op(int op, bint patternisleft, Py_ssize_t n, uint64_t* keys, double* values, double* out,
+                     uint64_t* okeys, double* ovalues, Py_ssize_t on, Py_ssize_t* otable,
+                     bint reduce, vector[uint64_t]& scale, vector[uint64_t]& size, vector[uint64_t]& target) nogil:
+    # out[i] = values[i] op other[keys[i]] where other is a frozen array,
+    # looked up with its dense position table if otable is not NULL.
+    cdef Py_ssize_t ii, pos
+    cdef uint64_t key
+    cdef double othervalue
+    for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+        key = keys[ii]
+        if reduce:
+            key = _reducekey(key, scale, size, target)
+        if otable != NULL:
+            pos = otable[key]
+        else:
+            pos = _searchsorted(okeys, on, key)
+            if not (pos < on and okeys[pos] == key):
+                pos = -1
+        if pos >= 0:
+            othervalue = ovalues[pos]
+        else:
+            othervalue = 0.0
+        if patternisleft:
+            out[ii] = _apply_op(op, values[ii], othervalue)
+        else:
+            out[ii] = _apply_op(op, othervalue, values[ii])
+    return
 
 @cython.profile(PROFILE_FLAG)
-cdef SparseArray _add_array_with_copy(SparseArray lhs, SparseArray rhs):
-        cdef SparseArray result = SparseArray(rhs.shape())
-        cdef SparseArrayIterator it = rhs._data.begin()
-        cdef SparseArrayIterator end = rhs._data.end()
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = rhs.decodekey(key)
-            result.add(index, rhs.get(index))
-            preincrement(it)
-        it = lhs._data.begin()
-        end = lhs._data.end()
-        while it != end:
-            key = dereference(it).first
-            index = lhs.decodekey(key)
-            result.add(index, lhs.get(index))
-            preincrement(it)
+cdef SparseArray _union_op(SparseArray lhs, SparseArray rhs, int op, SparseArray out):
+    # lhs +/- rhs for identically shaped arrays
+    cdef double scale = -1.0 if op == _OP_SUB else 1.0
+    cdef SparseArray result
+    if same_pattern(lhs, rhs):
+        if out is None:
+            out = SparseArray(rhs._shape)
+        else:
+            _check_output(out, rhs._shape)
+        rhs._pattern_into(out)
+        if op == _OP_ADD:
+            numpy.add(lhs._values, rhs._values, out=out._values)
+        else:
+            numpy.subtract(lhs._values, rhs._values, out=out._values)
+        return out
+    if lhs._frozen and rhs._frozen:
+        result = _merge_frozen(lhs, rhs, scale)
+    else:
+        result = SparseArray(rhs._shape)
+        _accumulate(result, rhs, scale)
+        _accumulate(result, lhs, 1.0)
+    if out is None:
         return result
+    _check_output(out, rhs._shape)
+    out._assign(result)
+    return out
+
+cdef _check_output(SparseArray out, vector[uint64_t] shape):
+    if not vector_content_identical(out._shape, shape):
+        raise ValueError("SparseArray output buffer has the wrong shape", out.shape(), shape)
+    return
 
 @cython.profile(PROFILE_FLAG)
-cdef SparseArray _subtract_array_with_copy(SparseArray lhs, SparseArray rhs):
-        cdef SparseArray result = SparseArray(rhs.shape())
-        cdef SparseArrayIterator it = rhs._data.begin()
-        cdef SparseArrayIterator end = rhs._data.end()
-        cdef double x = 0.0
-        cdef vector[uint64_t] index
-        while it != end:
-            key = dereference(it).first
-            index = rhs.decodekey(key)
-            result.add(index, -1.0 * rhs.get(index))
-            preincrement(it)
-        it = lhs._data.begin()
-        end = lhs._data.end()
+cdef SparseArray _merge_frozen(SparseArray lhs, SparseArray rhs, double scale):
+    # lhs + scale * rhs as a single merge of the sorted keys
+    cdef Py_ssize_t nl = lhs._nfrozen
+    cdef Py_ssize_t nr = rhs._nfrozen
+    cdef numpy.ndarray[numpy.uint64_t, ndim=1] keys = numpy.empty(nl + nr, dtype=numpy.uint64)
+    cdef numpy.ndarray[numpy.float64_t, ndim=1] values = numpy.empty(nl + nr, dtype=numpy.float64)
+    cdef uint64_t* kout = <uint64_t*> keys.data
+    cdef double* vout = <double*> values.data
+    cdef Py_ssize_t ii = 0, jj = 0, n = 0
+    cdef uint64_t lkey, rkey
+    while ii < nl and jj < nr:
+        lkey = lhs._kptr[ii]
+        rkey = rhs._kptr[jj]
+        if lkey < rkey:
+            kout[n] = lkey
+            vout[n] = lhs._vptr[ii]
+            ii += 1
+        elif rkey < lkey:
+            kout[n] = rkey
+            vout[n] = scale * rhs._vptr[jj]
+            jj += 1
+        else:
+            kout[n] = lkey
+            vout[n] = lhs._vptr[ii] + scale * rhs._vptr[jj]
+            ii += 1
+            jj += 1
+        n += 1
+    while ii < nl:
+        kout[n] = lhs._kptr[ii]
+        vout[n] = lhs._vptr[ii]
+        ii += 1
+        n += 1
+    while jj < nr:
+        kout[n] = rhs._kptr[jj]
+        vout[n] = scale * rhs._vptr[jj]
+        jj += 1
+        n += 1
+    cdef SparseArray result = SparseArray(rhs._shape)
+    if n < nl + nr:
+        result._setstorage(keys[:n].copy(), values[:n].copy())
+    else:
+        result._setstorage(keys, values)
+    return result
+
+cdef void _accumulate(SparseArray result, SparseArray arr, double scale):
+        # result += scale * arr, both arrays must have identical shape
+        cdef Py_ssize_t ii
+        if arr._frozen:
+            for ii in xrange(arr._nfrozen):
+                result.addkey(arr._kptr[ii], scale * arr._vptr[ii])
+            return
+        cdef SparseArrayIterator it = arr._data.begin()
+        cdef SparseArrayIterator end = arr._data.end()
         while it != end:
-            key = dereference(it).first
-            index = lhs.decodekey(key)
-            result.add(index, lhs.get(index))
+            result.addkey(dereference(it).first, scale * dereference(it).second)
             preincrement(it)
-        return result
+        return
+
+cdef bint _use_lookup_table(SparseArray arr, Py_ssize_t nlookups):
+    # a dense position table is used for lookups into small frozen arrays
+    # (typically arrays broadcast along most axes)
+    cdef uint64_t size = 1
+    cdef size_t d
+    if not arr._frozen:
+        return False
+    for d in range(arr._shape.size()):
+        if arr._shape[d] > 0:
+            size *= arr._shape[d]
+    return size <= _LOOKUP_TABLE_RATIO * (<uint64_t> nlookups)
+
+cdef numpy.ndarray _lookup_table(SparseArray arr):
+    # table[key] is the position of key in the frozen storage or -1
+    cdef numpy.ndarray table = numpy.empty(arr.max_size(), dtype=numpy.intp)
+    table.fill(-1)
+    table[arr._keys.astype(numpy.intp)] = numpy.arange(arr._nfrozen, dtype=numpy.intp)
+    return table
+
+cdef inline double _apply_op(int op, double lhs, double rhs) nogil:
+    if op == _OP_MUL:
+        return lhs * rhs
+    elif op == _OP_DIV:
+        if rhs != 0.0:
+            return lhs / rhs
+        return 0.0
+    elif op == _OP_ADD:
+        return lhs + rhs
+    return lhs - rhs
+
+cdef void _reduction(SparseArray full, SparseArray reduced, vector[uint64_t]& scale, vector[uint64_t]& size, vector[uint64_t]& target):
+    # Per-axis terms used by _reducekey to map keys of full onto keys of
+    # reduced, where reduced is broadcast (size 0) along some of the axes.
+    # Axes that are adjacent in both arrays are merged into one term and the
+    # outermost axis needs no modulo (size 0).
+    cdef size_t d, n
+    cdef uint64_t total = 1
+    for d in range(full._shape.size()):
+        if full._shape[d] > 0:
+            total *= full._shape[d]
+        if reduced._dimscale[d] > 0:
+            n = scale.size()
+            if n > 0 and scale[n - 1] * size[n - 1] == full._dimscale[d] and target[n - 1] * size[n - 1] == reduced._dimscale[d]:
+                size[n - 1] *= full._shape[d]
+            else:
+                scale.push_back(full._dimscale[d])
+                size.push_back(full._shape[d])
+                target.push_back(reduced._dimscale[d])
+    n = scale.size()
+    if n > 0 and scale[n - 1] * size[n - 1] == total:
+        size[n - 1] = 0
+    return
+
+@cython.cdivision(True)
+cdef inline uint64_t _reducekey(uint64_t key, vector[uint64_t]& scale, vector[uint64_t]& size, vector[uint64_t]& target) nogil:
+    cdef uint64_t result = 0
+    cdef size_t d
+    for d in range(scale.size()):
+        if size[d] > 0:
+            result += ((key / scale[d]) % size[d]) * target[d]
+        else:
+            result += (key / scale[d]) * target[d]
+    return result
 
 def _makescalar(val, shape):
     s = [0 for s in shape]
@@ -403,6 +948,472 @@ def _makescalar(val, shape):
 #            return dereference(it).second
 
 ###############################################################################
+
+cdef class SparseExpression:
+    """Lazily evaluated arithmetic expression of SparseArrays.
+
+    Create one with SparseArray.lazy() and combine it with +, -, * and / with
+    other expressions, SparseArrays or floats. Nothing is calculated until
+    evaluate() is called, which makes a single pass over the sparsity pattern
+    of the result with no temporary arrays. The result (shape, pattern and
+    broadcasting) is the same as for the equivalent SparseArray operators.
+    """
+
+    def __init__(self, SparseArray arr):
+        self._op = _OP_LEAF
+        self._arr = arr
+        self._shape = arr._shape
+        self._isconst = False
+
+    def shape(self):
+        return self._shape
+
+    def __mul__(lhs, rhs):
+        return _expression(_OP_MUL, lhs, rhs)
+
+    def __div__(lhs, rhs):
+        return _expression(_OP_DIV, lhs, rhs)
+
+    def __truediv__(lhs, rhs):
+        return _expression(_OP_DIV, lhs, rhs)
+
+    def __add__(lhs, rhs):
+        return _expression(_OP_ADD, lhs, rhs)
+
+    def __sub__(lhs, rhs):
+        return _expression(_OP_SUB, lhs, rhs)
+
+    def evaluate(self, SparseArray out=None):
+        """Calculate the expression.
+        If out is given, the result is written into it and out is returned.
+        All arrays in the expression are frozen (see SparseArray.freeze).
+        """
+        if self._isconst:
+            raise ValueError("SparseExpression contains no arrays")
+        cdef list leaves = []
+        cdef list program = []
+        self._compile(leaves, program)
+        for arr in leaves:
+            (<SparseArray> arr).freeze()
+        pattern = self._pattern()
+        cdef SparseArray result = out
+        cdef SparseArray source = None
+        if isinstance(pattern, SparseArray):
+            source = pattern
+        if out is None:
+            result = SparseArray(self._shape)
+        else:
+            _check_output(out, self._shape)
+            for arr in leaves:
+                if arr is out and not (source is not None and same_pattern(source, out)):
+                    #out is overwritten before it is read
+                    out._assign(self.evaluate())
+                    return out
+        if source is not None:
+            source._pattern_into(result)
+        else:
+            result._clearmap()
+            result._setstorage(pattern, numpy.empty(pattern.shape[0], dtype=numpy.float64))
+        _evaluate_program(result, source, leaves, program)
+        return result
+
+    cdef _compile(self, list leaves, list program):
+        # flatten the tree into a postfix program of (op, operand, patternmode)
+        cdef int mode
+        if self._op == _OP_LEAF:
+            program.append((_OP_LEAF, len(leaves), 0))
+            leaves.append(self._arr)
+        elif self._op == _OP_CONST:
+            program.append((_OP_CONST, self._value, 0))
+        else:
+            self._lhs._compile(leaves, program)
+            self._rhs._compile(leaves, program)
+            if self._lhs._isconst:
+                mode = _PATTERN_RHS
+            elif self._rhs._isconst:
+                mode = _PATTERN_LHS
+            else:
+                mode = self._patternmode()
+            program.append((self._op, 0, mode))
+        return
+
+    cdef int _patternmode(self):
+        # which operand the sparsity pattern of the result comes from
+        if vector_content_identical(self._lhs._shape, self._rhs._shape):
+            if self._op == _OP_ADD or self._op == _OP_SUB:
+                return _PATTERN_UNION
+            return _PATTERN_RHS
+        if _compatible_shape(self._lhs._shape, self._rhs._shape):
+            return _PATTERN_RHS
+        return _PATTERN_LHS
+
+    cdef object _pattern(self):
+        # the SparseArray whose sparsity pattern the result has, or the
+        # sorted keys of the result if it is not the pattern of one array.
+        # None for constants.
+        if self._op == _OP_LEAF:
+            return self._arr
+        elif self._op == _OP_CONST:
+            return None
+        lp = self._lhs._pattern()
+        rp = self._rhs._pattern()
+        if lp is None:
+            return rp
+        if rp is None:
+            return lp
+        cdef int mode = self._patternmode()
+        if mode == _PATTERN_LHS:
+            return lp
+        elif mode == _PATTERN_RHS:
+            return rp
+        if isinstance(lp, SparseArray) and isinstance(rp, SparseArray) and same_pattern(lp, rp):
+            return rp
+        return numpy.union1d(_patternkeys(lp), _patternkeys(rp))
+
+cdef object _patternkeys(pattern):
+    if isinstance(pattern, SparseArray):
+        return (<SparseArray> pattern)._keys
+    return pattern
+
+cdef SparseExpression _as_expression(x):
+    cdef SparseExpression result
+    if isinstance(x, SparseExpression):
+        return x
+    if isinstance(x, SparseArray):
+        return SparseExpression(x)
+    result = SparseExpression.__new__(SparseExpression)
+    result._op = _OP_CONST
+    result._value = x
+    result._isconst = True
+    return result
+
+cdef SparseExpression _expression(int op, lhs, rhs):
+    cdef SparseExpression l = _as_expression(lhs)
+    cdef SparseExpression r = _as_expression(rhs)
+    if l._isconst and r._isconst:
+        return _as_expression(_apply_op(op, l._value, r._value))
+    cdef SparseExpression result = SparseExpression.__new__(SparseExpression)
+    result._op = op
+    result._lhs = l
+    result._rhs = r
+    result._isconst = False
+    if l._isconst:
+        result._shape = r._shape
+    elif r._isconst:
+        result._shape = l._shape
+    elif _compatible_shape(l._shape, r._shape):
+        result._shape = r._shape
+    elif _compatible_shape(r._shape, l._shape):
+        result._shape = l._shape
+    else:
+        raise Exception("Arrays have incompatible shape", list(l._shape), list(r._shape))
+    return result
+
+@cython.profile(PROFILE_FLAG)
+cdef _evaluate_program(SparseArray result, SparseArray source, list leaves, list program):
+    # Run the postfix program for every entry of result (which already has
+    # the sparsity pattern of the result). The program is run on blocks of
+    # entries so that each instruction is a tight loop and the temporaries
+    # stay in cache. Leaves that share the pattern of the result are read
+    # directly, all others are looked up by key.
+    #
+    # Alongside each value the stack records whether the key is in the
+    # pattern of that sub-expression. As for the SparseArray operators, a
+    # sub-expression is zero outside of its pattern, which matters for
+    # broadcast + and -. For * and / the value is zero there anyway.
+    cdef Py_ssize_t nprogram = len(program)
+    cdef vector[int] ops
+    cdef vector[int] modes
+    cdef vector[Py_ssize_t] operands
+    cdef vector[double] constants
+    cdef vector[double] stack
+    cdef vector[char] present
+    cdef vector[bint] aligned
+    cdef vector[bint] reduce
+    cdef vector[uint64_t*] kptrs
+    cdef vector[Py_ssize_t*] tptrs
+    cdef list tables = []
+    cdef vector[double*] vptrs
+    cdef vector[Py_ssize_t] sizes
+    cdef vector[vector[uint64_t]] scales, shapes, targets
+    cdef vector[uint64_t] scale, size, target
+    cdef bint needpresence = False
+    cdef SparseArray arr
+    cdef SparseArray shaped = SparseArray(result._shape)
+    for a in leaves:
+        arr = a
+        reduce.push_back(not vector_content_identical(arr._shape, result._shape))
+        aligned.push_back(source is not None and not reduce.back() and same_pattern(source, arr))
+        kptrs.push_back(arr._kptr)
+        if not aligned.back() and _use_lookup_table(arr, result._nfrozen):
+            tables.append(_lookup_table(arr))
+            tptrs.push_back(<Py_ssize_t*> (<numpy.ndarray> tables[-1]).data)
+        else:
+            tptrs.push_back(NULL)
+        vptrs.push_back(arr._vptr)
+        sizes.push_back(arr._nfrozen)
+        scale.clear()
+        size.clear()
+        target.clear()
+        if reduce.back():
+            _reduction(shaped, arr, scale, size, target)
+        scales.push_back(scale)
+        shapes.push_back(size)
+        targets.push_back(target)
+    for op, operand, patternmode in program:
+        ops.push_back(op)
+        modes.push_back(patternmode)
+        if op == _OP_CONST:
+            operands.push_back(constants.size())
+            constants.push_back(operand)
+        else:
+            operands.push_back(operand)
+        if op == _OP_ADD or op == _OP_SUB:
+            needpresence = True
+    cdef Py_ssize_t start, nblock, ii, jj, ileaf, pos
+    cdef Py_ssize_t sp
+    cdef uint64_t key
+    cdef int code, mode
+    cdef double* v
+    cdef double* w
+    cdef char* p
+    cdef char* q
+    cdef double* lvptr
+    cdef uint64_t* lkptr
+    cdef Py_ssize_t* ltptr
+    cdef uint64_t* kptr = result._kptr
+    cdef double* optr = result._vptr
+    cdef Py_ssize_t n = result._nfrozen
+    cdef Py_ssize_t nblocks = (n + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+    cdef int nthreads = parallel_threads(n)
+    cdef Py_ssize_t iblock, stackstart
+    cdef Py_ssize_t stacksize = (nprogram + 1) * _BLOCK_SIZE
+    #one stack per thread
+    stack.resize(nthreads * stacksize)
+    present.resize(nthreads * stacksize)
+    with nogil:
+        for iblock in prange(nblocks, num_threads=nthreads, schedule="static"):
+            start = iblock * _BLOCK_SIZE
+            nblock = min(<Py_ssize_t> _BLOCK_SIZE, n - start)
+            stackstart = threadid() * stacksize
+            sp = 0
+            for jj in xrange(nprogram):
+                code = ops[jj]
+                v = &stack[stackstart + sp * _BLOCK_SIZE]
+                p = &present[stackstart + sp * _BLOCK_SIZE]
+                if code == _OP_LEAF:
+                    ileaf = operands[jj]
+                    lvptr = vptrs[ileaf]
+                    lkptr = kptrs[ileaf]
+                    ltptr = tptrs[ileaf]
+                    if aligned[ileaf]:
+                        for ii in xrange(nblock):
+                            v[ii] = lvptr[start + ii]
+                            p[ii] = True
+                    else:
+                        for ii in xrange(nblock):
+                            key = kptr[start + ii]
+                            if reduce[ileaf]:
+                                key = _reducekey(key, scales[ileaf], shapes[ileaf], targets[ileaf])
+                            if ltptr != NULL:
+                                pos = ltptr[key]
+                            else:
+                                pos = _searchsorted(lkptr, sizes[ileaf], key)
+                                if not (pos < sizes[ileaf] and lkptr[pos] == key):
+                                    pos = -1
+                            if pos >= 0:
+                                v[ii] = lvptr[pos]
+                                p[ii] = True
+                            else:
+                                v[ii] = 0.0
+                                p[ii] = False
+                    sp = sp + 1
+                elif code == _OP_CONST:
+                    for ii in xrange(nblock):
+                        v[ii] = constants[operands[jj]]
+                    sp = sp + 1
+                else:
+                    v = &stack[stackstart + (sp - 2) * _BLOCK_SIZE]
+                    w = &stack[stackstart + (sp - 1) * _BLOCK_SIZE]
+                    p = &present[stackstart + (sp - 2) * _BLOCK_SIZE]
+                    q = &present[stackstart + (sp - 1) * _BLOCK_SIZE]
+                    mode = modes[jj]
+                    if code == _OP_MUL:
+                        for ii in xrange(nblock):
+                            v[ii] = v[ii] * w[ii]
+                    elif code == _OP_DIV:
+                        for ii in xrange(nblock):
+                            v[ii] = _apply_op(_OP_DIV, v[ii], w[ii])
+                    else:
+                        for ii in xrange(nblock):
+                            v[ii] = _apply_op(code, v[ii], w[ii])
+                    if needpresence:
+                        if mode == _PATTERN_RHS:
+                            for ii in xrange(nblock):
+                                p[ii] = q[ii]
+                        elif mode == _PATTERN_UNION:
+                            for ii in xrange(nblock):
+                                p[ii] = p[ii] or q[ii]
+                        if code == _OP_ADD or code == _OP_SUB:
+                            for ii in xrange(nblock):
+                                if not p[ii]:
+                                    v[ii] = 0.0
+                    sp = sp - 1
+            for ii in xrange(nblock):
+                optr[start + ii] = stack[stackstart + ii]
+    return
+
+###############################################################################
+
+cdef class _KeyProjection:
+    # Maps the keys of an array onto the keys of its projection onto the
+    # axes in keep (with dimscale newdimscale), or -1 for keys outside
+    # range_. The bins inside range_ are precomputed as a mask per axis.
+    cdef vector[uint64_t] _scale
+    cdef vector[uint64_t] _size
+    cdef vector[uint64_t] _target
+    cdef vector[uint64_t] _rangescale
+    cdef vector[uint64_t] _rangesize
+    cdef vector[size_t] _maskoffset
+    cdef vector[char] _mask
+
+    def __cinit__(self, vector[uint64_t] shape, vector[uint64_t] dimscale, vector[uint64_t] keep, vector[uint64_t] newdimscale, dict range_):
+        cdef size_t jj
+        for jj in range(keep.size()):
+            self._push_axis(shape, dimscale, keep[jj], self._scale, self._size)
+            self._target.push_back(newdimscale[jj])
+        if range_:
+            for axis, (low, high) in range_.iteritems():
+                self._push_axis(shape, dimscale, axis, self._rangescale, self._rangesize)
+                self._maskoffset.push_back(self._mask.size())
+                for b in xrange(self._rangesize.back()):
+                    self._mask.push_back(low <= b < high)
+
+    cdef _push_axis(self, vector[uint64_t]& shape, vector[uint64_t]& dimscale, uint64_t axis, vector[uint64_t]& scale, vector[uint64_t]& size):
+        if shape.at(axis) > 0:
+            scale.push_back(dimscale[axis])
+            size.push_back(shape[axis])
+        else:
+            #broadcast axis, the bin is always 0
+            scale.push_back(1)
+            size.push_back(1)
+        return
+
+    @cython.cdivision(True)
+    cdef inline int64_t project(self, uint64_t key) nogil:
+        cdef size_t d
+        cdef uint64_t b
+        cdef uint64_t result = 0
+        for d in range(self._rangescale.size()):
+            b = (key / self._rangescale[d]) % self._rangesize[d]
+            if not self._mask[self._maskoffset[d] + b]:
+                return -1
+        for d in range(self._scale.size()):
+            result += ((key / self._scale[d]) % self._size[d]) * self._target[d]
+        return result
+
+cdef class ProjectionPlan:
+    """Precomputed projection of a frozen SparseArray onto a subset of its axes.
+
+    The destination bin of every stored entry is calculated once for a given
+    (shape, keep, range_) and sparsity pattern. Applying the plan is then a
+    single scatter-add of the values into a dense output vector. The plan is
+    rebuilt automatically if it is applied to an array with another pattern.
+    """
+
+    def __init__(self, vector[uint64_t] shape, vector[uint64_t] keep, dict range_=None):
+        self._shape = shape
+        self._keep = keep
+        self._range = range_
+        self._newshape = [shape[k] for k in keep]
+        cdef uint64_t cumprod = 1
+        for s in self._newshape:
+            if s > 0:
+                self._newdimscale.push_back(cumprod)
+                cumprod *= s
+            else:
+                self._newdimscale.push_back(0)
+        self._size = cumprod
+        self._keys = None
+        self._dest = None
+
+    def shape(self):
+        return self._newshape
+
+    def size(self):
+        return self._size
+
+    cdef _build(self, SparseArray arr):
+        cdef numpy.ndarray[numpy.intp_t, ndim=1] dest = numpy.empty(arr._nfrozen, dtype=numpy.intp)
+        cdef _KeyProjection projection = _KeyProjection(self._shape, arr._dimscale, self._keep, self._newdimscale, self._range)
+        cdef Py_ssize_t ii
+        for ii in xrange(arr._nfrozen):
+            #entries outside the requested range have destination -1
+            dest[ii] = projection.project(arr._kptr[ii])
+        self._keys = arr._keys
+        self._dest = dest
+        return
+
+    cdef _check_pattern(self, SparseArray arr):
+        if not vector_content_identical(self._shape, arr._shape):
+            raise ValueError("ProjectionPlan applied to an array with a different shape", list(self._shape), list(arr._shape))
+        if self._keys is arr._keys:
+            return
+        if self._keys is not None and self._keys.shape[0] == arr._nfrozen and numpy.array_equal(self._keys, arr._keys):
+            #same pattern in a different key array
+            self._keys = arr._keys
+            return
+        self._build(arr)
+        return
+
+    def __call__(self, SparseArray arr, numpy.ndarray out=None):
+        """Project arr and return the dense, flattened result.
+        If out is given, the result is written into it (it must be a float64
+        array with size() elements).
+        """
+        if out is None:
+            out = numpy.zeros(self._size, dtype=numpy.float64)
+        elif not (out.dtype == numpy.float64 and out.ndim == 1 and out.shape[0] == self._size):
+            raise ValueError("ProjectionPlan output buffer has the wrong size or type", numpy.shape(out), self._size)
+        else:
+            out.fill(0.0)
+        if not arr._frozen:
+            #no fixed pattern to plan for
+            out += arr.project(self._keep, range_=self._range).flatten()
+            return out
+        self._check_pattern(arr)
+        cdef Py_ssize_t n = arr._nfrozen
+        cdef Py_ssize_t size = self._size
+        cdef int nthreads = parallel_threads(n)
+        cdef numpy.ndarray partial
+        cdef double* result = <double*> out.data
+        cdef numpy.intp_t* dest = <numpy.intp_t*> self._dest.data
+        cdef double* vptr = arr._vptr
+        cdef numpy.intp_t position
+        cdef Py_ssize_t ii, ithread, start, stop
+        cdef Py_ssize_t chunk = (n + nthreads - 1) // nthreads
+        if nthreads == 1:
+            with nogil:
+                for ii in xrange(n):
+                    position = dest[ii]
+                    if position >= 0:
+                        result[position] += vptr[ii]
+            return out
+        #each thread scatters its share of the entries into its own output
+        partial = numpy.zeros((nthreads, size), dtype=numpy.float64)
+        result = <double*> partial.data
+        with nogil:
+            for ithread in prange(nthreads, num_threads=nthreads, schedule="static", chunksize=1):
+                start = ithread * chunk
+                stop = min(n, start + chunk)
+                for ii in xrange(start, stop):
+                    position = dest[ii]
+                    if position >= 0:
+                        result[ithread * size + position] += vptr[ii]
+        numpy.sum(partial, axis=0, out=out)
+        return out
+
+###############################################################################
         
 cdef class SparseHistogram:
     cdef SparseArray _arr
@@ -449,6 +1460,9 @@ cdef class SparseHistogram:
     def occupancy(self):
         return self._arr.occupancy()
 
+    def memory_usage(self):
+        return self._arr.memory_usage()
+
     def fill(self, coord, double weight=1.0):
         cdef vector[uint64_t] index = self._findindex(coord)
         if self._isoverflow(index):
@@ -457,6 +1471,76 @@ cdef class SparseHistogram:
             self._arr.add(index, weight)
         return
 
+    def fill_many(self, coords, weights=None):
+        """Fill many entries at once.
+
+        coords is an (nentries, ndim) array and weights an (nentries,) array
+        (1.0 for all entries if None). Equivalent to calling fill for each
+        row but the bin lookup and accumulation are done in one compiled loop.
+        As in fill, axes without a coordinate are filled in their first bin.
+        """
+        coords = numpy.ascontiguousarray(coords, dtype=numpy.float64)
+        if coords.ndim != 2 or coords.shape[1] > self._binning.size():
+            raise ValueError("fill_many expects an (nentries, ndim) array of coordinates", coords.shape, self._binning.size())
+        if weights is None:
+            weights = numpy.ones(coords.shape[0], dtype=numpy.float64)
+        weights = numpy.ascontiguousarray(weights, dtype=numpy.float64)
+        if not (weights.ndim == 1 and weights.shape[0] == coords.shape[0]):
+            raise ValueError("fill_many expects one weight per entry", weights.shape, coords.shape)
+        self._fill_many(coords, weights)
+        return
+
+    def bin_keys(self, coords):
+        """Keys of the bins that fill_many would fill for each row of the
+        (nentries, ndim) array coords. Entries with the same key can be
+        combined before filling them with fill_keys.
+        """
+        coords = numpy.ascontiguousarray(coords, dtype=numpy.float64)
+        if coords.ndim != 2 or coords.shape[1] > self._binning.size():
+            raise ValueError("bin_keys expects an (nentries, ndim) array of coordinates", coords.shape, self._binning.size())
+        cdef double[:, ::1] view = coords
+        cdef numpy.ndarray keys = numpy.empty(coords.shape[0], dtype=numpy.uint64)
+        cdef uint64_t[::1] kview = keys
+        cdef Py_ssize_t ii
+        for ii in xrange(view.shape[0]):
+            kview[ii] = self._coordkey(view, ii)
+        return keys
+
+    def fill_keys(self, keys, weights):
+        """Add weights to the bins with keys (from bin_keys)."""
+        cdef uint64_t[::1] kview = numpy.ascontiguousarray(keys, dtype=numpy.uint64)
+        cdef double[::1] wview = numpy.ascontiguousarray(weights, dtype=numpy.float64)
+        if kview.shape[0] != wview.shape[0]:
+            raise ValueError("fill_keys expects one weight per key", kview.shape[0], wview.shape[0])
+        cdef Py_ssize_t ii
+        for ii in xrange(kview.shape[0]):
+            self._arr.addkey(kview[ii], wview[ii])
+        return
+
+    cdef _fill_many(self, double[:, ::1] coords, double[::1] weights):
+        cdef SparseArray arr = self._arr
+        cdef Py_ssize_t ii
+        for ii in xrange(coords.shape[0]):
+            arr.addkey(self._coordkey(coords, ii), weights[ii])
+        return
+
+    cdef uint64_t _coordkey(self, double[:, ::1] coords, Py_ssize_t ii):
+        # key of the bin of row ii of coords, axes without a coordinate are
+        # in their first bin
+        cdef SparseArray arr = self._arr
+        cdef Py_ssize_t dim
+        cdef int i
+        cdef uint64_t key = 0
+        for dim in xrange(coords.shape[1]):
+            i = array_bisect_right(self._binning[dim], coords[ii, dim]) - 1
+            #under/overflow goes into the first/last bin as in _findindex
+            if i < 0:
+                i = 0
+            if i >= <int>arr._shape[dim]:
+                i = arr._shape[dim] - 1
+            key += (<uint64_t>i) * arr._dimscale[dim]
+        return key
+
     def eval(self, coord):
         index = self._findindex(coord)
         return self._arr.get(index)
@@ -501,7 +1585,10 @@ cdef class SparseHistogram:
     def project_1d(self, unsigned int axis, dict range_=None):
         if range_:
             range_ = self._convert_floatrange_to_binrange(range_)
-        binning, values = self._binning.at(axis), self._arr.project((axis,), range_=range_).flatten()
+        return self._histogram_1d(axis, self._arr.project((axis,), range_=range_).flatten())
+
+    def _histogram_1d(self, unsigned int axis, values):
+        binning = self._binning.at(axis)
         label = HistogramNDLabel(binning, label = self._label.label,
                                  axislabels=self._label.axislabels[axis],
                                  axisunits=self._label.axisunits[axis],
@@ -517,15 +1604,39 @@ cdef class SparseHistogram:
             result[axis] = (low, high)
         return result
 
+    def split_nd(self, list axes, unsigned int splitaxis):
+        """Project onto axes separately for each bin of splitaxis.
+
+        Returns a list with one SparseHistogram per bin of splitaxis. The
+        stored entries are read once: the histogram is projected onto axes
+        and splitaxis, and the (sorted) result is cut into slices.
+        """
+        if splitaxis >= self._arr._shape.size() or self._arr._shape[splitaxis] == 0:
+            raise ValueError("split_nd cannot split along a missing or broadcast axis", splitaxis, self._arr.shape())
+        cdef SparseArray projected = self._arr.project(axes + [splitaxis])
+        cdef uint64_t nsplit = self._arr._shape.at(splitaxis)
+        keys, values = projected.to_arrays()
+        #splitaxis is the outermost axis of the projection, so each slice is
+        #a contiguous range of keys
+        cdef uint64_t splitscale = projected._dimscale.back()
+        bins = keys // numpy.uint64(splitscale)
+        keys = keys - bins * numpy.uint64(splitscale)
+        bounds = numpy.searchsorted(bins, numpy.arange(nsplit + 1, dtype=numpy.uint64))
+        binning = [self._binning[k] for k in axes]
+        result = []
+        for ii in xrange(nsplit):
+            h = SparseHistogram(binning)
+            h._arr = SparseArray.from_arrays(h._arr.shape(), keys[bounds[ii]:bounds[ii + 1]], values[bounds[ii]:bounds[ii + 1]])
+            result.append(h)
+        return result
+
     def split_1d(self, unsigned int axis, unsigned int splitaxis, fmtlabel=None):
         histlist = []
-        for ii in xrange(len(self._binning[splitaxis]) - 1):
-            #create histogram from sub range
+        for ii, split in enumerate(self.split_nd([axis], splitaxis)):
+            h = self._histogram_1d(axis, split.array().flatten())
+            #determine label for histogram
             low = self._binning[splitaxis][ii]
             high = self._binning[splitaxis][ii+1]
-            range_ = {splitaxis:(low, high)}
-            h = self.project_1d(axis, range_=range_)
-            #determine label for histogram
             splitname = self._label.axislabels[splitaxis]
             splitunits = self._label.axisunits[splitaxis]
             binlabel = self._label.getbinlabel(ii, splitaxis)
@@ -540,6 +1651,27 @@ cdef class SparseHistogram:
             histlist.append(h)
         return histlist
 
+    def merge(self, SparseHistogram other):
+        """Add the contents of other to this histogram and return self.
+
+        Both histograms must have the same binning. The arrays are summed key
+        by key in compiled code, so histograms filled from separate parts of
+        a data set (e.g. in worker processes) can be combined cheaply.
+        """
+        if self._binning != other._binning:
+            raise ValueError("cannot merge histograms with different binning")
+        cdef SparseArray lhs = self._arr
+        cdef SparseArray rhs = other._arr
+        if lhs._frozen and rhs._frozen and not same_pattern(lhs, rhs):
+            self._arr = _merge_frozen(lhs, rhs, 1.0)
+        else:
+            _binary_op_inplace(lhs, rhs, _OP_ADD)
+        self._overflow += other._overflow
+        return self
+
+    def __iadd__(self, SparseHistogram other):
+        return self.merge(other)
+
     def __reduce__(self):
         constructor = _unpickle_sparsehistogram
         args = (self._binning, self._arr, self._overflow)
@@ -547,6 +1679,19 @@ cdef class SparseHistogram:
 
     def scale(self, float scale):
         cdef SparseArray rhs = self._arr
+        cdef SparseArray scaled
+        cdef Py_ssize_t ii
+        cdef Py_ssize_t n = rhs._nfrozen
+        cdef double* optr
+        cdef double* vptr = rhs._vptr
+        if rhs._frozen:
+            scaled = rhs._frozen_like(numpy.empty(n, dtype=numpy.float64))
+            optr = scaled._vptr
+            with nogil:
+                for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                    optr[ii] = vptr[ii] * scale
+            self._arr = scaled
+            return
         cdef SparseArray result = SparseArray(rhs.shape())
         cdef SparseArrayIterator it = rhs._data.begin()
         cdef SparseArrayIterator end = rhs._data.end()
@@ -564,6 +1709,11 @@ cdef class SparseHistogram:
         ret._arr = self._arr.clone()
         return ret
 
+def _unpickle_sparsearray(shape, keys, values):
+    cdef SparseArray arr = SparseArray(shape)
+    arr._setstorage(keys, values)
+    return arr
+
 def _unpickle_sparsehistogram(binning, arr, overflow):
     hist = SparseHistogram(binning)
     hist._arr = arr
@@ -584,25 +1734,118 @@ cdef int array_bisect_right(vector[double]& arr, double x):
     return lo
 
 @cython.profile(PROFILE_FLAG)
-cdef SparseArray sparse_array_interpolation(double f, SparseArray y0, SparseArray y1):
+cdef SparseArray sparse_array_interpolation(double f, SparseArray y0, SparseArray y1, SparseArray out=None):
+    # f*y1 + (1-f)*y0 with the sparsity pattern of y1, written into out if it is given.
     if not y1._check_shape(y0) == SHAPE_IS_IDENTICAL:
         raise Exception("ERROR interpolating between arrays with different shapes.")
-    cdef SparseArray result = SparseArray(y1.shape())
+    if out is None:
+        out = SparseArray(y1._shape)
+    else:
+        _check_output(out, y1._shape)
+        if out is y0 and not (out is y1 or same_pattern(out, y1)):
+            #out is overwritten before y0 is read
+            out._assign(sparse_array_interpolation(f, y0, y1))
+            return out
+    cdef double* optr
+    cdef double* v0ptr
+    cdef double* v1ptr
+    cdef uint64_t* k0ptr
+    cdef uint64_t* k1ptr
+    cdef Py_ssize_t ii
+    cdef Py_ssize_t n = y1._nfrozen
+    cdef Py_ssize_t n0 = y0._nfrozen
+    if y1._frozen:
+        y1._pattern_into(out)
+        optr = out._vptr
+        v1ptr = y1._vptr
+        k1ptr = y1._kptr
+        v0ptr = y0._vptr
+        k0ptr = y0._kptr
+        if same_pattern(y0, y1):
+            with nogil:
+                for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                    optr[ii] = f*v1ptr[ii] + (1.0-f)*v0ptr[ii]
+        elif y0._frozen:
+            with nogil:
+                for ii in prange(n, num_threads=parallel_threads(n), schedule="static"):
+                    optr[ii] = f*v1ptr[ii] + (1.0-f)*frozen_value(k0ptr, v0ptr, n0, k1ptr[ii])
+        else:
+            for ii in xrange(n):
+                optr[ii] = f*v1ptr[ii] + (1.0-f)*y0.getkey(k1ptr[ii])
+        return out
+    cdef bint inplace = out is y1
+    if not inplace:
+        out._reset()
     cdef SparseArrayIterator it = y1._data.begin()
     cdef SparseArrayIterator end = y1._data.end()
     cdef double v1, v0, v
-    cdef vector[uint64_t] index
     cdef uint64_t key
     while it != end:
         key = dereference(it).first
         v1 = dereference(it).second
-        v0 = y0._data[key]
+        v0 = y0.getkey(key)
         v = f*v1 + (1.0-f)*v0
-        result._data[key] = v
+        if inplace:
+            dereference(it).second = v
+        else:
+            out._data[key] = v
         preincrement(it)
-    return result
+    return out
+
+cdef bint same_pattern(SparseArray lhs, SparseArray rhs):
+    """True if both arrays are frozen with the same keys.
+    Callers are responsible for checking that the shapes are identical.
+    """
+    if not (lhs._frozen and rhs._frozen):
+        return False
+    if lhs._keys is rhs._keys:
+        return True
+    if lhs._nfrozen != rhs._nfrozen:
+        return False
+    if lhs._nfrozen > 0 and memcmp(lhs._kptr, rhs._kptr, lhs._nfrozen * sizeof(uint64_t)) != 0:
+        return False
+    #share one key array so that the next comparison is an identity check
+    rhs._keys = lhs._keys
+    rhs._kptr = lhs._kptr
+    return True
+
+def share_patterns(arrays):
+    """Freeze the arrays and let arrays with identical keys share one key
+    array. Histograms filled from the same events (e.g. one per systematic
+    knot) then only store their own values.
+    """
+    cdef SparseArray arr, other
+    cdef list distinct = []
+    for arr in arrays:
+        arr.freeze()
+        for other in distinct:
+            if vector_content_identical(arr._shape, other._shape) and same_pattern(other, arr):
+                break
+        else:
+            distinct.append(arr)
+    return
+
+cdef double frozen_value(uint64_t* keys, double* values, Py_ssize_t n, uint64_t key) nogil:
+    # value of key in frozen storage, zero if it is not present
+    cdef Py_ssize_t pos = _searchsorted(keys, n, key)
+    if pos < n and keys[pos] == key:
+        return values[pos]
+    return 0.0
+
+cdef inline Py_ssize_t _searchsorted(uint64_t* keys, Py_ssize_t n, uint64_t key) nogil:
+    # index of the first element of the sorted keys that is >= key
+    cdef Py_ssize_t lo = 0
+    cdef Py_ssize_t hi = n
+    cdef Py_ssize_t mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if keys[mid] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
-cdef vector_content_identical(vector[uint64_t]& lhs, vector[uint64_t]& rhs):
+cdef bint vector_content_identical(vector[uint64_t]& lhs, vector[uint64_t]& rhs):
     if lhs.size() != rhs.size():
         return False
     for ii in xrange(lhs.size()):
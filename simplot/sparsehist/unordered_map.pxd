@@ -64,5 +64,6 @@ cdef extern from "<unordered_map>" namespace "std" nogil:
         void max_load_factor(float)
         float max_load_factor()
         void rehash(size_t)
+        void reserve(size_t)
         size_t bucket_count()
         size_t max_bucket_count()
@@ -1,19 +1,30 @@
 
 import itertools
 import math
+import os
 import random
+import shutil
 import string
+import tempfile
 import unittest
 
 import numpy as np
+import scipy.interpolate
 
 from simplot.mc.montecarlo import ToyMC
 from simplot.mc.statistics import Mean, StandardDeviation, calculate_statistics_from_toymc
 from simplot.mc.likelihood import EventRateLikelihood, SumLikelihood
 from simplot.mc.generators import GaussianGenerator, GeneratorList
 from simplot.mc.priors import GaussianPrior, CombinedPrior, OscillationParametersPrior
-from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample
+from simplot.binnedmodel.sample import Sample, BinnedSample, BinnedSampleWithOscillation, CombinedBinnedSample, EventColumns
 from simplot.binnedmodel.systematics import Systematics, SplineSystematics, FluxSystematics, FluxAndSplineSystematics
+from simplot.binnedmodel.dependencies import ParameterDependencies, parameter_indices
+from simplot.binnedmodel.xsecweights import XsecWeights, StackedXsecWeights, InterpolatedWeightCalc, SimpleInterpolatedWeightCalc, spline_coefficients
+from simplot.sparsehist import SparseArray, SparseHistogram
+from simplot.binnedmodel.model import BinnedModel, ProbabilityCache, shared_probability_cache, clear_shared_probability_caches
+from simplot.binnedmodel.vacuumprob import VacuumProbability
+from simplot.binnedmodel.probabilitygrid import ProbabilityGrid
+from simplot.pdg import PdgNeutrinoOscillationParameters
 
 ################################################################################
 
@@ -26,6 +37,389 @@ class TestSystematics(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             syst(None, None, None)
 
+    def test_flux_jacobian(self):
+        binning = [np.linspace(0.0, 5.0, num=11), np.arange(0.0, 5.0), np.linspace(0.0, 5.0, num=3), [0.0, 1.0, 2.0]]
+        flux_error_binning = [((b, f), bb, fb, [0.0, 2.5, 5.0]) for bb, b in enumerate(["RHC", "FHC"]) for fb, f in enumerate(["numu", "nue", "numubar", "nuebar"])]
+        systematics = FluxSystematics(0, 1, 3, FluxSystematics.make_flux_parameter_map(binning[0], flux_error_binning))
+        parnames = systematics.parameter_names
+        _, _, weights = systematics(parnames, None, SparseHistogram(binning))
+        pars = np.random.RandomState(1244).uniform(0.5, 1.5, size=len(parnames))
+        #before the weights are evaluated
+        jacobian = weights.jacobian(pars).toarray()
+        values = np.array(weights(pars).to_arrays()[1])
+        self.assertEquals(jacobian.shape, (len(values), len(parnames)))
+        self.assertTrue(np.array_equal(jacobian.sum(axis=1), np.ones(len(values))))
+        self.assertTrue(np.array_equal(jacobian.dot(pars), values))
+
+################################################################################
+
+class TestXsecWeights(unittest.TestCase):
+    def _array(self, rng, shape, density):
+        arr = SparseArray(shape)
+        for index in itertools.product(*[xrange(s) for s in shape]):
+            if rng.uniform() < density:
+                arr[index] = rng.uniform(0.5, 1.5)
+        return arr
+
+    def test_stacked(self):
+        rng = np.random.RandomState(1228)
+        shape = [7, 4, 5]
+        parnames = ["a", "b", "c", "d"]
+        nominal = self._array(rng, shape, 0.6)
+        def build(kind):
+            calcs = []
+            for parname, knots in [("a", [-1.0, 0.0, 1.0]), ("b", [-2.0, -1.0, 0.0, 1.0, 2.0]), ("d", [0.0]), ("c", [0.0, 1.0])]:
+                #some of the knot arrays are missing bins of the nominal array
+                arrays = [self._array(np.random.RandomState(len(knots) + ii), shape, 0.7) for ii in xrange(len(knots))]
+                calcs.append(InterpolatedWeightCalc(nominal, knots, arrays, parname, parnames, kind=kind if parname != "a" else "linear"))
+            return calcs
+        for kind in ["linear", "natural", "monotone"]:
+            stacked = StackedXsecWeights(nominal, build(kind))
+            reference = XsecWeights(nominal, build(kind))
+            self.assertEquals(stacked.parameter_indices(), [0, 1, 2, 3])
+            for pars in [[0.0, 0.0, 0.0, 0.0], [0.3, -1.5, 0.5, 2.0], [-3.0, 3.0, 1.0, -1.0], [1.0, -2.0, 0.25, 0.0], [1.0, -2.0, 0.25, 0.0]]:
+                pars = np.array(pars)
+                expected = reference(pars)
+                result = stacked(pars)
+                for index in itertools.product(*[xrange(s) for s in shape]):
+                    if expected[index] != 0.0 or kind == "linear":
+                        self.assertAlmostEquals(result[index], expected[index], places=12)
+            #derivatives away from the knots
+            pars = np.array([0.3, -1.5, 0.5, 2.0])
+            jacobian = stacked.jacobian(pars).toarray()
+            values = lambda p: np.array(stacked(p).to_arrays()[1])
+            for ipar in xrange(len(pars)):
+                up, down = np.copy(pars), np.copy(pars)
+                up[ipar] += 1e-6
+                down[ipar] -= 1e-6
+                self.assertTrue(np.allclose(jacobian[:, ipar], (values(up) - values(down)) / 2e-6, rtol=0.0, atol=1e-6))
+            #one sided slopes on the end knots (d has a single knot)
+            pars = np.array([-1.0, 2.0, 1.0, 0.0])
+            jacobian = stacked.jacobian(pars).toarray()
+            for ipar, step in enumerate([1e-6, -1e-6, -1e-6, 1e-6]):
+                shifted = np.copy(pars)
+                shifted[ipar] += step
+                self.assertTrue(np.allclose(jacobian[:, ipar], (values(shifted) - values(pars)) / step, rtol=1e-5, atol=1e-5))
+        return
+
+    def test_owned_results(self):
+        #results of consecutive calls do not share their values
+        nominal = SparseArray([3])
+        for ii in xrange(3):
+            nominal[(ii,)] = 1.0
+        arrays = [nominal * 0.5, nominal * 1.0, nominal * 2.0]
+        for kind in ["linear", "natural"]:
+            wc = InterpolatedWeightCalc(nominal, [-1.0, 0.0, 1.0], arrays, "a", ["a"], kind=kind)
+            weights = XsecWeights(nominal, [InterpolatedWeightCalc(nominal, [-1.0, 0.0, 1.0], arrays, "a", ["a"], kind=kind)])
+            stacked = StackedXsecWeights(nominal, [InterpolatedWeightCalc(nominal, [-1.0, 0.0, 1.0], arrays, "a", ["a"], kind=kind)])
+            for func in [wc, weights, stacked]:
+                a = func([0.5])
+                expected = np.array(a.to_arrays()[1])
+                b = func([-0.5])
+                self.assertFalse(a is b)
+                self.assertTrue(np.array_equal(a.to_arrays()[1], expected))
+                self.assertFalse(np.array_equal(b.to_arrays()[1], expected))
+        return
+
+    def _evaluate(self, coefficients, xvec, x):
+        i = np.clip(np.searchsorted(xvec, x, side="right") - 1, 0, len(coefficients) - 1)
+        t = x - xvec[i]
+        c = coefficients[i]
+        return ((c[3]*t + c[2])*t + c[1])*t + c[0]
+
+    def test_spline_coefficients(self):
+        xvec = np.array([-3.0, -1.0, 0.0, 0.5, 2.0])
+        yvalues = np.array([[0.2, 0.5, 1.0, 1.1, 1.9], [1.5, 1.2, 1.0, 1.3, 0.4]]).T
+        references = {"linear": lambda y: scipy.interpolate.interp1d(xvec, y),
+                      "natural": lambda y: scipy.interpolate.CubicSpline(xvec, y, bc_type="natural"),
+                      "monotone": lambda y: scipy.interpolate.PchipInterpolator(xvec, y),
+        }
+        for kind, reference in references.iteritems():
+            coefficients = spline_coefficients(xvec, yvalues, kind)
+            self.assertEquals(coefficients.shape, (4, 4, 2))
+            for ibin in xrange(2):
+                for x in np.linspace(-3.0, 2.0, num=41):
+                    self.assertAlmostEquals(self._evaluate(coefficients[..., ibin], xvec, x), float(reference(yvalues[:, ibin])(x)))
+        #the monotone spline does not overshoot monotonic knots
+        x = np.linspace(-3.0, 2.0, num=401)
+        values = np.array([self._evaluate(spline_coefficients(xvec, yvalues, "monotone")[..., 0], xvec, v) for v in x])
+        self.assertTrue(np.all(np.diff(values) >= 0.0))
+        with self.assertRaises(ValueError):
+            spline_coefficients(xvec, yvalues, "quadratic")
+        return
+
+    def test_spline_weights(self):
+        rng = np.random.RandomState(1229)
+        shape = [6, 5]
+        nominal = self._array(rng, shape, 1.0)
+        knots = [-2.0, -1.0, 0.0, 1.0, 2.0]
+        arrays = [self._array(rng, shape, 1.0) for _ in knots]
+        nominalvalues = np.array([nominal[index] for index in itertools.product(*[xrange(s) for s in shape])])
+        dense = [np.array([arr[index] for index in itertools.product(*[xrange(s) for s in shape])]) for arr in arrays]
+        for kind in ["linear", "natural", "monotone"]:
+            calc = InterpolatedWeightCalc(nominal, knots, arrays, "a", ["a"], kind=kind)
+            simple = SimpleInterpolatedWeightCalc(nominalvalues, knots, dense, "a", ["a"], kind=kind)
+            xs = [-3.0, -2.0, -1.5, -1.0, 0.3, 1.7, 2.0, 2.5]
+            batch = simple.eval_batch(np.array(xs)[:, np.newaxis])
+            for row, x in enumerate(xs):
+                calc.update([x])
+                simple.update([x])
+                weights = np.array([calc.array()[index] for index in itertools.product(*[xrange(s) for s in shape])])
+                self.assertTrue(np.allclose(weights, simple.array(), rtol=0.0, atol=1e-12))
+                self.assertTrue(np.allclose(batch[row], simple.array(), rtol=0.0, atol=1e-12))
+                #derivative
+                derivative = calc.derivative([x])
+                derivative = np.array([derivative[index] for index in itertools.product(*[xrange(s) for s in shape])])
+                self.assertTrue(np.allclose(derivative, simple.derivative([x]), rtol=0.0, atol=1e-12))
+                if -2.0 < x < 2.0 and x not in knots:
+                    eps = 1e-6
+                    simple.update([x + eps])
+                    up = np.array(simple.array())
+                    simple.update([x - eps])
+                    down = np.array(simple.array())
+                    self.assertTrue(np.allclose(derivative, (up - down) / (2.0 * eps), rtol=0.0, atol=1e-6))
+                elif x in (-2.0, 2.0):
+                    #one sided slope on the end knots
+                    eps = 1e-6 if x == -2.0 else -1e-6
+                    simple.update([x + eps])
+                    shifted = np.array(simple.array())
+                    simple.update([x])
+                    self.assertTrue(np.allclose(derivative, (shifted - np.array(simple.array())) / eps, rtol=0.0, atol=1e-5))
+                    self.assertTrue(np.any(derivative != 0.0))
+                else:
+                    self.assertTrue(np.all(derivative == 0.0) or -2.0 < x < 2.0)
+        return
+
+################################################################################
+
+class TestParameterDependencies(unittest.TestCase):
+    def test_changed(self):
+        deps = ParameterDependencies([[0], [1, 2], [], None])
+        self.assertEquals(deps.parameter_indices(), None)
+        self.assertEquals(ParameterDependencies([[0], [1, 2], []]).parameter_indices(), [0, 1, 2])
+        self.assertEquals(list(deps.changed([0.0, 0.0, 0.0])), [True] * 4)
+        self.assertEquals(list(deps.changed([0.0, 0.0, 0.0])), [False, False, False, True])
+        self.assertEquals(list(deps.changed([0.0, 0.0, 1.0])), [False, True, False, True])
+        self.assertEquals(list(deps.changed([1.0, 0.0, 1.0])), [True, False, False, True])
+        deps.reset()
+        self.assertEquals(list(deps.changed([1.0, 0.0, 1.0])), [True] * 4)
+        return
+
+    def test_parameter_indices(self):
+        self.assertEquals(parameter_indices(None), [])
+        self.assertEquals(parameter_indices(object()), None)
+        return
+
+################################################################################
+
+class TestProbabilityCache(unittest.TestCase):
+    def test_lru(self):
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        prob = ProbabilityCache(parnames, np.linspace(0.1, 5.0, num=11), [295.0], probabilitycalc=_TwoFlavourProbability(), cachesize=2)
+        points = [np.array([0.3, 0.5, 0.02, 0.0, 7.5e-5, ldm]) for ldm in [2.4e-3, 2.5e-3, 2.6e-3]]
+        expected = []
+        for pars in points:
+            prob.update(pars)
+            expected.append(np.copy(prob.array))
+        self.assertEquals((prob.hits, prob.misses), (0, 3))
+        #the last two are cached, the first has been removed
+        for index, hits, misses in [(1, 1, 3), (2, 2, 3), (0, 2, 4), (1, 2, 5), (0, 3, 5)]:
+            prob.update(points[index])
+            self.assertTrue(np.array_equal(prob.array, expected[index]))
+            self.assertEquals((prob.hits, prob.misses), (hits, misses))
+        prob.clear()
+        self.assertEquals((prob.hits, prob.misses), (0, 0))
+        with self.assertRaises(ValueError):
+            ProbabilityCache(parnames, np.linspace(0.1, 5.0, num=11), [295.0], probabilitycalc=_TwoFlavourProbability(), cachesize=0)
+        return
+
+    def test_derivatives(self):
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        prob = ProbabilityCache(parnames, np.linspace(0.1, 5.0, num=11), [0.0, 295.0], probabilitycalc=VacuumProbability(), cachesize=2)
+        other = np.array([0.3, 0.5, 0.02, 0.0, 7.5e-5, 2.5e-3])
+        pars = np.array([0.3, 0.5, 0.02, 1.0, 7.5e-5, 2.4e-3])
+        prob.update(other)
+        prob.update(pars)
+        table = np.copy(prob.array)
+        derivatives = prob.derivatives(pars)
+        #the shifted tables do not go through the cache
+        self.assertEquals((prob.hits, prob.misses), (0, 2))
+        self.assertTrue(np.array_equal(prob.array, table))
+        prob.update(other)
+        self.assertEquals((prob.hits, prob.misses), (1, 2))
+        exact = ProbabilityCache(parnames, np.linspace(0.1, 5.0, num=11), [0.0, 295.0], probabilitycalc=VacuumProbability())
+        for ii, index in enumerate(prob.parameter_indices()):
+            step = 1e-5 * pars[index]
+            shifted = [np.copy(pars) for _ in xrange(2)]
+            shifted[0][index] += step
+            shifted[1][index] -= step
+            up, down = [np.copy(exact.update(p) or exact.array) for p in shifted]
+            self.assertTrue(np.allclose(derivatives[ii], (up - down) / (2.0 * step), rtol=1e-4, atol=1e-6))
+        return
+
+    def test_shared(self):
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        calc = VacuumProbability()
+        enubinning = np.linspace(0.1, 5.0, num=11)
+        prob = shared_probability_cache(parnames, enubinning, [295.0], probabilitycalc=calc)
+        self.assertIs(shared_probability_cache(parnames + ["x"], list(enubinning), [295.0], probabilitycalc=calc), prob)
+        for other in [shared_probability_cache(["x"] + parnames, enubinning, [295.0], probabilitycalc=calc),
+                      shared_probability_cache(parnames, enubinning, [810.0], probabilitycalc=calc),
+                      shared_probability_cache(parnames, np.linspace(0.1, 5.0, num=12), [295.0], probabilitycalc=calc),
+                      shared_probability_cache(parnames, enubinning, [295.0], probabilitycalc=VacuumProbability()),
+        ]:
+            self.assertIsNot(other, prob)
+        clear_shared_probability_caches()
+        self.assertIsNot(shared_probability_cache(parnames, enubinning, [295.0], probabilitycalc=calc), prob)
+        return
+
+################################################################################
+
+class TestVacuumProbability(unittest.TestCase):
+    def _calc(self, pars=(0.59, 0.78, 0.15, 1.2, 7.5e-5, 2.5e-3)):
+        prob = VacuumProbability()
+        prob.setAll(*pars)
+        prob.update()
+        return prob
+
+    def _table(self, prob, energies, baselines, cp):
+        out = np.zeros((len(energies), len(baselines), 3, 3))
+        prob.fillProbabilityTable(energies, len(energies), baselines, len(baselines), cp, out)
+        return out
+
+    def test_unitarity(self):
+        prob = self._calc()
+        for cp in [1, -1]:
+            table = self._table(prob, np.linspace(0.1, 5.0, num=20), np.array([295.0, 810.0]), cp)
+            self.assertTrue(np.allclose(table.sum(axis=2), 1.0))
+            self.assertTrue(np.allclose(table.sum(axis=3), 1.0))
+        return
+
+    def test_two_flavour_limit(self):
+        theta23, ldm, baseline = 0.7, 2.5e-3, 295.0
+        prob = self._calc((0.0, theta23, 0.0, 0.0, 0.0, ldm))
+        prob.setBaseline(baseline)
+        for enu in np.linspace(0.1, 5.0, num=20):
+            expected = 1.0 - math.sin(2.0 * theta23) ** 2 * math.sin(1.267 * ldm * baseline / enu) ** 2
+            self.assertAlmostEqual(prob.getVacuumProbability(2, 2, enu, 1), expected)
+            self.assertAlmostEqual(prob.getVacuumProbability(1, 1, enu, 1), 1.0)
+        return
+
+    def test_table(self):
+        prob = self._calc()
+        energies = np.linspace(0.1, 5.0, num=20)
+        baselines = np.array([295.0, 810.0])
+        for cp in [1, -1]:
+            table = self._table(prob, energies, baselines, cp)
+            for (ienu, enu), (ibase, baseline), init, final in itertools.product(enumerate(energies), enumerate(baselines), [1, 2, 3], [1, 2, 3]):
+                prob.setBaseline(baseline)
+                self.assertEquals(table[ienu, ibase, init - 1, final - 1], prob.getVacuumProbability(init, final, enu, cp))
+        #CPT: P(nu_mu -> nu_e) = P(antinu_e -> antinu_mu)
+        self.assertTrue(np.allclose(self._table(prob, energies, baselines, 1)[:, :, 1, 0], self._table(prob, energies, baselines, -1)[:, :, 0, 1]))
+        with self.assertRaises(ValueError):
+            prob.getVacuumProbability(4, 1, 1.0, 1)
+        with self.assertRaises(ValueError):
+            prob.fillProbabilityTable(energies, len(energies), baselines, len(baselines), 1, np.zeros((len(energies), 1, 3, 3)))
+        return
+
+    def test_probability_cache(self):
+        #the vectorized table must agree with the per-energy calls
+        class _ScalarOnly(object):
+            def __init__(self):
+                self._prob = VacuumProbability()
+            def __getattr__(self, name):
+                if name == "fillProbabilityTable":
+                    raise AttributeError(name)
+                return getattr(self._prob, name)
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        pars = np.array([0.3, 0.5, 0.02, 1.0, 7.5e-5, 2.5e-3])
+        enubinning = np.linspace(0.1, 5.0, num=11)
+        vectorized = ProbabilityCache(parnames, enubinning, [0.0, 295.0], probabilitycalc=VacuumProbability())
+        scalar = ProbabilityCache(parnames, enubinning, [0.0, 295.0], probabilitycalc=_ScalarOnly())
+        vectorized.update(pars)
+        scalar.update(pars)
+        self.assertTrue(np.array_equal(vectorized.array, scalar.array))
+        return
+
+################################################################################
+
+class TestProbabilityGrid(unittest.TestCase):
+    def _grid(self, order=1, **kwargs):
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        axes = [("ldm", np.linspace(2.2e-3, 2.6e-3, num=9)),
+                ("deltacp", np.linspace(-math.pi, math.pi, num=9)),
+                ("sinsqtheta23", np.linspace(0.4, 0.6, num=5)),
+                ("sinsqtheta13", np.linspace(0.02, 0.03, num=5)),
+        ]
+        fixed = {"sinsqtheta12": 0.3, "sdm": 7.5e-5}
+        return ProbabilityGrid(parnames, np.linspace(0.2, 3.0, num=11), [0.0, 295.0], axes, fixed, VacuumProbability(), order=order, seed=1227, nprocesses=2, **kwargs)
+
+    def _exact(self, pars):
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        prob = ProbabilityCache(parnames, np.linspace(0.2, 3.0, num=11), [0.0, 295.0], probabilitycalc=VacuumProbability())
+        prob.update(pars)
+        return prob
+
+    def test_interpolate(self):
+        for order, tolerance in [(1, 0.05), (3, 0.01)]:
+            grid = self._grid(order)
+            self.assertTrue(0.0 < grid.error_bound < tolerance)
+            #exact at the grid points
+            node = np.array([0.3, grid.axes[2][1], grid.axes[3][2], grid.axes[1][3], 7.5e-5, grid.axes[0][4]])
+            self.assertTrue(np.allclose(grid.interpolate(node), self._exact(node).oscillating_entries(), rtol=0.0, atol=1e-12))
+            pars = np.array([0.3, 0.47, 0.023, 0.4, 7.5e-5, 2.43e-3])
+            self.assertTrue(np.allclose(grid.interpolate(pars), self._exact(pars).oscillating_entries(), rtol=0.0, atol=grid.error_bound * 2.0))
+            #not covered
+            self.assertIsNone(grid.interpolate(np.array([0.3, 0.7, 0.023, 0.4, 7.5e-5, 2.43e-3])))
+            self.assertIsNone(grid.interpolate(np.array([0.31, 0.47, 0.023, 0.4, 7.5e-5, 2.43e-3])))
+        return
+
+    def test_probability_cache(self):
+        grid = self._grid()
+        parnames = list(PdgNeutrinoOscillationParameters.ALL_PARS_SINSQ)
+        prob = ProbabilityCache(parnames, np.linspace(0.2, 3.0, num=11), [0.0, 295.0], probabilitycalc=VacuumProbability(), grid=grid)
+        for pars in [np.array([0.3, 0.47, 0.023, 0.4, 7.5e-5, 2.43e-3]), np.array([0.3, 0.7, 0.023, 0.4, 7.5e-5, 2.43e-3])]:
+            prob.update(pars)
+            exact = self._exact(pars)
+            self.assertTrue(np.allclose(prob.array, exact.array, rtol=0.0, atol=grid.error_bound * 2.0))
+            #the zero baseline bin is not oscillated
+            self.assertTrue(np.array_equal(prob.array[:, 0], exact.array[:, 0]))
+        with self.assertRaises(ValueError):
+            ProbabilityCache(parnames, np.linspace(0.2, 3.0, num=12), [0.0, 295.0], probabilitycalc=VacuumProbability(), grid=grid)
+        return
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            grid = self._grid(cache_name="testgrid", cache_dir=cache_dir)
+            reloaded = self._grid(cache_name="testgrid", cache_dir=cache_dir)
+            self.assertEquals(len(os.listdir(cache_dir)), 1)
+            self.assertTrue(np.array_equal(grid.values, reloaded.values))
+            self.assertEquals(grid.error_bound, reloaded.error_bound)
+        finally:
+            shutil.rmtree(cache_dir)
+        return
+
+################################################################################
+
+class _TwoFlavourProbability(object):
+    """Simple stand-in for the prob3++ calculator."""
+    def setAll(self, *pars):
+        self._pars = pars
+
+    def update(self):
+        return
+
+    def setBaseline(self, baseline):
+        self._baseline = baseline
+
+    def getVacuumProbability(self, initflav, finalflav, enu, cp):
+        theta12, theta23, theta13, dcp, sdm, ldm = self._pars
+        x = math.sin(1.27 * ldm * self._baseline / enu) ** 2
+        if initflav == finalflav:
+            return 1.0 - math.sin(2.0 * theta23) ** 2 * x
+        return 0.5 * math.sin(2.0 * theta13) ** 2 * math.sin(theta23) ** 2 * x * (1.0 + 0.1 * cp)
+
 ################################################################################
 
 class TestModel(unittest.TestCase):
@@ -51,6 +445,246 @@ class TestModel(unittest.TestCase):
                 self.assertAlmostEquals(xi1, xi2)
         return
 
+    def test_parallel_fill(self):
+        random = np.random.RandomState(1230)
+        #enough events for several chunks
+        events = [(c, 1.0, [(-4.0, w, 5.0)]) for c, w in zip(random.poisson(size=(250000, 2)).tolist(), random.uniform(0.5, 1.5, size=250000).tolist())]
+        binning = [("a", np.arange(0.0, 10.0)), ("b", np.arange(0.0, 10.0))]
+        systematics = SplineSystematics([("x", [-5.0, 0.0, 5.0])])
+        serial = BinnedSample("serial", binning, ["a"], events, systematics=systematics, nprocesses=1)
+        parallel = BinnedSample("parallel", binning, ["a"], events, systematics=systematics, nprocesses=3)
+        for pars in [[-3.0], [0.0], [2.0]]:
+            for x1, x2 in itertools.izip_longest(serial(pars), parallel(pars)):
+                self.assertAlmostEquals(x1, x2)
+        with self.assertRaises(ValueError):
+            BinnedSample("none", binning, ["a"], events, nprocesses=0)
+        return
+
+    def test_shared_cache_flux_change(self):
+        random = np.random.RandomState(1240)
+        n = 2000
+        trueenu = random.uniform(0.0, 5.0, size=n)
+        coords = np.column_stack([trueenu, random.uniform(0.0, 4.0, size=n), random.normal(1.0, 0.1, size=n) * trueenu, random.randint(2, size=n)])
+        columns = EventColumns(coords, random.uniform(0.2, 1.0, size=n), noselweight=np.ones(n))
+        binning = [("trueenu", np.linspace(0.0, 5.0, num=11)), ("nupdg", np.arange(0.0, 5.0)), ("recoenu", np.linspace(0.0, 5.0, num=12)), ("beammode", [0.0, 1.0, 2.0])]
+        flux_error_binning = [((b, f), bb, fb, [0.0, 2.5, 5.0]) for bb, b in enumerate(["RHC", "FHC"]) for fb, f in enumerate(["numu", "nue", "numubar", "nuebar"])]
+        systematics = FluxSystematics(0, 1, 3, FluxSystematics.make_flux_parameter_map(binning[0][1], flux_error_binning))
+        def build(calc):
+            return BinnedSampleWithOscillation("shared", binning, ["recoenu"], columns, enuaxis="trueenu", flavaxis="nupdg", beammodeaxis="beammode", distance=295.0,
+                                               systematics=systematics, probabilitycalc=calc)
+        calc = _TwoFlavourProbability()
+        first, second = build(calc), build(calc)
+        self.assertIs(first._model.probability_cache, second._model.probability_cache)
+        #a sample with its own cache as the reference
+        reference = build(_TwoFlavourProbability())
+        generator = OscillationParametersPrior(seed=1241).generator
+        pars1, pars2 = [np.array([oscpars.get(name, 1.0) for name in first.parameter_names]) for oscpars in
+                        [dict(zip(generator.parameter_names, generator())) for _ in xrange(2)]]
+        first(pars1)
+        second(pars2)
+        #only the flux parameters of the first sample change
+        isflux = np.array([name in systematics.parameter_names for name in first.parameter_names])
+        pars1[isflux] = random.normal(1.0, 0.1, size=np.sum(isflux))
+        self.assertTrue(np.allclose(first(pars1), reference(pars1), rtol=1e-12, atol=0.0))
+        second(pars2)
+        self.assertTrue(np.allclose(first.jacobian(pars1), reference.jacobian(pars1), rtol=1e-9, atol=0.0))
+        clear_shared_probability_caches()
+        return
+
+    def test_fresh_weight_arrays(self):
+        random = np.random.RandomState(1242)
+        hist = SparseHistogram([np.arange(0.0, 11.0), np.arange(0.0, 6.0)])
+        hist.fill_many(random.uniform(0.0, 10.0, size=(500, 2)) * [1.0, 0.5], np.ones(500))
+        shape = hist.array().shape()
+        indices = np.array(list(itertools.product(xrange(10), xrange(5))))
+        class FreshWeights(object):
+            #a new array on each call, with every other bin missing for negative pars[1]
+            def __call__(self, pars):
+                rows = indices if pars[1] >= 0.0 else indices[::2]
+                return SparseArray.from_indices(shape, rows, pars[0] * (1.0 + rows[:, 0]))
+        model = BinnedModel(["a", "b"], hist, [0], xsec_weights=FreshWeights(), engine="compare")
+        #raises if the dense and sparse evaluation differ
+        for pars in random.normal(1.0, 1.0, size=(20, 2)):
+            model(pars)
+        return
+
+    def test_shared_weights(self):
+        random = np.random.RandomState(1243)
+        hist = SparseHistogram([np.arange(0.0, 8.0), np.arange(0.0, 5.0)])
+        hist.fill_many(random.uniform(0.0, 7.0, size=(500, 2)) * [1.0, 4.0 / 7.0], np.ones(500))
+        nominal = hist.array().freeze()
+        shape = nominal.shape()
+        keys, values = nominal.to_arrays()
+        arrays = [SparseArray.from_arrays(shape, keys, values * random.uniform(0.5, 1.5, size=len(values))) for _ in xrange(3)]
+        parnames = ["a", "b"]
+        def xsecweights():
+            return StackedXsecWeights(nominal, [InterpolatedWeightCalc(nominal, [-1.0, 0.0, 1.0], arrays, "a", parnames)])
+        class ScaleWeights(object):
+            def parameter_indices(self):
+                return [1]
+            def __call__(self, pars):
+                return SparseArray.from_arrays(shape, keys, np.full(len(keys), pars[1]))
+        #StackedXsecWeights returns the same buffer on each call
+        shared = xsecweights()
+        first, second = [BinnedModel(parnames, hist, [0], flux_weights=ScaleWeights(), xsec_weights=shared) for _ in xrange(2)]
+        reference = BinnedModel(parnames, hist, [0], flux_weights=ScaleWeights(), xsec_weights=xsecweights())
+        pars = np.array([0.5, 1.0])
+        first.observable_array(pars)
+        second.observable_array(np.array([-0.5, 1.0]))
+        #only the parameter of the stage before the shared weights changes
+        pars[1] = 2.0
+        self.assertTrue(np.allclose(first.observable_array(pars), reference.observable_array(pars), rtol=1e-12, atol=0.0))
+        return
+
+    def test_columnar_fill(self):
+        random = np.random.RandomState(1238)
+        n = 5000
+        trueenu = random.uniform(0.0, 5.0, size=n)
+        coords = np.column_stack([trueenu, random.uniform(0.0, 4.0, size=n), random.normal(1.0, 0.1, size=n) * trueenu])
+        selweight = np.where(random.uniform(size=n) < 0.2, 0.0, random.uniform(0.2, 1.0, size=n))
+        noselweight = random.uniform(0.5, 1.5, size=n)
+        #the second systematic has fewer knots, the extra value is ignored
+        systweight = random.normal(1.0, 0.1, size=(n, 2, 3))
+        events = [(c, s, nw, [tuple(w[0]), tuple(w[1][:2])]) for c, s, nw, w in zip(coords.tolist(), selweight, noselweight, systweight.tolist())]
+        binning = [("trueenu", np.linspace(0.0, 5.0, num=11)), ("nupdg", np.arange(0.0, 5.0)), ("recoenu", np.linspace(0.0, 5.0, num=12))]
+        systematics = SplineSystematics([("x", [-5.0, 0.0, 5.0]), ("y", [-5.0, 5.0])])
+        columns = EventColumns(coords, selweight, systweight, noselweight)
+        samples = []
+        for data in [[(c, s, w) for c, s, _, w in events], EventColumns(coords, selweight, systweight)]:
+            samples.append(BinnedSample("columns", binning, ["recoenu"], data, systematics=systematics, nprocesses=1))
+        for data in [events, columns]:
+            samples.append(BinnedSampleWithOscillation("columns", binning, ["recoenu"], data, enuaxis="trueenu", flavaxis="nupdg", distance=295.0,
+                                                       systematics=systematics, probabilitycalc=_TwoFlavourProbability(), nprocesses=1))
+        for tuples, cols in [samples[:2], samples[2:]]:
+            for x in [0.0, -3.0, 2.0]:
+                pars = np.array([1.0] * (len(tuples.parameter_names) - 2) + [x, -x])
+                self.assertTrue(np.allclose(tuples(pars), cols(pars), rtol=1e-12, atol=0.0))
+        with self.assertRaises(ValueError):
+            EventColumns(coords, selweight[1:])
+        with self.assertRaises(ValueError):
+            BinnedSample("columns", binning, ["recoenu"], EventColumns(coords, selweight, systweight[:, :1]), systematics=systematics)
+        with self.assertRaises(ValueError):
+            BinnedSampleWithOscillation("columns", binning, ["recoenu"], EventColumns(coords, selweight, systweight), enuaxis="trueenu", flavaxis="nupdg", distance=295.0,
+                                        systematics=systematics, probabilitycalc=_TwoFlavourProbability())
+        return
+
+    def test_cache_key(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            random = np.random.RandomState(1239)
+            coords = random.uniform(0.0, 10.0, size=(1000, 2))
+            columns = EventColumns(coords, np.ones(len(coords)), random.normal(1.0, 0.1, size=(1000, 1, 3)))
+            inputfile = os.path.join(cache_dir, "input.txt")
+            with open(inputfile, "w") as f:
+                f.write("events")
+            binning = [("a", np.arange(0.0, 11.0)), ("b", np.arange(0.0, 11.0))]
+            def build(binning=binning, columns=columns, knots=[-5.0, 0.0, 5.0]):
+                systematics = SplineSystematics([("x", knots)])
+                return BinnedSample("cached", binning, ["a"], columns, cache_name="cached", cache_dir=cache_dir, systematics=systematics, input_files=[inputfile])
+            def ncached():
+                return len(os.listdir(cache_dir)) - 1
+            first = build()
+            self.assertEquals(ncached(), 1)
+            #same configuration is reloaded
+            reloaded = build()
+            self.assertEquals(ncached(), 1)
+            self.assertTrue(np.array_equal(first([2.0]), reloaded([2.0])))
+            #each change is a new cache entry
+            build(binning=[("a", np.arange(0.0, 11.0)), ("b", np.arange(0.0, 11.0, 2.0))])
+            self.assertEquals(ncached(), 2)
+            build(knots=[-4.0, 0.0, 4.0])
+            self.assertEquals(ncached(), 3)
+            build(columns=EventColumns(coords, np.full(len(coords), 2.0), columns.systweight))
+            self.assertEquals(ncached(), 4)
+            with open(inputfile, "a") as f:
+                f.write(" changed")
+            build()
+            self.assertEquals(ncached(), 5)
+        finally:
+            shutil.rmtree(cache_dir)
+        return
+
+    def test_engine_compare(self):
+        model = self._buildsmallmodel(engine="compare")
+        random = np.random.RandomState(1233)
+        generator = OscillationParametersPrior(seed=1232).generator
+        for _ in xrange(5):
+            oscpars = dict(zip(generator.parameter_names, generator()))
+            pars = np.array([oscpars.get(name, random.normal(1.0, 0.1)) for name in model.parameter_names])
+            #raises if the dense and sparse evaluation differ
+            model(pars)
+        with self.assertRaises(ValueError):
+            BinnedSample("none", [("a", np.arange(0.0, 10.0))], ["a"], [], engine="fast")
+        return
+
+    def test_incremental_eval(self):
+        model = self._buildsmallmodel(engine="compare")
+        random = np.random.RandomState(1236)
+        generator = OscillationParametersPrior(seed=1237).generator
+        oscpars = dict(zip(generator.parameter_names, generator()))
+        start = np.array([oscpars.get(name, 1.0) for name in model.parameter_names])
+        model(start)
+        #change one parameter at a time, then return to the start
+        for ipar in xrange(len(start)):
+            pars = np.copy(start)
+            pars[ipar] *= random.normal(1.0, 0.1)
+            #raises if the partially recalculated dense result differs from the sparse one
+            model(pars)
+            model(start)
+        return
+
+    def test_eval_batch(self):
+        model = self._buildsmallmodel()
+        random = np.random.RandomState(1234)
+        generator = OscillationParametersPrior(seed=1235).generator
+        oscpoints = [dict(zip(generator.parameter_names, generator())) for _ in xrange(3)]
+        #repeat oscillation parameters in a random order
+        pars_matrix = np.array([[oscpoints[ii].get(name, random.normal(1.0, 0.1)) for name in model.parameter_names] for ii in random.randint(3, size=20)])
+        batch = model.eval_batch(pars_matrix)
+        self.assertEquals(batch.shape, (20, len(model(pars_matrix[0]))))
+        for pars, vec in zip(pars_matrix, batch):
+            for x1, x2 in itertools.izip_longest(model(pars), vec):
+                self.assertAlmostEquals(x1, x2)
+        for sample in model.samples:
+            self.assertEquals(sample.eval_batch(np.zeros((0, len(sample.parameter_names)))).shape[0], 0)
+        with self.assertRaises(ValueError):
+            model.eval_batch(pars_matrix[:, 1:])
+        return
+
+    def test_jacobian(self):
+        model = self._buildsmallmodel()
+        random = np.random.RandomState(1238)
+        generator = OscillationParametersPrior(seed=1239).generator
+        for _ in xrange(3):
+            oscpars = dict(zip(generator.parameter_names, generator()))
+            pars = np.array([oscpars.get(name, random.normal(1.0, 0.1)) for name in model.parameter_names])
+            jacobian = model.jacobian(pars)
+            #central differences of the model
+            expected = Sample.jacobian(model, pars)
+            self.assertEquals(jacobian.shape, (len(model(pars)), len(pars)))
+            scale = np.max(np.abs(expected), axis=0) + 1.0
+            self.assertTrue(np.all(np.abs(jacobian - expected) <= 1e-5 * scale))
+            #the model is left at pars
+            self.assertTrue(np.array_equal(model(pars), model.eval_batch(pars[np.newaxis])[0]))
+        return
+
+    def _buildsmallmodel(self, engine="dense"):
+        random = np.random.RandomState(1231)
+        events = []
+        for _ in xrange(2000):
+            trueenu = random.uniform(0.0, 5.0)
+            coord = (trueenu, random.uniform(0.0, 4.0), random.normal(1.0, 0.1) * trueenu, random.randint(2))
+            sel = 0.0 if random.uniform() < 0.2 else random.uniform(0.2, 1.0)
+            events.append((coord, sel, 1.0, [tuple(random.normal(1.0, 0.1, size=3))]))
+        binning = [("trueenu", np.linspace(0.0, 5.0, num=11)), ("nupdg", np.arange(0.0, 5.0)), ("recoenu", np.linspace(0.0, 5.0, num=12)), ("beammode", [0.0, 1.0, 2.0])]
+        flux_error_binning = [((b, f), bb, fb, [0.0, 2.5, 5.0]) for bb, b in enumerate(["RHC", "FHC"]) for fb, f in enumerate(["numu", "nue", "numubar", "nuebar"])]
+        fluxparametermap = FluxSystematics.make_flux_parameter_map(binning[0][1], flux_error_binning)
+        systematics = FluxAndSplineSystematics([("x", [-5.0, 0.0, 5.0])], 0, 1, 3, fluxparametermap)
+        nd = BinnedSample("nd", binning, ["recoenu", "beammode"], [(c, s, w) for c, s, n, w in events], systematics=systematics, nprocesses=1, engine=engine)
+        fd = BinnedSampleWithOscillation("fd", binning, ["recoenu"], events, enuaxis="trueenu", flavaxis="nupdg", beammodeaxis="beammode", distance=295.0, 
+                                         systematics=SplineSystematics([("x", [-5.0, 0.0, 5.0])]), probabilitycalc=_TwoFlavourProbability(), nprocesses=1, engine=engine)
+        return CombinedBinnedSample([nd, fd])
+
     def test_generate_mc(self):
         _, toymc, _ = self._buildmodelnoosc()
         npe = 100
@@ -211,7 +845,7 @@ class TestModel(unittest.TestCase):
 
 class TestOscillationCalculation(unittest.TestCase):
 
-    def _buildtestmc(self, cachestr=None):
+    def _buildtestmc(self, cachestr=None, probabilitycalc=None, name="simplemodelwithoscillation"):
         systematics = [("x", [-5.0, 0.0, 5.0]),
                        ("y", [-5.0, 0.0, 5.0]),
                        ("z", [-5.0, 0.0, 5.0]),
@@ -227,8 +861,8 @@ class TestOscillationCalculation(unittest.TestCase):
                 yield coord, 1.0, 1.0, [(-4., 1.0, 6.0), (-4.0, 1.0, 6.0), (-4.0, 1.0, 6.0)]
         binning = [("trueenu", np.linspace(0.0, 5.0, num=10.0)), ("nupdg", np.arange(0.0, 5.0)), ("recoenu", np.linspace(0.0, 5.0, num=10.0))]
         observables = ["recoenu"]
-        model = BinnedSampleWithOscillation("simplemodelwithoscillation", binning, observables, gen(10**4), enuaxis="trueenu", flavaxis="nupdg", 
-                                            distance=295.0, systematics=systematics, probabilitycalc=None)
+        model = BinnedSampleWithOscillation(name, binning, observables, gen(10**4), enuaxis="trueenu", flavaxis="nupdg", 
+                                            distance=295.0, systematics=systematics, probabilitycalc=probabilitycalc)
         oscgen = OscillationParametersPrior(seed=1225).generator
         systgen = GaussianGenerator(["x", "y", "z"], [0.0, 0.0, 0.0], [0.1, 0.1, 0.1], seed=1226)
         #toymc = ToyMC(model, GeneratorList(oscgen))
@@ -236,7 +870,29 @@ class TestOscillationCalculation(unittest.TestCase):
         return toymc
 
     def test_systematics(self):
-        toymc = self._buildtestmc()
+        self._check_systematics(self._buildtestmc())
+        return
+
+    def test_systematics_vacuum(self):
+        self._check_systematics(self._buildtestmc(probabilitycalc=VacuumProbability()))
+        return
+
+    def test_shared_probability_cache(self):
+        calc = VacuumProbability()
+        toymcs = [self._buildtestmc(probabilitycalc=calc, name=name) for name in ["fhc", "rhc"]]
+        samples = [toymc.ratevector for toymc in toymcs]
+        model = CombinedBinnedSample(samples)
+        prob = samples[0]._model.probability_cache
+        self.assertIs(samples[1]._model.probability_cache, prob)
+        pars = np.copy(toymcs[0].asimov().pars)
+        pars[3] += 0.5
+        prob.clear()
+        vec = model(pars)
+        self.assertEquals((prob.hits, prob.misses), (0, 1))
+        self.assertTrue(np.array_equal(vec[:len(vec) // 2], vec[len(vec) // 2:]))
+        return
+
+    def _check_systematics(self, toymc):
         asimov = toymc.asimov()
         model = toymc.ratevector
         for scale in np.linspace(0.1, 1.9, num=10):
@@ -49,6 +49,18 @@ class TestMonteCarlo(unittest.TestCase):
                 self.assertAlmostEquals(v, ex, delta=3.0*er)
         return
 
+    def test_toymc_batch(self):
+        npe = 1000
+        statistics = []
+        for batchsize in [None, 7]:
+            toymc = ToyMC(self.model, GaussianGenerator(self.model.parameter_names, self.mu, self.sigma, seed=12913))
+            statistics.append(calculate_statistics_from_toymc(toymc, [Mean(), Covariance()], npe, batchsize=batchsize))
+        for s1, s2 in zip(*statistics):
+            self.assertTrue(np.array_equal(s1.eval(), s2.eval()))
+        with self.assertRaises(ValueError):
+            calculate_statistics_from_toymc(toymc, Mean(), npe, batchsize=0)
+        return
+
     def test_toymc_covariance(self):
         npe = 10**4
         toymc = ToyMC(self.model, self.gen)
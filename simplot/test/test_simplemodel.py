@@ -27,6 +27,16 @@ import ROOT
 def _smear(x, state=np.random, resolution=0.1):
     return state.normal(loc=1.0, scale=resolution) * x
 
+def _central_differences(func, pars, step=1e-6):
+    columns = []
+    for index in xrange(len(pars)):
+        h = step * max(abs(pars[index]), 1.0)
+        up, down = np.copy(pars), np.copy(pars)
+        up[index] += h
+        down[index] -= h
+        columns.append((np.array(func(up)) - np.array(func(down))) / (2.0 * h))
+    return np.array(columns).T
+
 class TestSimpleFit(unittest.TestCase):
 
     def _buildtestmc(self, cachestr=None):
@@ -70,6 +80,38 @@ class TestSimpleFit(unittest.TestCase):
                 self.assertAlmostEquals(v1, v2, delta=delta)
         return
 
+    def test_covariance_batch(self):
+        #the batched covariance generation draws the same experiments
+        keep = {"z":[-10.0, -5.0, 0.0, 1.0, 5.0, 10.0]}
+        _, cov1 = SimpleMcBuilder().build(None, self._buildtestmc(), npe=100, keep=keep, batchsize=None)
+        _, cov2 = SimpleMcBuilder().build(None, self._buildtestmc(), npe=100, keep=keep, batchsize=7)
+        self.assertTrue(np.allclose(cov1, cov2, rtol=1e-12, atol=0.0))
+        return
+
+    def test_eval_batch(self):
+        toymc1 = self._buildtestmc()
+        toymc2, cov = SimpleMcBuilder().build(None, toymc1, npe=100, keep={"z":[-10.0, -5.0, 0.0, 1.0, 5.0, 10.0]})
+        for toymc in [toymc1, toymc2]:
+            pars_matrix = np.array([toymc.generator() for _ in xrange(20)])
+            batch = toymc.ratevector.eval_batch(pars_matrix)
+            for pars, vec in zip(pars_matrix, batch):
+                for x1, x2 in itertools.izip_longest(toymc.ratevector(pars), vec):
+                    self.assertAlmostEquals(x1, x2)
+        return
+
+    def test_jacobian(self):
+        toymc1 = self._buildtestmc()
+        toymc2, cov = SimpleMcBuilder().build(None, toymc1, npe=100, keep={"z":[-10.0, -5.0, 0.0, 1.0, 5.0, 10.0]})
+        for toymc in [toymc1, toymc2]:
+            for _ in xrange(5):
+                pars = np.array(toymc.generator())
+                jacobian = toymc.ratevector.jacobian(pars)
+                #central differences of the model
+                expected = _central_differences(toymc.ratevector, pars)
+                scale = np.max(np.abs(expected), axis=0) + 1.0
+                self.assertTrue(np.all(np.abs(jacobian - expected) <= 1e-5 * scale))
+        return
+
 class TestSimpleFitWithOscillation(unittest.TestCase):
     def _buildtestmc(self, cachestr=None):
         systematics = [("x", [-5.0, 0.0, 5.0]),
@@ -102,6 +144,18 @@ class TestSimpleFitWithOscillation(unittest.TestCase):
         toymc2()
         return
 
+    def test_jacobian(self):
+        toymc1 = self._buildtestmc()
+        toymc2, cov = SimpleMcWithOscillationBuilder().build(None, toymc1, toymc1.ratevector, npe=100)
+        for _ in xrange(5):
+            pars = np.array(toymc2.generator())
+            jacobian = toymc2.ratevector.jacobian(pars)
+            #central differences of the model
+            expected = _central_differences(toymc2.ratevector, pars)
+            scale = np.max(np.abs(expected), axis=0) + 1.0
+            self.assertTrue(np.all(np.abs(jacobian - expected) <= 1e-5 * scale))
+        return
+
     def test_eval_model(self):
         npe = 10**3
         toymc1 = self._buildtestmc()
@@ -0,0 +1,407 @@
+import cPickle as pickle
+import itertools
+import operator
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from simplot.cache import CacheMemoryMap
+from simplot.sparsehist import SparseArray, SparseHistogram, ProjectionPlan, SparseExpression, set_num_threads, get_num_threads, share_patterns
+
+################################################################################
+
+def _randomarray(shape, nentries, state):
+    arr = SparseArray(shape)
+    indices = list(itertools.product(*[xrange(max(s, 1)) for s in shape]))
+    for ii in state.choice(len(indices), size=min(nentries, len(indices)), replace=False):
+        arr[list(indices[ii])] = state.uniform(0.5, 2.0)
+    return arr
+
+def _frozen(arr):
+    return arr.clone().freeze()
+
+def _dense(arr):
+    # numpy array with broadcast axes of length 1
+    shape = [max(s, 1) for s in arr.shape()]
+    return arr.flatten().reshape(shape, order="F")
+
+################################################################################
+
+class TestFrozenSparseArray(unittest.TestCase):
+
+    def setUp(self):
+        self.state = np.random.RandomState(1227)
+        self.shape = [3, 4, 5]
+
+    def _assert_equal_arrays(self, lhs, rhs):
+        self.assertEquals(list(lhs.shape()), list(rhs.shape()))
+        for x, y in itertools.izip_longest(lhs.flatten(), rhs.flatten()):
+            self.assertAlmostEquals(x, y)
+        return
+
+    def test_freeze_thaw(self):
+        arr = _randomarray(self.shape, 20, self.state)
+        frozen = _frozen(arr)
+        self.assertTrue(frozen.isfrozen())
+        self.assertFalse(arr.isfrozen())
+        self.assertEquals(len(arr), len(frozen))
+        self.assertAlmostEquals(arr.sum(), frozen.sum())
+        self._assert_equal_arrays(arr, frozen)
+        self._assert_equal_arrays(arr, frozen.clone().thaw())
+        return
+
+    def test_set_outside_pattern(self):
+        arr = _randomarray(self.shape, 20, self.state)
+        frozen = _frozen(arr)
+        for index in itertools.product(*[xrange(s) for s in self.shape]):
+            arr[index] = 1.0
+            frozen[index] = 1.0
+        self._assert_equal_arrays(arr, frozen)
+        return
+
+    def test_operators(self):
+        a = _randomarray(self.shape, 20, self.state)
+        b = _randomarray(self.shape, 20, self.state)
+        broadcast = _randomarray([3, 0, 5], 5, self.state)
+        for lhs, rhs in [(a, a.clone()), (a, b), (broadcast, a), (a, broadcast)]:
+            dl, dr = _dense(lhs), _dense(rhs)
+            #broadcast add and subtract are evaluated on the pattern of the full operand
+            mask = 1.0 if lhs.shape() == rhs.shape() else (_dense(rhs if lhs is broadcast else lhs) != 0.0)
+            quotient = np.divide(dl, dr, out=np.zeros(np.broadcast(dl, dr).shape), where=(dr != 0.0))
+            for fl, fr in itertools.product([lambda x: x.clone(), _frozen], repeat=2):
+                self._assert_equal_dense(dl * dr, fl(lhs) * fr(rhs))
+                self._assert_equal_dense(quotient, fl(lhs) / fr(rhs))
+                self._assert_equal_dense((dl + dr) * mask, fl(lhs) + fr(rhs))
+                self._assert_equal_dense((dl - dr) * mask, fl(lhs) - fr(rhs))
+                if rhs is broadcast or lhs.shape() == rhs.shape():
+                    for op, expected in [(operator.imul, dl * dr),
+                                         (operator.idiv, quotient),
+                                         (operator.iadd, (dl + dr) * mask),
+                                         (operator.isub, (dl - dr) * mask),
+                                         ]:
+                        inplace = fl(lhs)
+                        self.assertIs(op(inplace, fr(rhs)), inplace)
+                        self._assert_equal_dense(expected, inplace)
+        with self.assertRaises(Exception):
+            broadcast * _randomarray([3, 4, 0], 5, self.state)
+        return
+
+    def _assert_equal_dense(self, expected, arr):
+        for x, y in itertools.izip_longest(np.ravel(expected, order="F"), arr.flatten()):
+            self.assertAlmostEquals(x, y)
+        return
+
+    def test_output_buffers(self):
+        a = _randomarray(self.shape, 20, self.state)
+        b = _randomarray(self.shape, 20, self.state)
+        broadcast = _randomarray([3, 0, 5], 5, self.state)
+        for fa, fb in itertools.product([lambda x: x.clone(), _frozen], repeat=2):
+            lhs, rhs = fa(a), fb(b)
+            for out in [SparseArray(self.shape), _frozen(b), _frozen(a)]:
+                #repeated use of the same buffer
+                for _ in xrange(2):
+                    self.assertIs(lhs.multiply(rhs, out=out), out)
+                    self._assert_equal_arrays(lhs * rhs, out)
+                    self.assertIs(broadcast.multiply(rhs, out=out), out)
+                    self._assert_equal_arrays(broadcast * rhs, out)
+            #output aliasing an input
+            expected = lhs * rhs
+            self.assertIs(lhs.multiply(rhs, out=lhs), lhs)
+            self._assert_equal_arrays(expected, lhs)
+            out = SparseArray([3, 5])
+            self.assertIs(rhs.project([0, 2], out=out), out)
+            self._assert_equal_arrays(rhs.project([0, 2]), out)
+        with self.assertRaises(ValueError):
+            a.multiply(b, out=SparseArray([3, 4]))
+        return
+
+    def test_lazy_expression(self):
+        a = _randomarray(self.shape, 20, self.state)
+        b = _randomarray(self.shape, 20, self.state)
+        c = _randomarray(self.shape, 20, self.state)
+        broadcast = _randomarray([3, 0, 5], 5, self.state)
+        expressions = [lambda a, b, c, x: x * (c * (b * a)),
+                       lambda a, b, c, x: (a + b) * x - c,
+                       lambda a, b, c, x: a / b + x,
+                       lambda a, b, c, x: c * (a - x) / b,
+                       ]
+        for expression in expressions:
+            for f in [lambda x: x.clone(), _frozen]:
+                expected = expression(f(a), f(b), f(c), broadcast)
+                lazy = expression(f(a).lazy(), f(b), f(c), broadcast)
+                self.assertIsInstance(lazy, SparseExpression)
+                self._assert_equal_arrays(expected, lazy.evaluate())
+                out = SparseArray(self.shape)
+                for _ in xrange(2):
+                    self.assertIs(lazy.evaluate(out=out), out)
+                    self._assert_equal_arrays(expected, out)
+        expected = (a * b) * 2.0
+        self._assert_equal_arrays(expected, (a.lazy() * b * 2.0).evaluate())
+        #output aliasing an input
+        self.assertIs((b.lazy() * a).evaluate(out=b), b)
+        self._assert_equal_arrays(expected, b * 2.0)
+        with self.assertRaises(Exception):
+            broadcast.lazy() * _randomarray([3, 4, 0], 5, self.state)
+        return
+
+    def test_pickle(self):
+        arr = _randomarray(self.shape, 20, self.state)
+        broadcast = _randomarray([3, 0, 5], 5, self.state)
+        for a in [arr, _frozen(arr), broadcast, SparseArray(self.shape)]:
+            for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+                self._assert_equal_arrays(a, pickle.loads(pickle.dumps(a, protocol)))
+        return
+
+    def test_array_interop(self):
+        arr = _randomarray(self.shape, 20, self.state)
+        broadcast = _randomarray([3, 0, 5], 5, self.state)
+        for a in [arr, _frozen(arr), broadcast, SparseArray(self.shape)]:
+            keys, values = a.to_arrays()
+            self.assertEquals(list(keys), sorted(keys))
+            self._assert_equal_arrays(a, SparseArray.from_arrays(a.shape(), keys, values))
+            indices, values = a.to_indices()
+            self.assertEquals(indices.shape, (len(a), len(self.shape)))
+            for index, value in zip(indices, values):
+                self.assertAlmostEquals(a[list(index)], value)
+            self._assert_equal_arrays(a, SparseArray.from_indices(a.shape(), indices, values))
+        #frozen arrays are exported without a copy
+        frozen = _frozen(arr)
+        frozen.to_arrays()[1][:] = 2.0
+        self.assertAlmostEquals(2.0 * len(arr), frozen.sum())
+        #duplicates are summed
+        summed = SparseArray.from_indices([3, 4], [[1, 2], [0, 0], [1, 2]], [1.0, 2.0, 3.0])
+        self.assertEquals(len(summed), 2)
+        self.assertAlmostEquals(summed[[1, 2]], 4.0)
+        with self.assertRaises(IndexError):
+            SparseArray.from_indices([3, 4], [[3, 0]], [1.0])
+        with self.assertRaises(ValueError):
+            SparseArray.from_arrays([3, 4], [1, 2], [1.0])
+        return
+
+    def test_scipy(self):
+        arr = _randomarray([4, 6], 10, self.state)
+        for format in ["coo", "csr"]:
+            matrix = arr.to_scipy(format=format)
+            self.assertEquals(matrix.format, format)
+            for x, y in itertools.izip_longest(_dense(arr).ravel(), matrix.toarray().ravel()):
+                self.assertAlmostEquals(x, y)
+            self._assert_equal_arrays(arr, SparseArray.from_scipy(matrix))
+        with self.assertRaises(ValueError):
+            _randomarray(self.shape, 10, self.state).to_scipy()
+        return
+
+    def test_storage(self):
+        arr = _randomarray(self.shape, 20, self.state)
+        expected = arr.clone()
+        arr.reserve(1000)
+        self.assertGreater(arr.memory_usage(), 1000 * 8)
+        arr.rehash()
+        self.assertLess(arr.memory_usage(), 1000 * 8)
+        self._assert_equal_arrays(expected, arr)
+        frozen = _frozen(arr)
+        self.assertLess(frozen.memory_usage(), arr.memory_usage())
+        #arrays with the same keys share one key array
+        arrays = [arr, arr * 2.0, _frozen(arr) * 3.0, _randomarray(self.shape, 20, self.state)]
+        share_patterns(arrays)
+        self.assertTrue(all(a.isfrozen() for a in arrays))
+        self.assertIs(arrays[0].to_arrays()[0], arrays[1].to_arrays()[0])
+        self.assertIs(arrays[0].to_arrays()[0], arrays[2].to_arrays()[0])
+        self._assert_equal_arrays(expected * 3.0, arrays[2])
+        return
+
+    def test_project(self):
+        arr = _randomarray(self.shape, 20, self.state)
+        for keep in [[0], [1, 2], [2, 0]]:
+            self._assert_equal_arrays(arr.project(keep), _frozen(arr).project(keep))
+        #range restricted projection against a dense reference
+        dense = _dense(arr)
+        for keep, range_ in [([0], {1:(1, 3)}), ([2, 1], {0:(2, 3), 2:(-1, 2)})]:
+            selected = dense.copy()
+            for axis, (low, high) in range_.iteritems():
+                outside = [b for b in xrange(self.shape[axis]) if not low <= b < high]
+                selected[(slice(None),) * axis + (outside,)] = 0.0
+            summed = selected.sum(axis=tuple(d for d in xrange(len(self.shape)) if d not in keep))
+            expected = np.transpose(summed, np.argsort(np.argsort(keep)))
+            for a in [arr, _frozen(arr)]:
+                self._assert_equal_dense(expected, a.project(keep, range_=range_))
+        return
+
+    def test_projection_plan(self):
+        arr = _frozen(_randomarray(self.shape, 30, self.state))
+        other = _frozen(_randomarray(self.shape, 30, self.state))
+        for keep, range_ in [([0], None), ([2, 1], None), ([1], {0:(1, 3)})]:
+            plan = ProjectionPlan(self.shape, keep, range_)
+            out = np.zeros(plan.size())
+            for a in [arr, arr.clone(), other, other.clone().thaw()]:
+                expected = a.project(keep, range_=range_).flatten()
+                for x, y in itertools.izip_longest(expected, plan(a)):
+                    self.assertAlmostEquals(x, y)
+                self.assertIs(plan(a, out=out), out)
+                for x, y in itertools.izip_longest(expected, out):
+                    self.assertAlmostEquals(x, y)
+        return
+
+################################################################################
+
+class TestThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.state = np.random.RandomState(1229)
+        self.shape = [200, 4, 50]
+        self._nthreads = get_num_threads()
+
+    def tearDown(self):
+        set_num_threads(self._nthreads)
+
+    def test_threads(self):
+        #large enough to be split between threads
+        a = _frozen(_randomarray(self.shape, 30000, self.state))
+        b = _frozen(_randomarray(self.shape, 30000, self.state))
+        broadcast = _frozen(_randomarray([200, 0, 50], 1000, self.state))
+        plan = ProjectionPlan(self.shape, [2, 0])
+        results = []
+        for nthreads in [1, 3]:
+            set_num_threads(nthreads)
+            results.append([(a * b).flatten(),
+                             (a * a.clone()).flatten(),
+                             (broadcast * a).flatten(),
+                             (a.lazy() * b * broadcast + a).evaluate().flatten(),
+                             plan(a),
+                             [a.sum()],
+                             ])
+        for serial, threaded in zip(*results):
+            for x, y in itertools.izip_longest(serial, threaded):
+                self.assertAlmostEquals(x, y)
+        with self.assertRaises(ValueError):
+            set_num_threads(0)
+        return
+
+################################################################################
+
+class TestSparseHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self.state = np.random.RandomState(1228)
+        self.binning = [np.linspace(0.0, 5.0, num=11), np.arange(0.0, 5.0), np.linspace(0.0, 1.0, num=3)]
+
+    def test_fill_many(self):
+        coords = self.state.uniform(-1.0, 6.0, size=(1000, 3))
+        weights = self.state.uniform(0.0, 2.0, size=1000)
+        h1 = SparseHistogram(self.binning)
+        for c, w in zip(coords, weights):
+            h1.fill(c, w)
+        h2 = SparseHistogram(self.binning)
+        h2.fill_many(coords[:500], weights[:500])
+        h2.fill_many(coords[500:], weights[500:])
+        self.assertEquals(len(h1), len(h2))
+        for x, y in itertools.izip_longest(h1.array().flatten(), h2.array().flatten()):
+            self.assertAlmostEquals(x, y)
+        #missing coordinates fill the first bin
+        h1.fill_many(coords[:, :2], weights)
+        for c, w in zip(coords, weights):
+            h2.fill(c[:2], w)
+        for x, y in itertools.izip_longest(h1.array().flatten(), h2.array().flatten()):
+            self.assertAlmostEquals(x, y)
+        with self.assertRaises(ValueError):
+            h2.fill_many(np.hstack([coords, coords]), weights)
+        return
+
+    def test_fill_keys(self):
+        coords = self.state.uniform(-1.0, 6.0, size=(1000, 3))
+        weights = self.state.uniform(0.0, 2.0, size=1000)
+        h1 = SparseHistogram(self.binning)
+        h1.fill_many(coords, weights)
+        h2 = SparseHistogram(self.binning)
+        keys, inverse = np.unique(h2.bin_keys(coords), return_inverse=True)
+        h2.fill_keys(keys, np.bincount(inverse, weights=weights))
+        self.assertEquals(len(h1), len(h2))
+        for x, y in itertools.izip_longest(h1.array().flatten(), h2.array().flatten()):
+            self.assertAlmostEquals(x, y)
+        with self.assertRaises(ValueError):
+            h2.fill_keys(keys, weights)
+        return
+
+    def test_cache(self):
+        hist = SparseHistogram(self.binning)
+        hist.fill_many(self.state.uniform(-1.0, 6.0, size=(1000, 3)))
+        cn = CacheMemoryMap("test_sparsehist_cache", tmpdir=tempfile.mkdtemp())
+        data = (hist, [hist.array().clone().freeze(), np.arange(5)])
+        cn.write(data)
+        h2, (a2, x2) = cn.read()
+        for arr in [h2.array(), a2]:
+            for x, y in itertools.izip_longest(hist.array().flatten(), arr.flatten()):
+                self.assertAlmostEquals(x, y)
+        #loaded arrays can be modified
+        h2.fill([0.0, 0.0, 0.0], 2.0)
+        self.assertAlmostEquals(hist.eval([0.0, 0.0, 0.0]) + 2.0, h2.eval([0.0, 0.0, 0.0]))
+        self.assertEquals(list(x2), range(5))
+        #rewriting leaves arrays mapped from the previous file intact
+        cn.write(np.zeros(100))
+        self.assertEquals(list(x2), range(5))
+        self.assertEquals(len(cn.read()), 100)
+        #a failed write leaves the previous file and no temporary files
+        with self.assertRaises(Exception):
+            cn.write(lambda: None)
+        self.assertEquals(os.listdir(os.path.dirname(cn.tmpfilename())), [os.path.basename(cn.tmpfilename())])
+        self.assertEquals(len(cn.read()), 100)
+        return
+
+    def test_split(self):
+        coords = self.state.uniform(-1.0, 6.0, size=(1000, 3))
+        hist = SparseHistogram(self.binning)
+        hist.fill_many(coords, self.state.uniform(0.0, 2.0, size=1000))
+        for h in [hist, hist.clone()]:
+            h.array().freeze()
+            for axes, splitaxis in [([0], 1), ([2, 0], 1), ([1], 0)]:
+                binning = self.binning[splitaxis]
+                split = h.split_nd(axes, splitaxis)
+                self.assertEquals(len(split), len(binning) - 1)
+                for ii, s in enumerate(split):
+                    #middle of the bin to avoid the edges
+                    range_ = {splitaxis:(0.5 * (binning[ii] + binning[ii + 1]), binning[ii + 1])}
+                    expected = h.project_nd(axes, range_=range_).array().flatten()
+                    for x, y in itertools.izip_longest(expected, s.array().flatten()):
+                        self.assertAlmostEquals(x, y)
+            for ii, h1 in enumerate(h.split_1d(2, 0)):
+                range_ = {0:(self.binning[0][ii], self.binning[0][ii + 1])}
+                for x, y in itertools.izip_longest(h.project_1d(2, range_=range_).values, h1.values):
+                    self.assertAlmostEquals(x, y)
+        #an axis with a single edge has no bins (it is broadcast)
+        broadcast = SparseHistogram([self.binning[0], [0.0]])
+        broadcast.fill_many(coords[:, :1])
+        for splitaxis in [1, 2]:
+            with self.assertRaises(ValueError):
+                broadcast.split_nd([0], splitaxis)
+        return
+
+    def test_merge(self):
+        coords = self.state.uniform(-1.0, 6.0, size=(1000, 3))
+        weights = self.state.uniform(0.0, 2.0, size=1000)
+        expected = SparseHistogram(self.binning)
+        expected.fill_many(coords, weights)
+        for freeze in [False, True]:
+            parts = [SparseHistogram(self.binning) for _ in xrange(3)]
+            for ii, h in enumerate(parts):
+                h.fill_many(coords[ii::3], weights[ii::3])
+                if freeze:
+                    h.array().freeze()
+            total = parts[0]
+            for h in parts[1:]:
+                total += h
+            self.assertIs(total, parts[0])
+            for x, y in itertools.izip_longest(expected.array().flatten(), total.array().flatten()):
+                self.assertAlmostEquals(x, y)
+        with self.assertRaises(ValueError):
+            total.merge(SparseHistogram(self.binning[:2]))
+        return
+
+################################################################################
+
+def main():
+    unittest.main()
+    return
+
+if __name__ == "__main__":
+    main()